@@ -8,10 +8,17 @@ from bot.handlers.start import register_handlers
 from bot.handlers.payment import register_payment_handlers
 from bot.handlers.admin import register_admin_handlers
 from bot.utils.db import init_db
-from bot.utils.middlewares import ThrottlingMiddleware, BanCheckMiddleware, AntiFloodMiddleware
+from bot.utils.middlewares import ThrottlingMiddleware, BanCheckMiddleware, AntiFloodMiddleware, DeadChatMiddleware
 from bot.services.ban_service import BanService
 from bot.services.payment_service import PaymentService
 from bot.services.notification_service import NotificationService
+from bot.services.renewal_service import RenewalService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.dead_chat_service import DeadChatService
+from bot.services.broadcast_service import BroadcastService
+from bot.services.extension_service import ExtensionService
+from bot.services.stats_service import StatsService
+from bot.services.funnel_service import FunnelService
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +39,8 @@ dp = Dispatcher()
 throttling_middleware = ThrottlingMiddleware(rate_limit=2.0)
 
 # Добавляем middleware
+dp.message.outer_middleware(DeadChatMiddleware(DeadChatService))  # Пользователь снова доступен для сообщений
+dp.callback_query.outer_middleware(DeadChatMiddleware(DeadChatService))  # Для callback_query
 dp.message.middleware(throttling_middleware)  # Ограничение в 2 секунды
 dp.callback_query.middleware(ThrottlingMiddleware(rate_limit=1.0))  # Для callback_query
 dp.message.middleware(BanCheckMiddleware(ban_service))  # Проверка бана
@@ -49,6 +58,15 @@ async def main() -> None:
     logger.info("Инициализация базы данных...")
     await init_db()
     
+    # Загружаем каталог тарифов в память
+    await PlanRegistry.load()
+    
+    # Заполняем счетчики статистики при первом запуске
+    await StatsService.ensure_initialized()
+    
+    # Загружаем реестр чатов, заблокировавших бота
+    await DeadChatService.load()
+    
     # Запускаем задачу очистки для ThrottlingMiddleware
     await throttling_middleware.start_cleanup()
     
@@ -60,12 +78,29 @@ async def main() -> None:
     asyncio.create_task(NotificationService.start_notification_checker(bot, check_interval=3600))
     logger.info("Запущена проверка истекающих подписок каждый час")
     
+    # Учитываем окончания подписок в счетчиках статистики
+    asyncio.create_task(StatsService.start_expiry_checker(check_interval=3600))
+    
+    # Продолжаем рассылки, прерванные перезапуском
+    await BroadcastService.resume_unfinished(bot)
+    
+    # Продолжаем обновление VPN сервера по массовым продлениям
+    await ExtensionService.resume_unfinished(bot)
+    
+    # Запускаем автопродление подписок (если включено в настройках)
+    asyncio.create_task(RenewalService.start_renewal_checker(bot, check_interval=3600))
+    
+    # Запускаем запись событий воронки из буфера в БД
+    asyncio.create_task(FunnelService.start_flusher())
+    
     logger.info("Запуск бота...")
     try:
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        # Сохраняем события воронки, не записанные из буфера
+        await FunnelService.flush()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -47,10 +47,30 @@ if not YOOKASSA_SECRET_KEY:
     
 PAYMENT_RETURN_URL = os.getenv("PAYMENT_RETURN_URL", "https://t.me/ftwVPN_BOT")
 
+# Токен провайдера YooKassa из BotFather для оплаты через счета Telegram
+TELEGRAM_PAYMENT_PROVIDER_TOKEN = os.getenv("TELEGRAM_PAYMENT_PROVIDER_TOKEN")
+if not TELEGRAM_PAYMENT_PROVIDER_TOKEN:
+    logger.warning("TELEGRAM_PAYMENT_PROVIDER_TOKEN не найден, оплата счетами Telegram недоступна")
+
+# Базовый URL API YooKassa (можно указать локальный тестовый сервер)
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL")
+
+# Автопродление подписок сохраненным способом оплаты
+AUTO_RENEW_ENABLED = os.getenv("AUTO_RENEW_ENABLED", "false").lower() in ("1", "true", "yes")
+AUTO_RENEW_BEFORE_HOURS = int(os.getenv("AUTO_RENEW_BEFORE_HOURS", "24"))  # За сколько часов до окончания списывать оплату
+
+# Этапы напоминаний об окончании подписки: за сколько часов до окончания (0 - подписка истекла).
+# Порядок задает номер бита этапа в clients.reminder_stages - новые этапы добавлять в конец
+REMINDER_STAGES_HOURS = [int(hours) for hours in os.getenv("REMINDER_STAGES_HOURS", "168,72,24,0").split(",")]
+
 # Печатаем финальные значения переменных (безопасно)
 logger.info("Финальные значения переменных:")
 logger.info(f"YOOKASSA_SHOP_ID: {'Настроен' if YOOKASSA_SHOP_ID else 'Не настроен'}")
 logger.info(f"YOOKASSA_SECRET_KEY: {'Настроен' if YOOKASSA_SECRET_KEY else 'Не настроен'}")
+logger.info(f"TELEGRAM_PAYMENT_PROVIDER_TOKEN: {'Настроен' if TELEGRAM_PAYMENT_PROVIDER_TOKEN else 'Не настроен'}")
+logger.info(f"YOOKASSA_API_URL: {YOOKASSA_API_URL or 'По умолчанию'}")
+logger.info(f"REMINDER_STAGES_HOURS: {REMINDER_STAGES_HOURS}")
+logger.info(f"AUTO_RENEW_ENABLED: {AUTO_RENEW_ENABLED}, AUTO_RENEW_BEFORE_HOURS: {AUTO_RENEW_BEFORE_HOURS}")
 
 # Проверяем все необходимые переменные
 required_vars = {
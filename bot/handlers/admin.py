@@ -1,5 +1,6 @@
 from aiogram import Router, F, types
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import logging
@@ -11,12 +12,25 @@ from bot.models.plan import Plan
 from bot.models.payment import Payment
 from bot.models.promo import Promo
 from bot.config import ADMIN_IDS
-from sqlalchemy import func, desc
+from bot.utils.pagination import KeysetList, invalidate_count
+from bot.services.plan_registry import PlanRegistry
+from bot.services.broadcast_service import BroadcastService
+from bot.services.audience_service import AudienceService
+from bot.services.stats_service import StatsService
+from bot.services.user_lookup_service import UserLookupService
+from bot.services.export_service import ExportService
+from bot.services.extension_service import ExtensionService
+from bot.services.promo_service import PromoService
+from bot.services.funnel_service import FunnelService
+from bot.services.dead_chat_service import DeadChatService
+from bot.services.notification_service import NotificationService
 import math
+import os
+import tempfile
 import asyncio
 import random
 import string
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
 router = Router()
@@ -25,6 +39,7 @@ logger = logging.getLogger(__name__)
 # Состояния FSM для рассылки
 class BroadcastStates(StatesGroup):
     waiting_for_message = State()  # Ожидание сообщения для рассылки
+    waiting_for_audience = State()  # Ожидание фильтров аудитории
 
 # Состояния FSM для создания промокода
 class PromoStates(StatesGroup):
@@ -58,58 +73,96 @@ async def admin_panel(message: types.Message):
         [types.InlineKeyboardButton(text="Платежи", callback_data="admin_payments")],
         [types.InlineKeyboardButton(text="Промокоды", callback_data="admin_promos")],
         [types.InlineKeyboardButton(text="Тарифы", callback_data="admin_plans")],
+        [types.InlineKeyboardButton(text="Статистика", callback_data="admin_stats")],
         [types.InlineKeyboardButton(text="Рассылка", callback_data="admin_broadcast")]
     ])
     
     await message.answer("Админ-панель. Выберите раздел:", reply_markup=keyboard)
 
+# Списки админ-панели с постраничным выводом по ключу сортировки
+ADMIN_LISTS = {
+    "users": KeysetList(
+        "users", select(User), [User.id],
+        key=lambda row: (row[0].id,)
+    ),
+    "clients": KeysetList(
+        "clients", select(Client, User).join(User, Client.user_id == User.id), [Client.expiry_time, Client.id],
+        key=lambda row: (row[0].expiry_time, row[0].id)
+    ),
+    "payments": KeysetList(
+        "payments", select(Payment, User).join(User, Payment.user_id == User.id), [Payment.id],
+        key=lambda row: (row[0].id,)
+    ),
+    "promos": KeysetList(
+        "promos", select(Promo), [Promo.is_active, Promo.id],
+        key=lambda row: (row[0].is_active, row[0].id)
+    ),
+    "plans": KeysetList(
+        "plans", select(Plan), [Plan.id], descending=False,
+        key=lambda row: (row[0].id,)
+    )
+}
+
 # Функция для пагинации результатов
-async def paginate_results(query_func, page, page_size, callback):
+async def paginate_results(list_name, page, page_size, callback, cursor=None, forward=True):
+    """
+    Формирует страницу списка админ-панели
+    
+    Args:
+        list_name: Имя списка из ADMIN_LISTS
+        page: Номер страницы (для отображения)
+        page_size: Количество записей на странице
+        callback: Форматер записей
+        cursor: Ключ последней (или первой при движении назад) показанной записи
+        forward: Направление движения
+    """
+    keyset_list = ADMIN_LISTS[list_name]
+    
     try:
-        # Получаем общее количество записей
         async with async_session() as session:
-            total_count = await query_func(session, count=True)
+            # Количество записей кэшируется и не пересчитывается на каждое нажатие
+            total_count = await keyset_list.count(session)
             
-            if total_count == 0:
-                return "Записи не найдены.", None
+            rows, has_more = await keyset_list.fetch(session, page_size, cursor, forward)
             
-            # Вычисляем общее количество страниц
-            total_pages = math.ceil(total_count / page_size)
+            # Перед курсором не осталось полной страницы - показываем первую
+            if not forward and (len(rows) < page_size or page <= 1):
+                page, forward = 1, True
+                rows, has_more = await keyset_list.fetch(session, page_size)
             
-            # Проверяем корректность номера страницы
-            if page < 1:
-                page = 1
-            elif page > total_pages:
-                page = total_pages
+            if not rows:
+                return "Записи не найдены.", None
             
-            # Получаем данные для текущей страницы
-            results = await query_func(session, page=page, page_size=page_size)
+            has_next = has_more if forward else True
+            has_prev = page > 1
             
             # Форматируем результаты
-            text = callback(results)
+            items = [row[0] for row in rows] if len(rows[0]) == 1 else rows
+            text = callback(items)
             
             # Создаем клавиатуру для пагинации
             keyboard = []
             
             # Добавляем навигационные кнопки
             nav_buttons = []
-            if page > 1:
+            if has_prev:
                 nav_buttons.append(types.InlineKeyboardButton(
                     text="◀️ Назад", 
-                    callback_data=f"{query_func.__name__}_{page-1}"
+                    callback_data=f"pg:{list_name}:{page-1}:p:{keyset_list.encode_cursor(rows[0])}"
                 ))
             
-            if page < total_pages:
+            if has_next:
                 nav_buttons.append(types.InlineKeyboardButton(
                     text="Вперёд ▶️", 
-                    callback_data=f"{query_func.__name__}_{page+1}"
+                    callback_data=f"pg:{list_name}:{page+1}:n:{keyset_list.encode_cursor(rows[-1])}"
                 ))
             
             if nav_buttons:
                 keyboard.append(nav_buttons)
             
             # Добавляем статус пагинации и кнопку возврата
-            info_text = f"Страница {page} из {total_pages} (всего записей: {total_count})"
+            total_pages = max(math.ceil(total_count / page_size), page)
+            info_text = f"Страница {page} из ~{total_pages} (всего записей: ~{total_count})"
             
             # Добавляем кнопку назад в меню
             keyboard.append([types.InlineKeyboardButton(text="Назад в меню", callback_data="admin_back")])
@@ -120,74 +173,6 @@ async def paginate_results(query_func, page, page_size, callback):
         logger.error(f"Ошибка при пагинации результатов: {e}")
         return f"Ошибка при получении данных: {e}", None
 
-# Функции для получения данных из БД
-async def get_users(session, page=1, page_size=10, count=False):
-    if count:
-        result = await session.execute(select(func.count()).select_from(User))
-        return result.scalar()
-    
-    result = await session.execute(
-        select(User)
-        .order_by(desc(User.created_at))
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
-    return result.scalars().all()
-
-async def get_clients(session, page=1, page_size=10, count=False):
-    if count:
-        result = await session.execute(select(func.count()).select_from(Client))
-        return result.scalar()
-    
-    result = await session.execute(
-        select(Client, User)
-        .join(User, Client.user_id == User.id)
-        .order_by(desc(Client.expiry_time))
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
-    return result.all()
-
-async def get_payments(session, page=1, page_size=10, count=False):
-    if count:
-        result = await session.execute(select(func.count()).select_from(Payment))
-        return result.scalar()
-    
-    result = await session.execute(
-        select(Payment, User)
-        .join(User, Payment.user_id == User.id)
-        .order_by(desc(Payment.created_at))
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
-    return result.all()
-
-async def get_promos(session, page=1, page_size=10, count=False):
-    if count:
-        result = await session.execute(select(func.count()).select_from(Promo))
-        return result.scalar()
-    
-    result = await session.execute(
-        select(Promo)
-        .order_by(desc(Promo.is_active), Promo.expiration_date)
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
-    return result.scalars().all()
-
-async def get_plans(session, page=1, page_size=10, count=False):
-    if count:
-        result = await session.execute(select(func.count()).select_from(Plan))
-        return result.scalar()
-    
-    result = await session.execute(
-        select(Plan)
-        .order_by(Plan.id)
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
-    return result.scalars().all()
-
 # Форматеры для вывода результатов
 def format_users(users):
     result = []
@@ -233,6 +218,10 @@ def format_clients(clients):
     
     return "\n".join(result) if result else "Нет клиентов."
 
+def format_utc(value: datetime) -> str:
+    """Время платежа хранится в UTC - в карточках показываем его в локальном времени сервера, как и сроки подписок"""
+    return value.replace(tzinfo=timezone.utc).astimezone().strftime('%d.%m.%Y %H:%M')
+
 def format_payments(payments):
     result = []
     for payment, user in payments:
@@ -240,8 +229,8 @@ def format_payments(payments):
             f"💰 <b>ID:</b> {payment.id} | <b>Пользователь:</b> {user.tg_id} (@{user.username})\n"
             f"💸 Сумма: {payment.amount} ₽\n"
             f"Status: {payment.status}\n"
-            f"📅 Создан: {payment.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-            f"📅 Оплачен: {payment.paid_at.strftime('%d.%m.%Y %H:%M') if payment.paid_at else 'Не оплачен'}\n"
+            f"📅 Создан: {format_utc(payment.created_at)}\n"
+            f"📅 Оплачен: {format_utc(payment.paid_at) if payment.paid_at else 'Не оплачен'}\n"
         )
     
     return "\n".join(result) if result else "Нет платежей."
@@ -302,7 +291,7 @@ async def process_admin_users(callback: types.CallbackQuery):
         await callback.answer("У вас нет прав администратора", show_alert=True)
         return
     
-    text, markup = await paginate_results(get_users, 1, 5, format_users)
+    text, markup = await paginate_results("users", 1, 5, format_users)
     await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
     await callback.answer()
 
@@ -312,7 +301,7 @@ async def process_admin_clients(callback: types.CallbackQuery):
         await callback.answer("У вас нет прав администратора", show_alert=True)
         return
     
-    text, markup = await paginate_results(get_clients, 1, 5, format_clients)
+    text, markup = await paginate_results("clients", 1, 5, format_clients)
     await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
     await callback.answer()
 
@@ -322,7 +311,7 @@ async def process_admin_payments(callback: types.CallbackQuery):
         await callback.answer("У вас нет прав администратора", show_alert=True)
         return
     
-    text, markup = await paginate_results(get_payments, 1, 5, format_payments)
+    text, markup = await paginate_results("payments", 1, 5, format_payments)
     await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
     await callback.answer()
 
@@ -338,7 +327,7 @@ async def process_admin_promos(callback: types.CallbackQuery):
         [types.InlineKeyboardButton(text="Назад в меню", callback_data="admin_back")]
     ])
     
-    text, markup = await paginate_results(get_promos, 1, 5, format_promos)
+    text, markup = await paginate_results("promos", 1, 5, format_promos)
     
     # Добавляем кнопку создания промокода к существующей клавиатуре
     if markup:
@@ -355,63 +344,39 @@ async def process_admin_plans(callback: types.CallbackQuery):
         await callback.answer("У вас нет прав администратора", show_alert=True)
         return
     
-    text, markup = await paginate_results(get_plans, 1, 5, format_plans)
+    text, markup = await paginate_results("plans", 1, 5, format_plans)
     await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
     await callback.answer()
 
-# Обработчики для пагинации
-@router.callback_query(lambda c: c.data.startswith("get_users_"))
-async def paginate_users(callback: types.CallbackQuery):
-    if not await is_admin(callback.from_user.id):
-        await callback.answer("У вас нет прав администратора", show_alert=True)
-        return
-    
-    page = int(callback.data.split("_")[-1])
-    text, markup = await paginate_results(get_users, page, 5, format_users)
-    await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
-    await callback.answer()
+# Форматеры списков для обработчика пагинации
+LIST_FORMATTERS = {
+    "users": format_users,
+    "clients": format_clients,
+    "payments": format_payments,
+    "promos": format_promos,
+    "plans": format_plans
+}
 
-@router.callback_query(lambda c: c.data.startswith("get_clients_"))
-async def paginate_clients(callback: types.CallbackQuery):
+# Обработчик пагинации: pg:{список}:{страница}:{n|p}:{курсор}
+@router.callback_query(lambda c: c.data.startswith("pg:"))
+async def paginate_list(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
         await callback.answer("У вас нет прав администратора", show_alert=True)
         return
     
-    page = int(callback.data.split("_")[-1])
-    text, markup = await paginate_results(get_clients, page, 5, format_clients)
-    await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
-    await callback.answer()
-
-@router.callback_query(lambda c: c.data.startswith("get_payments_"))
-async def paginate_payments(callback: types.CallbackQuery):
-    if not await is_admin(callback.from_user.id):
-        await callback.answer("У вас нет прав администратора", show_alert=True)
+    _, list_name, page, direction, cursor = callback.data.split(":", 4)
+    if list_name not in ADMIN_LISTS:
+        await callback.answer("Неизвестный список", show_alert=True)
         return
     
-    page = int(callback.data.split("_")[-1])
-    text, markup = await paginate_results(get_payments, page, 5, format_payments)
-    await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
-    await callback.answer()
-
-@router.callback_query(lambda c: c.data.startswith("get_promos_"))
-async def paginate_promos(callback: types.CallbackQuery):
-    if not await is_admin(callback.from_user.id):
-        await callback.answer("У вас нет прав администратора", show_alert=True)
-        return
+    text, markup = await paginate_results(
+        list_name, int(page), 5, LIST_FORMATTERS[list_name], cursor=cursor, forward=direction == "n"
+    )
     
-    page = int(callback.data.split("_")[-1])
-    text, markup = await paginate_results(get_promos, page, 5, format_promos)
-    await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
-    await callback.answer()
-
-@router.callback_query(lambda c: c.data.startswith("get_plans_"))
-async def paginate_plans(callback: types.CallbackQuery):
-    if not await is_admin(callback.from_user.id):
-        await callback.answer("У вас нет прав администратора", show_alert=True)
-        return
+    # Кнопка создания промокода, как на первой странице раздела
+    if list_name == "promos" and markup:
+        markup.inline_keyboard.insert(0, [types.InlineKeyboardButton(text="➕ Создать промокод", callback_data="admin_create_promo")])
     
-    page = int(callback.data.split("_")[-1])
-    text, markup = await paginate_results(get_plans, page, 5, format_plans)
     await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
     await callback.answer()
 
@@ -428,6 +393,7 @@ async def back_to_admin_menu(callback: types.CallbackQuery):
         [types.InlineKeyboardButton(text="Платежи", callback_data="admin_payments")],
         [types.InlineKeyboardButton(text="Промокоды", callback_data="admin_promos")],
         [types.InlineKeyboardButton(text="Тарифы", callback_data="admin_plans")],
+        [types.InlineKeyboardButton(text="Статистика", callback_data="admin_stats")],
         [types.InlineKeyboardButton(text="Рассылка", callback_data="admin_broadcast")]
     ])
     
@@ -444,7 +410,7 @@ async def start_broadcast(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(BroadcastStates.waiting_for_message)
     await callback.message.edit_text(
         "📣 Введите сообщение для рассылки всем пользователям.\n"
-        "Поддерживается HTML-разметка.\n\n"
+        "Поддерживается HTML-разметка, а также фото, видео, документы и другие типы сообщений.\n\n"
         "Для отмены нажмите кнопку ниже.",
         reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="Отмена", callback_data="admin_cancel_broadcast")]
@@ -452,7 +418,10 @@ async def start_broadcast(callback: types.CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "admin_cancel_broadcast", BroadcastStates.waiting_for_message)
+@router.callback_query(
+    lambda c: c.data == "admin_cancel_broadcast",
+    StateFilter(BroadcastStates.waiting_for_message, BroadcastStates.waiting_for_audience)
+)
 async def cancel_broadcast(callback: types.CallbackQuery, state: FSMContext):
     if not await is_admin(callback.from_user.id):
         await callback.answer("У вас нет прав администратора", show_alert=True)
@@ -473,30 +442,90 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
     if not await is_admin(message.from_user.id):
         return
     
-    broadcast_text = message.text
-    if not broadcast_text:
-        await message.answer("❌ Сообщение не может быть пустым. Попробуйте снова или нажмите Отмена.")
-        return
+    # Текст рассылается с HTML-разметкой, остальные типы сообщений копируются как есть
+    if message.text:
+        broadcast_text = message.text
+        source_message_id = None
+        preview = f"Текст сообщения:\n{broadcast_text}"
+    else:
+        broadcast_text = message.caption or ""
+        source_message_id = message.message_id
+        preview = f"Тип сообщения: {message.content_type}"
+        if broadcast_text:
+            preview += f"\nПодпись:\n{broadcast_text}"
+    
+    # Сохраняем сообщение для дальнейшего использования
+    await state.update_data(
+        broadcast_text=broadcast_text, source_message_id=source_message_id,
+        broadcast_preview=preview, broadcast_segment={}
+    )
+    await send_broadcast_confirmation(message, state)
+
+async def send_broadcast_confirmation(message: types.Message, state: FSMContext):
+    """Показывает подтверждение рассылки с оценкой размера выбранной аудитории"""
+    user_data = await state.get_data()
+    segment = user_data.get("broadcast_segment") or {}
     
-    # Получаем список всех пользователей
-    async with async_session() as session:
-        result = await session.execute(select(User))
-        users = result.scalars().all()
+    # Количество получателей одним COUNT-запросом по сегменту
+    recipients = await BroadcastService.count_recipients(segment)
     
     # Подтверждение рассылки
     await message.answer(
-        f"📨 Вы собираетесь отправить сообщение {len(users)} пользователям.\n\n"
-        f"Текст сообщения:\n{broadcast_text}\n\n"
+        f"📨 Вы собираетесь отправить сообщение {recipients} пользователям.\n"
+        f"Аудитория: {AudienceService.describe(segment)}\n\n"
+        f"{user_data.get('broadcast_preview', '')}\n\n"
         f"Подтвердите рассылку:",
         reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="✅ Подтвердить", callback_data="admin_confirm_broadcast")],
+            [types.InlineKeyboardButton(text="🎯 Выбрать аудиторию", callback_data="admin_broadcast_audience")],
             [types.InlineKeyboardButton(text="❌ Отмена", callback_data="admin_cancel_broadcast")]
         ]),
         parse_mode="HTML"
     )
+
+@router.callback_query(lambda c: c.data == "admin_broadcast_audience", BroadcastStates.waiting_for_message)
+async def choose_broadcast_audience(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
     
-    # Сохраняем текст сообщения для дальнейшего использования
-    await state.update_data(broadcast_text=broadcast_text)
+    await state.set_state(BroadcastStates.waiting_for_audience)
+    await callback.message.edit_text(
+        f"🎯 Введите фильтры аудитории.\n\n{AudienceService.HELP_TEXT}",
+        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="👥 Все пользователи", callback_data="admin_broadcast_audience_all")],
+            [types.InlineKeyboardButton(text="❌ Отмена", callback_data="admin_cancel_broadcast")]
+        ]),
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+@router.callback_query(lambda c: c.data == "admin_broadcast_audience_all", BroadcastStates.waiting_for_audience)
+async def reset_broadcast_audience(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+    
+    await state.update_data(broadcast_segment={})
+    await state.set_state(BroadcastStates.waiting_for_message)
+    await callback.message.delete()
+    await send_broadcast_confirmation(callback.message, state)
+    await callback.answer()
+
+@router.message(BroadcastStates.waiting_for_audience)
+async def process_broadcast_audience(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    
+    try:
+        segment = AudienceService.parse(message.text or "")
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{AudienceService.HELP_TEXT}", parse_mode="HTML")
+        return
+    
+    await state.update_data(broadcast_segment=segment)
+    await state.set_state(BroadcastStates.waiting_for_message)
+    await send_broadcast_confirmation(message, state)
 
 @router.callback_query(lambda c: c.data == "admin_confirm_broadcast", BroadcastStates.waiting_for_message)
 async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext):
@@ -507,51 +536,63 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext):
     # Получаем сохраненное сообщение
     user_data = await state.get_data()
     broadcast_text = user_data.get("broadcast_text", "")
+    source_message_id = user_data.get("source_message_id")
+    segment = user_data.get("broadcast_segment") or {}
     
-    if not broadcast_text:
+    if not broadcast_text and not source_message_id:
         await callback.message.edit_text("❌ Ошибка: сообщение для рассылки не найдено.")
         await state.clear()
         return
     
-    # Получаем всех пользователей
-    async with async_session() as session:
-        result = await session.execute(select(User))
-        users = result.scalars().all()
-    
-    # Информируем о начале рассылки
-    await callback.message.edit_text(f"🚀 Начинаем рассылку {len(users)} пользователям...")
-    
-    # Счетчики для статистики
-    total_users = len(users)
-    successful = 0
-    failed = 0
-    
-    # Отправляем сообщения пользователям
-    for user in users:
-        try:
-            await callback.bot.send_message(user.tg_id, broadcast_text, parse_mode="HTML")
-            successful += 1
-            # Небольшая пауза чтобы не перегрузить API
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения пользователю {user.tg_id}: {e}")
-            failed += 1
-    
-    # Отчет о завершении рассылки
-    await callback.message.answer(
-        f"✅ Рассылка завершена!\n\n"
-        f"📊 Статистика:\n"
-        f"- Всего пользователей: {total_users}\n"
-        f"- Успешно отправлено: {successful}\n"
-        f"- Ошибок: {failed}",
-        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="Вернуться в админ-панель", callback_data="admin_back")]
-        ])
+    # Рассылка сохраняется и выполняется в фоне, чтобы пережить перезапуск бота
+    broadcast_id = await BroadcastService.create(
+        broadcast_text, callback.message.chat.id, callback.message.message_id, source_message_id, segment
     )
+    await callback.message.edit_text(
+        "🚀 Начинаем рассылку...",
+        reply_markup=BroadcastService.get_control_keyboard(broadcast_id, BroadcastService.STATUS_RUNNING)
+    )
+    BroadcastService.start(callback.bot, broadcast_id)
     
     # Очищаем состояние
     await state.clear()
 
+@router.callback_query(F.data.regexp(r"^bc_(pause|resume|cancel):\d+$"))
+async def control_broadcast(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+    
+    action, broadcast_id = callback.data[len("bc_"):].split(":")
+    broadcast_id = int(broadcast_id)
+    
+    if action == "pause":
+        changed = await BroadcastService.pause(broadcast_id)
+        status = BroadcastService.STATUS_PAUSED
+    elif action == "resume":
+        changed = await BroadcastService.resume(callback.bot, broadcast_id)
+        status = BroadcastService.STATUS_RUNNING
+    else:
+        changed = await BroadcastService.cancel(broadcast_id)
+        status = BroadcastService.STATUS_CANCELED
+    
+    if not changed:
+        await callback.answer("Рассылка уже завершена или в другом состоянии", show_alert=True)
+        return
+    
+    # Кнопки меняем сразу, счетчики обновит задача рассылки после текущей порции
+    await callback.message.edit_reply_markup(
+        reply_markup=BroadcastService.get_control_keyboard(broadcast_id, status)
+    )
+    await callback.answer({
+        BroadcastService.STATUS_PAUSED: "Рассылка будет приостановлена",
+        BroadcastService.STATUS_RUNNING: "Рассылка продолжена",
+        BroadcastService.STATUS_CANCELED: "Рассылка отменена"
+    }[status])
+
+# Максимум промокодов в одной пакетной генерации
+MAX_GENERATED_PROMOS = 100000
+
 # Функция генерации случайного кода промокода
 def generate_promo_code(length=8):
     """Генерирует случайный промокод из букв и цифр"""
@@ -797,6 +838,7 @@ async def create_promo(callback: types.CallbackQuery, state: FSMContext):
             
             session.add(new_promo)
             await session.commit()
+            invalidate_count("promos")
             
             # Подтверждаем создание промокода
             await callback.message.edit_text(
@@ -853,7 +895,7 @@ async def delete_promo(callback: types.CallbackQuery):
             await callback.answer(f"Промокод {promo.code} деактивирован", show_alert=True)
             
             # Обновляем список промокодов
-            text, markup = await paginate_results(get_promos, 1, 5, format_promos)
+            text, markup = await paginate_results("promos", 1, 5, format_promos)
             
             # Добавляем кнопку создания промокода
             if markup:
@@ -865,6 +907,501 @@ async def delete_promo(callback: types.CallbackQuery):
         logger.error(f"Ошибка при деактивации промокода {promo_id}: {e}")
         await callback.answer("Произошла ошибка при деактивации промокода", show_alert=True)
 
+# Команда /setprice - изменение цены тарифа
+@router.message(Command("setprice"))
+async def set_plan_price(message: types.Message):
+    """/setprice <ключ тарифа> <цена>"""
+    if not await check_admin(message):
+        return
+    
+    args = message.text.split()[1:]
+    if len(args) != 2 or not args[1].isdigit() or int(args[1]) <= 0:
+        await message.answer("Формат: /setprice <ключ тарифа> <цена>, например /setprice base 79")
+        return
+    
+    key, price = args[0], int(args[1])
+    
+    async with async_session() as session:
+        result = await session.execute(select(Plan).where(Plan.key == key))
+        plan = result.scalar_one_or_none()
+        
+        if not plan:
+            await message.answer(f"Тариф {key} не найден")
+            return
+        
+        old_price = plan.price
+        plan.price = price
+        await session.commit()
+    
+    # Перечитываем каталог тарифов и сбрасываем выданные расчеты покупок
+    await PlanRegistry.reload()
+    
+    logger.info(f"Администратор {message.from_user.id} изменил цену тарифа {key}: {old_price} -> {price}")
+    await message.answer(f"Цена тарифа {plan.title} изменена: {old_price} ₽ → {price} ₽")
+
+# Команда /reminders - эффективность напоминаний об окончании подписки
+@router.message(Command("reminders"))
+async def reminders_stats(message: types.Message):
+    """/reminders [дней] - доля продлений после напоминаний каждого этапа"""
+    if not await check_admin(message):
+        return
+    
+    args = message.text.split()[1:]
+    days = int(args[0]) if args and args[0].isdigit() else 30
+    
+    rates = await NotificationService.get_renewal_rates(days)
+    lag = NotificationService.get_lag_stats()
+    
+    text = f"<b>Напоминания за {days} дней</b>\n\n"
+    if rates:
+        for stage, data in rates.items():
+            stage_name = f"за {stage} ч" if stage > 0 else "после окончания"
+            text += f"• {stage_name}: отправлено {data['sent']}, продлено {data['renewed']} ({data['rate'] * 100:.1f}%)\n"
+    else:
+        text += "Напоминания не отправлялись\n"
+    
+    text += (
+        f"\nВ расписании: {lag['scheduled']}\n"
+        f"Задержка отправки: средняя {lag['avg_lag']:.0f} с, p95 {lag['p95_lag']:.0f} с"
+    )
+    
+    await message.answer(text, parse_mode="HTML")
+
+# Экран статистики - читается из счетчиков stat_counters
+@router.callback_query(lambda c: c.data == "admin_stats")
+async def process_admin_stats(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+    
+    stats = await StatsService.get_summary()
+    
+    text = (
+        f"📊 <b>Статистика</b>\n\n"
+        f"👤 Пользователей: {stats['users']} (сегодня +{stats['users_today']})\n"
+        f"💳 Оплативших: {stats['paying_users']} (конверсия {stats['conversion']}%)\n\n"
+        f"💰 Выручка сегодня: {stats['revenue_today']} ₽ ({stats['payments_today']} платежей)\n"
+        f"💰 Выручка за месяц: {stats['revenue_month']} ₽ ({stats['payments_month']} платежей)\n"
+        f"💰 Выручка всего: {stats['revenue_total']} ₽\n\n"
+        f"🔑 Действующие платные подписки:\n"
+    )
+    for plan in PlanRegistry.get_plans():
+        if plan.tariff_id:
+            text += f"• {plan.title}: {stats['active_clients'].get(plan.tariff_id, 0)}\n"
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
+        [types.InlineKeyboardButton(text="Назад в меню", callback_data="admin_back")]
+    ])
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    except TelegramBadRequest:
+        # Данные не изменились с прошлого обновления
+        pass
+    await callback.answer()
+
+# Команда /rebuildstats - пересчет счетчиков статистики по исходным таблицам
+@router.message(Command("rebuildstats"))
+async def rebuild_stats(message: types.Message):
+    if not await check_admin(message):
+        return
+    
+    await message.answer("⏳ Пересчитываю счетчики статистики...")
+    try:
+        await StatsService.rebuild()
+        await message.answer("✅ Счетчики статистики пересчитаны")
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете статистики: {e}")
+        await message.answer(f"Ошибка при пересчете статистики: {e}")
+
+def format_user_card(card):
+    """Карточка пользователя для поддержки"""
+    user = card["user"]
+    
+    if user.is_banned:
+        ban_until = f" до {user.banned_until.strftime('%d.%m.%Y %H:%M')}" if user.banned_until else ""
+        ban_status = f"🚫 Забанен{ban_until}: {user.ban_reason or 'причина не указана'}"
+    else:
+        ban_status = "✅ Не забанен"
+    
+    text = (
+        f"👤 <b>ID:</b> {user.id} | <b>TG ID:</b> <code>{user.tg_id}</code>\n"
+        f"👤 @{user.username}\n"
+        f"📧 {user.email or 'Нет email'}\n"
+        f"📅 {user.created_at.strftime('%d.%m.%Y %H:%M') if user.created_at else '-'}\n"
+        f"Status: {ban_status}\n"
+        f"🔁 Автопродление: {'включено' if user.auto_renew else 'выключено'}"
+        f"{' (бот заблокирован пользователем)' if DeadChatService.is_dead(user.tg_id) else ''}\n"
+    )
+    
+    if card["clients"]:
+        text += "\n" + format_clients([(client, user) for client in card["clients"]])
+        for client in card["clients"]:
+            text += f"🆔 UUID: <code>{client.uuid}</code>\n"
+    else:
+        text += "\nКлиента VPN нет\n"
+    
+    if card["payments"]:
+        text += "\n<b>Последние платежи:</b>\n"
+        for payment in card["payments"]:
+            paid = format_utc(payment.paid_at) if payment.paid_at else "не оплачен"
+            text += f"• <code>{payment.payment_id}</code> - {payment.amount} ₽, {payment.status}, {paid}\n"
+    else:
+        text += "\nПлатежей нет\n"
+    
+    return text
+
+# Команда /find - поиск пользователя по любому идентификатору
+@router.message(Command("find"))
+async def find_user(message: types.Message):
+    """/find <tg_id | @username | email | UUID | user_<id> | ID платежа>"""
+    if not await check_admin(message):
+        return
+    
+    query = message.text.split(maxsplit=1)[1] if len(message.text.split(maxsplit=1)) > 1 else ""
+    if not query:
+        await message.answer(
+            "Использование: /find &lt;tg_id | @username | email | UUID клиента | user_&lt;id&gt; | ID платежа&gt;",
+            parse_mode="HTML"
+        )
+        return
+    
+    users = await UserLookupService.find(query)
+    
+    if not users:
+        await message.answer("Пользователь не найден.")
+        return
+    
+    if len(users) == 1:
+        card = await UserLookupService.get_card(users[0].id)
+        await message.answer(format_user_card(card), parse_mode="HTML")
+        return
+    
+    # Несколько совпадений по началу username - предлагаем выбрать
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=f"@{user.username} ({user.tg_id})", callback_data=f"find_user_{user.id}")]
+        for user in users
+    ])
+    await message.answer(f"Найдено пользователей: {len(users)}. Выберите:", reply_markup=keyboard)
+
+@router.callback_query(lambda c: c.data.startswith("find_user_"))
+async def show_user_card(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+    
+    card = await UserLookupService.get_card(int(callback.data.split("_")[-1]))
+    if not card:
+        await callback.answer("Пользователь не найден", show_alert=True)
+        return
+    
+    await callback.message.answer(format_user_card(card), parse_mode="HTML")
+    await callback.answer()
+
+# Команда /reconcile - сверка платежей с YooKassa
+@router.message(Command("reconcile"))
+async def reconcile_payments(message: types.Message):
+    """
+    /reconcile [ДД.ММ.ГГГГ] [ДД.ММ.ГГГГ] [fix]
+
+    Без дат сверяет вчерашний день. С флагом fix активирует платежи,
+    оплаченные в YooKassa, но не активированные в БД.
+    """
+    if not await check_admin(message):
+        return
+
+    args = message.text.split()[1:]
+    auto_activate = "fix" in args
+    dates = [arg for arg in args if arg != "fix"]
+
+    try:
+        if dates:
+            date_from = datetime.strptime(dates[0], "%d.%m.%Y")
+            date_to = datetime.strptime(dates[1], "%d.%m.%Y") if len(dates) > 1 else date_from
+        else:
+            date_from = date_to = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    except ValueError:
+        await message.answer("Формат: /reconcile [ДД.ММ.ГГГГ] [ДД.ММ.ГГГГ] [fix]")
+        return
+
+    # Конечная дата включительно
+    date_to += timedelta(days=1)
+
+    await message.answer(f"Сверка платежей за {date_from:%d.%m.%Y} - {(date_to - timedelta(days=1)):%d.%m.%Y} запущена...")
+
+    # Сверка может занять время - выполняем ее в фоне, не блокируя обработку апдейтов
+    asyncio.create_task(_run_reconciliation(message, date_from, date_to, auto_activate))
+
+async def _run_reconciliation(message: types.Message, date_from: datetime, date_to: datetime, auto_activate: bool):
+    """Выполняет сверку и отправляет администратору отчет"""
+    from bot.services.reconciliation_service import ReconciliationService
+
+    report_path = os.path.join(tempfile.gettempdir(), f"reconcile_{date_from:%Y%m%d}_{date_to:%Y%m%d}_{message.from_user.id}.csv")
+
+    try:
+        stats = await ReconciliationService.reconcile(date_from, date_to, report_path, auto_activate, message.bot)
+
+        summary = (
+            f"<b>Сверка платежей завершена</b>\n\n"
+            f"YooKassa: {stats['yookassa']}, БД: {stats['db']}, совпало: {stats['matched']}\n"
+            f"Нет в БД: {stats['missing_in_db']}\n"
+            f"Нет в YooKassa: {stats['missing_in_yookassa']}\n"
+            f"Расхождение статуса: {stats['status_mismatch']}\n"
+            f"Расхождение суммы: {stats['amount_mismatch']}"
+        )
+        if auto_activate:
+            summary += f"\nАктивировано: {stats['activated']}"
+
+        await message.answer_document(types.FSInputFile(report_path), caption=summary, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Ошибка при сверке платежей: {e}")
+        await message.answer(f"Ошибка при сверке платежей: {e}")
+    finally:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+# Команда /export - выгрузка таблицы в сжатый файл
+@router.message(Command("export"))
+async def export_table(message: types.Message):
+    """
+    /export <users|clients|payments> [csv|jsonl] [ДД.ММ.ГГГГ] [ДД.ММ.ГГГГ]
+
+    Период фильтрует пользователей и платежи по дате создания, клиентов -
+    по дате окончания подписки. Конечная дата включительно.
+    """
+    if not await check_admin(message):
+        return
+
+    args = message.text.split()[1:]
+    usage = "Формат: /export <users|clients|payments> [csv|jsonl] [ДД.ММ.ГГГГ] [ДД.ММ.ГГГГ]"
+
+    if not args or args[0] not in ExportService.TABLES:
+        await message.answer(usage)
+        return
+
+    table = args[0]
+    fmt = "csv"
+    if len(args) > 1 and args[1] in ExportService.FORMATS:
+        fmt = args[1]
+        dates = args[2:]
+    else:
+        dates = args[1:]
+
+    try:
+        date_from = datetime.strptime(dates[0], "%d.%m.%Y") if dates else None
+        date_to = datetime.strptime(dates[1], "%d.%m.%Y") + timedelta(days=1) if len(dates) > 1 else None
+    except ValueError:
+        await message.answer(usage)
+        return
+
+    await message.answer(f"Выгрузка {table} ({fmt}) запущена...")
+
+    # Выгрузка большой таблицы может занять время - выполняем ее в фоне
+    asyncio.create_task(_run_export(message, table, fmt, date_from, date_to))
+
+async def _run_export(message: types.Message, table: str, fmt: str, date_from: datetime, date_to: datetime):
+    """Выполняет выгрузку и отправляет администратору файл"""
+    export_path = os.path.join(
+        tempfile.gettempdir(),
+        f"export_{table}_{datetime.now():%Y%m%d%H%M%S}_{message.from_user.id}.{fmt}.gz"
+    )
+
+    try:
+        total = await ExportService.export(table, export_path, fmt, date_from, date_to)
+
+        period = ""
+        if date_from or date_to:
+            period_from = f"{date_from:%d.%m.%Y}" if date_from else "..."
+            period_to = f"{(date_to - timedelta(days=1)):%d.%m.%Y}" if date_to else "..."
+            period = f" за {period_from} - {period_to}"
+
+        await message.answer_document(
+            types.FSInputFile(export_path),
+            caption=f"<b>Выгрузка {table}</b>{period}\nСтрок: {total}",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке {table}: {e}")
+        await message.answer(f"Ошибка при выгрузке {table}: {e}")
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+
+# Подтвержденные продления (защита от повторного нажатия кнопки)
+confirmed_extensions = set()
+
+# Команда /extend - массовое продление действующих платных подписок
+@router.message(Command("extend"))
+async def extend_subscriptions(message: types.Message):
+    """/extend <дней> [tariff=<тип тарифа>] - сначала показывает количество подписок для подтверждения"""
+    if not await check_admin(message):
+        return
+
+    args = message.text.split()[1:]
+    usage = "Формат: /extend <дней> [tariff=<тип тарифа>], например /extend 3 или /extend 3 tariff=2"
+
+    if not args or not args[0].isdigit() or not 0 < int(args[0]) <= 365:
+        await message.answer(usage)
+        return
+
+    days = int(args[0])
+    tariff_id = 0
+    if len(args) > 1:
+        name, _, value = args[1].partition("=")
+        if name != "tariff" or not value.isdigit() or not PlanRegistry.get_by_tariff_id(int(value)):
+            await message.answer(usage)
+            return
+        tariff_id = int(value)
+
+    # Пробный запуск - только количество подписок
+    count = await ExtensionService.count(tariff_id or None)
+    if not count:
+        await message.answer("Нет действующих платных подписок для продления.")
+        return
+
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [
+            types.InlineKeyboardButton(text="✅ Продлить", callback_data=f"extend_confirm:{days}:{tariff_id}"),
+            types.InlineKeyboardButton(text="❌ Отменить", callback_data="extend_cancel")
+        ]
+    ])
+    tariff_text = f" тарифа {tariff_id}" if tariff_id else ""
+    await message.answer(
+        f"Будет продлено подписок{tariff_text}: {count} на {days} дн.\n"
+        f"Новые сроки будут отправлены на VPN сервер. Продолжить?",
+        reply_markup=keyboard
+    )
+
+@router.callback_query(F.data.regexp(r"^extend_confirm:\d+:\d+$"))
+async def confirm_extension(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+
+    key = (callback.message.chat.id, callback.message.message_id)
+    if key in confirmed_extensions:
+        await callback.answer("Продление уже запущено", show_alert=True)
+        return
+    confirmed_extensions.add(key)
+
+    _, days, tariff_id = callback.data.split(":")
+
+    await callback.message.edit_text("⏳ Продлеваю подписки...")
+
+    # Продление сохраняется заданием, обновление сервера выполняется в фоне
+    job_id = await ExtensionService.create(
+        int(days), callback.message.chat.id, callback.message.message_id, int(tariff_id) or None
+    )
+    ExtensionService.start(callback.bot, job_id)
+
+    logger.info(f"Администратор {callback.from_user.id} продлил подписки на {days} дн. (задание {job_id})")
+    await callback.answer()
+
+@router.callback_query(lambda c: c.data == "extend_cancel")
+async def cancel_extension(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("У вас нет прав администратора", show_alert=True)
+        return
+
+    await callback.message.edit_text("Продление отменено.")
+    await callback.answer()
+
+# Команда /genpromo - пакетная генерация одноразовых промокодов
+@router.message(Command("genpromo"))
+async def generate_promo_codes(message: types.Message):
+    """/genpromo <количество> <скидка %> [дней действия] [префикс]"""
+    if not await check_admin(message):
+        return
+
+    args = message.text.split()[1:]
+    usage = "Формат: /genpromo <количество> <скидка %> [дней действия] [префикс], например /genpromo 1000 20 30 PARTNER"
+
+    if len(args) < 2 or not args[0].isdigit() or not args[1].isdigit():
+        await message.answer(usage)
+        return
+
+    count, discount = int(args[0]), int(args[1])
+    if not 0 < count <= MAX_GENERATED_PROMOS or not 0 < discount <= 100:
+        await message.answer(f"Количество - от 1 до {MAX_GENERATED_PROMOS}, скидка - от 1 до 100%")
+        return
+
+    days = None
+    if len(args) > 2:
+        if not args[2].isdigit() or int(args[2]) <= 0:
+            await message.answer(usage)
+            return
+        days = int(args[2])
+
+    prefix = args[3].upper() if len(args) > 3 else ""
+    if prefix and not prefix.isalnum():
+        await message.answer(usage)
+        return
+
+    await message.answer(f"Генерация {count} промокодов запущена...")
+
+    # Генерация большой пачки занимает время - выполняем ее в фоне
+    asyncio.create_task(_run_promo_generation(message, count, discount, days, prefix))
+
+async def _run_promo_generation(message: types.Message, count: int, discount: int, days: int, prefix: str):
+    """Создает промокоды и отправляет администратору файл с кодами"""
+    expiration_date = datetime.now() + timedelta(days=days) if days else None
+    codes_path = os.path.join(
+        tempfile.gettempdir(),
+        f"promo_{datetime.now():%Y%m%d%H%M%S}_{message.from_user.id}.txt"
+    )
+
+    try:
+        codes = await PromoService.generate_bulk(count, discount, expiration_date, usage_limit=1, prefix=prefix)
+        invalidate_count("promos")
+
+        def write_codes():
+            with open(codes_path, "w", encoding="utf-8") as codes_file:
+                codes_file.write("\n".join(codes) + "\n")
+
+        await asyncio.to_thread(write_codes)
+
+        await message.answer_document(
+            types.FSInputFile(codes_path),
+            caption=(
+                f"<b>Создано промокодов: {len(codes)}</b>\n"
+                f"Скидка: {discount}%, одноразовые\n"
+                f"Срок действия: {expiration_date.strftime('%d.%m.%Y %H:%M') if expiration_date else 'бессрочно'}"
+            ),
+            parse_mode="HTML"
+        )
+        logger.info(f"Администратор {message.from_user.id} создал {len(codes)} промокодов со скидкой {discount}%")
+    except Exception as e:
+        logger.error(f"Ошибка при генерации промокодов: {e}")
+        await message.answer(f"Ошибка при генерации промокодов: {e}")
+    finally:
+        if os.path.exists(codes_path):
+            os.remove(codes_path)
+
+# Команда /funnel - воронка покупки
+@router.message(Command("funnel"))
+async def funnel_report(message: types.Message):
+    """/funnel [дней] - конверсия и медианное время между шагами воронки"""
+    if not await check_admin(message):
+        return
+
+    args = message.text.split()[1:]
+    days = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 7
+
+    await message.answer(f"Отчет по воронке за {days} дн. формируется...")
+
+    # Отчет строится в фоне, не задерживая обработку апдейтов
+    asyncio.create_task(_run_funnel_report(message, days))
+
+async def _run_funnel_report(message: types.Message, days: int):
+    """Строит отчет по воронке и отправляет его администратору"""
+    try:
+        report = await FunnelService.build_report(days)
+        await message.answer(FunnelService.format_report(report, days), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Ошибка при построении отчета по воронке: {e}")
+        await message.answer(f"Ошибка при построении отчета по воронке: {e}")
+
 # Регистрация обработчиков
 def register_admin_handlers(dp):
     """Регистрирует обработчики администратора"""
@@ -11,6 +11,9 @@ from bot.utils.db import async_session
 from bot.services.payment_service import DEFAULT_EMAIL
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from bot.services.promo_service import PromoService
+from bot.services.checkout_service import CheckoutService, CheckoutQuote
+from bot.services.stats_service import StatsService
+from bot.services.funnel_service import FunnelService
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -39,14 +42,24 @@ async def process_tariff_selection(callback: types.CallbackQuery, state: FSMCont
                 username=callback.from_user.username or "none"
             )
             session.add(user)
+            await StatsService.record_user_created(session)
             await session.commit()
             has_email = False
         else:
             has_email = bool(user.email)
     
-    # Сохраняем выбранный тариф
-    await state.update_data(selected_tariff=tariff_key)
+    # Рассчитываем покупку один раз - расчет используется до создания платежа
+    try:
+        quote = await CheckoutService.build_quote(callback.from_user.id, tariff_key, user_id=user.id)
+    except ValueError as e:
+        await callback.message.edit_text(f"Ошибка: {str(e)}")
+        await callback.answer()
+        return
+    
+    # Сохраняем выбранный тариф и расчет (выбор другого тарифа заменяет расчет)
+    await state.update_data(selected_tariff=tariff_key, checkout_quote=quote.to_dict())
     await state.set_state(ContactState.tariff_selected)
+    FunnelService.emit(callback.from_user.id, FunnelService.TARIFF)
     
     # Если у пользователя уже есть email, спрашиваем, хочет ли он его использовать
     if has_email:
@@ -137,12 +150,17 @@ async def process_promo(message: types.Message, state: FSMContext):
     # Получаем данные из состояния
     user_data = await state.get_data()
     email = user_data.get("email")
-    user_id = message.from_user.id
+    quote = CheckoutQuote.from_dict(user_data.get("checkout_quote"))
     
-    # Проверяем промокод
-    is_valid, discount, promo = await PromoService.check_promo(promo_code, user_id)
+    # Проверяем промокод (привязка промокода хранится по ID пользователя в БД)
+    is_valid, discount, promo = await PromoService.check_promo(promo_code, quote.user_id if quote else None)
     
     if is_valid:
+        # Применяем скидку к расчету без повторного чтения плана
+        if quote:
+            quote = CheckoutService.apply_promo(quote, promo_code, discount)
+            await state.update_data(checkout_quote=quote.to_dict())
+        
         # Создаем платеж с промокодом
         await message.answer(
             f"Промокод применен. Скидка: {discount}%",
@@ -165,6 +183,7 @@ async def ask_for_promo(callback_or_message, state, email):
     
     # Сохраняем email в состоянии
     await state.update_data(email=email)
+    FunnelService.emit(callback_or_message.from_user.id, FunnelService.EMAIL)
     
     # Спрашиваем, хочет ли пользователь ввести промокод
     await message.edit_text(
@@ -236,6 +255,7 @@ async def process_contact(message: types.Message, state: FSMContext):
                 email=email
             )
             session.add(user)
+            await StatsService.record_user_created(session)
             await session.commit()
             logger.info(f"Создан пользователь {message.from_user.id} с email {email}")
     
@@ -259,6 +279,7 @@ async def skip_email(callback: types.CallbackQuery, state: FSMContext):
                 username=callback.from_user.username or "none"
             )
             session.add(user)
+            await StatsService.record_user_created(session)
             await session.commit()
     
     # Спрашиваем о промокоде
@@ -363,25 +384,68 @@ async def create_payment_with_email(callback_or_message, state, email, promo_cod
     is_callback = isinstance(callback_or_message, types.CallbackQuery)
     message = callback_or_message.message if is_callback else callback_or_message
     user_id = callback_or_message.from_user.id
+    FunnelService.emit(user_id, FunnelService.PROMO)
     
-    # Получаем выбранный тариф
+    # Получаем выбранный тариф и расчет покупки
     user_data = await state.get_data()
     tariff_key = user_data.get("selected_tariff")
+    quote = CheckoutQuote.from_dict(user_data.get("checkout_quote"))
     
     # Сбрасываем состояние
     await state.clear()
     
+    # Расчет пересчитывается, только если он устарел или изменился тариф/промокод
+    if not CheckoutService.is_valid(quote, tariff_key, promo_code):
+        try:
+            quote = await CheckoutService.build_quote(user_id, tariff_key, promo_code)
+        except ValueError as e:
+            text = f"Ошибка: {str(e)}"
+            
+            if is_callback:
+                await message.edit_text(text)
+                await callback_or_message.answer()
+            else:
+                await message.answer(text)
+            return
+    
+    # Тариф может оплачиваться счетом Telegram вместо страницы YooKassa
+    if PaymentService.get_payment_method(tariff_key) == "invoice":
+        try:
+            payment_id = await PaymentService.create_invoice(
+                quote=quote,
+                chat_id=message.chat.id,
+                bot=callback_or_message.bot,
+                contact=email
+            )
+            
+            if payment_id:
+                FunnelService.emit(user_id, FunnelService.PAYMENT_CREATED)
+            
+            text = (
+                "Счёт на оплату отправлен ниже.\n"
+                "После оплаты тариф будет активирован автоматически."
+            ) if payment_id else "Не удалось создать платеж. Попробуйте позже."
+        except ValueError as e:
+            text = f"Ошибка: {str(e)}"
+        
+        if is_callback:
+            await message.edit_text(text)
+            await callback_or_message.answer()
+        else:
+            await message.answer(text)
+        return
+    
     # Создаем платеж
     try:
         payment_id, payment_url, markup = await PaymentService.create_payment(
-            user_id=user_id,
-            tariff_key=tariff_key,
+            quote=quote,
             contact=email,
-            bot=callback_or_message.bot,
-            promo_code=promo_code
+            bot=callback_or_message.bot
         )
         
         if payment_id and payment_url and markup:
+            FunnelService.emit(user_id, FunnelService.PAYMENT_CREATED)
+            
             text = (
                 f"Для оплаты нажмите кнопку 'Оплатить'.\n"
                 f"После успешной оплаты тариф будет активирован автоматически."
@@ -417,6 +481,37 @@ async def create_payment_with_email(callback_or_message, state, email, promo_cod
     if is_callback:
         await callback_or_message.answer()
 
+# Проверка счета Telegram перед списанием
+@router.pre_checkout_query()
+async def process_pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
+    try:
+        ok, error_message = await PaymentService.validate_invoice(
+            pre_checkout_query.invoice_payload,
+            pre_checkout_query.total_amount,
+            pre_checkout_query.currency
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при проверке счета {pre_checkout_query.invoice_payload}: {e}")
+        ok, error_message = False, "Произошла ошибка, попробуйте позже"
+    
+    await pre_checkout_query.answer(ok=ok, error_message=error_message)
+
+# Успешная оплата счета Telegram - активируем тариф без опроса YooKassa
+@router.message(F.successful_payment)
+async def process_successful_payment(message: types.Message):
+    payment = message.successful_payment
+    
+    logger.info(f"Получена оплата счета {payment.invoice_payload} от пользователя {message.from_user.id}: "
+                f"{payment.total_amount / 100} {payment.currency}, charge_id={payment.provider_payment_charge_id}")
+    
+    # Уведомление об успешной оплате отправляет activate_payment
+    await PaymentService.activate_payment(
+        payment.invoice_payload,
+        message.bot,
+        source="invoice",
+        provider_payment_id=payment.provider_payment_charge_id
+    )
+
 def register_payment_handlers(dp):
     """Регистрирует обработчики платежей"""
     dp.include_router(router) 
@@ -3,6 +3,7 @@ from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import uuid
 import logging
+from bot.config import AUTO_RENEW_ENABLED
 from bot.services.vpn_service import VPNService
 from bot.utils.db import async_session
 from bot.models.client import Client
@@ -11,6 +12,10 @@ from sqlalchemy import select
 from bot.keyboards.instruction_kb import get_instruction_keyboard
 from bot.keyboards.user_menu_kb import get_user_menu_keyboard
 from bot.keyboards.subscription_kb import get_tariffs_info, get_tariffs_keyboard, get_payment_keyboard, TARIFFS
+from bot.services.plan_registry import PlanRegistry
+from bot.services.dead_chat_service import DeadChatService
+from bot.services.stats_service import StatsService
+from bot.services.funnel_service import FunnelService
 
 router = Router()
 vpn_service = VPNService()
@@ -18,6 +23,8 @@ logger = logging.getLogger(__name__)
 
 @router.message(CommandStart())
 async def cmd_start(message: types.Message):
+    FunnelService.emit(message.from_user.id, FunnelService.START)
+    
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="Получить конфиг", callback_data="get_config")]
@@ -56,6 +63,7 @@ async def process_get_config(callback: types.CallbackQuery):
                     username=callback.from_user.username or "none"
                 )
                 session.add(user)
+                await StatsService.record_user_created(session)
                 await session.commit()
                 await session.refresh(user)
             
@@ -102,6 +110,7 @@ async def process_get_config(callback: types.CallbackQuery):
             )
             session.add(client)
             await session.commit()
+            FunnelService.emit(callback.from_user.id, FunnelService.GET_CONFIG)
 
             # Отправляем сообщение об успехе с конфигом И устанавливаем клавиатуру меню
             await callback.message.answer(
@@ -131,14 +140,9 @@ async def process_get_config(callback: types.CallbackQuery):
 def get_tariff_name_by_id(tariff_id):
     if tariff_id == 0:
         return "ftw.none"
-    elif tariff_id == 1:
-        return "ftw.base"
-    elif tariff_id == 2:
-        return "ftw.middle"
-    elif tariff_id == 3:
-        return "ftw.unlimited"
-    else:
-        return "Не определен"
+    
+    plan = PlanRegistry.get_by_tariff_id(tariff_id)
+    return plan.title if plan else "Не определен"
 
 # Обновляем обработчики для кнопок меню, теперь используем текст сообщения вместо callback_data
 @router.message(lambda message: message.text == "👤 Мой профиль")
@@ -193,11 +197,43 @@ async def process_profile(message: types.Message):
             else:
                 profile_text += "\n\n⚠️ У вас нет активной VPN конфигурации"
             
-            await message.answer(profile_text, parse_mode="HTML")
+            # Кнопка автопродления доступна после оплаты с сохранением способа оплаты
+            markup = None
+            if AUTO_RENEW_ENABLED and user.payment_method_id:
+                profile_text += f"\n\n<b>🔁 Автопродление:</b> {'включено' if user.auto_renew else 'выключено'}"
+                markup = get_auto_renew_keyboard(user.auto_renew)
+            
+            await message.answer(profile_text, parse_mode="HTML", reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка при отображении профиля: {e}")
         await message.answer("❌ Произошла ошибка при загрузке профиля. Пожалуйста, попробуйте позже.")
 
+def get_auto_renew_keyboard(enabled: bool) -> InlineKeyboardMarkup:
+    """Клавиатура переключения автопродления"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="❌ Выключить автопродление" if enabled else "🔁 Включить автопродление",
+            callback_data="auto_renew_off" if enabled else "auto_renew_on"
+        )]
+    ])
+
+@router.callback_query(lambda c: c.data in ("auto_renew_on", "auto_renew_off"))
+async def toggle_auto_renew(callback: types.CallbackQuery):
+    from bot.services.renewal_service import RenewalService
+    
+    enabled = callback.data == "auto_renew_on"
+    if not await RenewalService.set_auto_renew(callback.from_user.id, enabled):
+        await callback.answer("❌ Профиль не найден", show_alert=True)
+        return
+    
+    # Обновляем строку статуса в сообщении профиля
+    profile_text = callback.message.html_text.replace(
+        f"<b>🔁 Автопродление:</b> {'выключено' if enabled else 'включено'}",
+        f"<b>🔁 Автопродление:</b> {'включено' if enabled else 'выключено'}"
+    )
+    await callback.message.edit_text(profile_text, parse_mode="HTML", reply_markup=get_auto_renew_keyboard(enabled))
+    await callback.answer("🔁 Автопродление включено" if enabled else "Автопродление выключено")
+
 @router.message(lambda message: message.text == "💼 Подписка и оплата")
 async def show_subscription_info(message: types.Message):
     # Отправляем информацию о тарифах и кнопки выбора
@@ -260,5 +296,16 @@ async def show_bonuses(message: types.Message):
         "🔜 Бонусная система скоро будет доступна"
     )
 
+@router.my_chat_member()
+async def on_bot_status_changed(update: types.ChatMemberUpdated):
+    # Telegram сообщает о блокировке бота пользователем и о разблокировке
+    if update.chat.type != "private":
+        return
+    
+    if update.new_chat_member.status == "kicked":
+        await DeadChatService.mark_dead(update.chat.id, "бот заблокирован пользователем")
+    elif update.new_chat_member.status == "member":
+        await DeadChatService.revive(update.chat.id)
+
 def register_handlers(dp: Dispatcher):
     dp.include_router(router)
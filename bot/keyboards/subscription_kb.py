@@ -1,55 +1,49 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-# Константы для тарифов
+# Начальные данные тарифов для таблицы plans. Во время работы каталог
+# читается из PlanRegistry, изменения вносятся в таблицу plans
 TARIFFS = {
     "base": {
         "name": "ftw.base",
         "price": 69,
         "traffic": "25ГБ/месяц",
         "ips": "3IP",
-        "callback_data": "tariff_base"
+        "callback_data": "tariff_base",
+        "payment_method": "redirect",  # redirect - страница YooKassa, invoice - счет Telegram
+        "tariff_id": 1,
+        "limit_ip": 3
     },
     "middle": {
         "name": "ftw.middle",
         "price": 149,
         "traffic": "Безлимит",
         "ips": "3IP",
-        "callback_data": "tariff_middle"
+        "callback_data": "tariff_middle",
+        "payment_method": "redirect",
+        "tariff_id": 2,
+        "limit_ip": 3
     },
     "unlimited": {
         "name": "ftw.unlimited",
         "price": 199,
         "traffic": "Безлимит",
         "ips": "6IP",
-        "callback_data": "tariff_unlimited"
+        "callback_data": "tariff_unlimited",
+        "payment_method": "redirect",
+        "tariff_id": 3,
+        "limit_ip": 6
     }
 }
 
 def get_tariffs_info() -> str:
-    """Формирует текстовое описание всех тарифов"""
-    info = "💼 Доступные тарифы\n\n"
-    info += "⚫ ftw.VPN предлагает три уровня цифровой невидимости:\n"
-    
-    for tariff in TARIFFS.values():
-        info += f"• {tariff['name']} — {tariff['price']}₽/месяц — {tariff['traffic']} и {tariff['ips']}\n"
-    
-    info += "\n🔍 Выберите степень вашей анонимности"
-    
-    return info
+    """Возвращает заранее сформированное описание всех тарифов"""
+    from bot.services.plan_registry import PlanRegistry
+    return PlanRegistry.get_tariffs_text()
 
 def get_tariffs_keyboard() -> InlineKeyboardMarkup:
-    """Создает клавиатуру с кнопками выбора тарифа"""
-    keyboard = []
-    
-    for tariff in TARIFFS.values():
-        keyboard.append([
-            InlineKeyboardButton(
-                text=f"{tariff['name']} -- {tariff['price']} РУБ",
-                callback_data=tariff["callback_data"]
-            )
-        ])
-    
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    """Возвращает заранее сформированную клавиатуру выбора тарифа"""
+    from bot.services.plan_registry import PlanRegistry
+    return PlanRegistry.get_tariffs_keyboard()
 
 def get_payment_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру с кнопками выбора способа оплаты"""
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, Text, DateTime, BigInteger, String
+from datetime import datetime
+from bot.utils.db import Base
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)  # Текст рассылки (для медиа - подпись)
+    source_chat_id = Column(BigInteger, nullable=True)  # Исходное сообщение администратора для copy_message
+    source_message_id = Column(BigInteger, nullable=True)
+    audience = Column(Text, nullable=True)  # Фильтр получателей (None - все пользователи)
+    status = Column(String(20), default="running", index=True)  # running, paused, canceled, completed
+    last_user_id = Column(Integer, default=0)  # Контрольная точка: последний обработанный users.id
+    total = Column(Integer, default=0)
+    delivered = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)  # Бот заблокирован получателем во время этой рассылки
+    skipped = Column(Integer, default=0)  # Не отправлено: чат уже в реестре недоступных
+    admin_chat_id = Column(BigInteger, nullable=False)  # Чат администратора для прогресса и отчета
+    progress_message_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Text, Boolean, DateTime, BigInteger, ForeignKey
+from sqlalchemy import Column, Integer, Text, Boolean, DateTime, BigInteger, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from bot.utils.db import Base  # Импортируем Base из base.py
 
@@ -7,15 +7,19 @@ class Client(Base):
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    email = Column(Text)
-    uuid = Column(Text)
+    email = Column(Text, index=True)
+    uuid = Column(Text, index=True)
     limit_ip = Column(Integer)
     total_traffic = Column(BigInteger)
-    expiry_time = Column(DateTime)
+    expiry_time = Column(DateTime, index=True)  # Индекс для выборки истекающих подписок
     is_active = Column(Boolean, default=True)
-    tg_notified = Column(Boolean, default=False)
+    tg_notified = Column(Boolean, default=False)  # Устарело: не используется, заменено reminder_stages
+    reminder_stages = Column(Integer, default=0)  # Битовая маска отправленных напоминаний для текущего expiry_time
     config_data = Column(Text, nullable=True)  # URL конфигурации VPN
     tariff_id = Column(Integer, nullable=True)  # Номер типа тарифа (1 - base, 2 - middle, 3 - unlimited)
     
     # Добавляем отношение с пользователем
     user = relationship("User", back_populates="clients")
+    
+    # Подписки пользователя для сегментов рассылки
+    __table_args__ = (Index("ix_clients_user_expiry", "user_id", "expiry_time"),)
@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Text, DateTime, BigInteger
+from datetime import datetime
+from bot.utils.db import Base
+
+class DeadChat(Base):
+    __tablename__ = "dead_chats"
+    
+    tg_id = Column(BigInteger, primary_key=True)  # Чат, в который бот не может писать
+    reason = Column(Text, nullable=True)  # Ответ Telegram (бот заблокирован, чат не найден)
+    marked_at = Column(DateTime, default=datetime.now)
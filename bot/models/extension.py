@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, DateTime, BigInteger, String
+from datetime import datetime
+from bot.utils.db import Base
+
+class ExtensionJob(Base):
+    __tablename__ = "extension_jobs"
+
+    id = Column(Integer, primary_key=True)
+    days = Column(Integer, nullable=False)  # На сколько дней продлены подписки
+    tariff_id = Column(Integer, nullable=True)  # Фильтр по типу тарифа (None - все платные тарифы)
+    cutoff = Column(DateTime, nullable=False)  # Продлены подписки, действовавшие на этот момент
+    max_client_id = Column(Integer, nullable=False)  # Последний clients.id на момент продления
+    status = Column(String(20), default="pushing", index=True)  # pushing, completed
+    last_client_id = Column(Integer, default=0)  # Контрольная точка: последний обновленный на сервере clients.id
+    total = Column(Integer, default=0)
+    pushed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    admin_chat_id = Column(BigInteger, nullable=False)  # Чат администратора для прогресса и отчета
+    progress_message_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
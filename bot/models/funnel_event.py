@@ -0,0 +1,11 @@
+from sqlalchemy import Column, Integer, DateTime, BigInteger, String
+from bot.utils.db import Base
+
+class FunnelEvent(Base):
+    __tablename__ = "funnel_events"
+
+    # Таблица только пополняется пакетами из буфера FunnelService
+    id = Column(Integer, primary_key=True)
+    tg_id = Column(BigInteger, nullable=False)
+    step = Column(String(20), nullable=False)  # Шаг воронки (FunnelService.STEPS)
+    created_at = Column(DateTime, nullable=False, index=True)  # Время события (не время записи)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Text, Boolean, DateTime, ForeignKey, Index
 from datetime import datetime
 from bot.utils.db import Base
 
@@ -12,4 +12,12 @@ class Payment(Base):
     amount = Column(Integer)
     payment_id = Column(Text, nullable=False, unique=True)  # ID платежа в системе YooKassa
     created_at = Column(DateTime, default=datetime.utcnow)
-    paid_at = Column(DateTime, nullable=True)  # Может быть None, если платеж не завершен
+    paid_at = Column(DateTime, nullable=True)  # Время оплаты (UTC); None, если платеж не завершен
+    provider_payment_id = Column(Text, nullable=True, index=True)  # ID платежа у провайдера для счетов Telegram
+    confirmation_url = Column(Text, nullable=True)  # Ссылка на оплату для повторной выдачи
+    is_renewal = Column(Boolean, default=False)  # Списание автопродления: срок продлевается от текущего окончания
+    
+    __table_args__ = (
+        # Поиск незавершенного платежа пользователя на тот же тариф
+        Index("ix_payments_user_plan_status", "user_id", "plan_id", "status"),
+    )
@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey
+from datetime import datetime
+from bot.utils.db import Base
+
+class PaymentActivation(Base):
+    __tablename__ = "payment_activations"
+    
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(Text, ForeignKey("payments.payment_id"), nullable=False, unique=True)  # Один платеж - одна активация
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    plan_id = Column(Integer, ForeignKey("plans.id"), nullable=False)
+    source = Column(Text)  # Кто активировал: poller, checker, callback, webhook
+    created_at = Column(DateTime, default=datetime.utcnow)  # Момент захвата платежа
+    completed_at = Column(DateTime, nullable=True)  # Заполняется вместе с обновлением клиента (UTC); NULL - активация будет повторена
@@ -5,7 +5,11 @@ class Plan(Base):
     __tablename__ = "plans"
     
     id = Column(Integer, primary_key=True)
+    key = Column(Text, unique=True, index=True, nullable=True)  # Ключ тарифа ("base", "middle", "unlimited")
     title = Column(Text)
     traffic_limit = Column(BigInteger)
     duration_days = Column(Integer)
     price = Column(Integer)
+    tariff_id = Column(Integer, nullable=True)  # Номер типа тарифа клиента (1 - base, 2 - middle, 3 - unlimited)
+    limit_ip = Column(Integer, default=3)  # Максимум одновременных подключений
+    payment_method = Column(Text, default="redirect")  # redirect - страница YooKassa, invoice - счет Telegram
@@ -1,11 +1,11 @@
-from sqlalchemy import Column, Integer, Text, DECIMAL, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, Text, DECIMAL, DateTime, Boolean, ForeignKey, Index
 from bot.utils.db import Base
 
 class Promo(Base):
     __tablename__ = "promik"  # Название таблицы согласно схеме
     
     id = Column(Integer, primary_key=True)
-    code = Column(Text)
+    code = Column(Text, unique=True, index=True)  # Уникальный индекс: поиск по коду и защита от повторов
     discount = Column(DECIMAL)  # Например, 20.0 для 20%
     expiration_date = Column(DateTime)
     usage_limit = Column(Integer)
@@ -13,3 +13,6 @@ class Promo(Base):
     is_active = Column(Boolean, default=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Если привязан к конкретному пользователю
     used_at = Column(DateTime, nullable=True)
+    
+    # Постраничный вывод в админ-панели: сначала активные, затем новые
+    __table_args__ = (Index("ix_promik_active_id", "is_active", "id"),)
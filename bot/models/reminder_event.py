@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index
+from datetime import datetime
+from bot.utils.db import Base
+
+class ReminderEvent(Base):
+    __tablename__ = "reminder_events"
+    
+    id = Column(Integer, primary_key=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    stage = Column(Integer, nullable=False)  # Этап напоминания: часов до окончания подписки (0 - истекла)
+    expiry_time = Column(DateTime, nullable=False)  # Срок подписки, о котором напомнили
+    sent_at = Column(DateTime, default=datetime.now)
+    
+    # Для расчета доли продлений по этапам за период
+    __table_args__ = (Index("ix_reminder_events_stage_sent", "stage", "sent_at"),)
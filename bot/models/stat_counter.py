@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Integer, String, BigInteger
+from bot.utils.db import Base
+
+class StatCounter(Base):
+    __tablename__ = "stat_counters"
+    
+    metric = Column(String(32), primary_key=True)  # users, payments, revenue, paying_users, active_clients
+    day = Column(String(10), primary_key=True, default="")  # Дата YYYY-MM-DD, "" - накопительный итог
+    tariff_id = Column(Integer, primary_key=True, default=0)  # Номер типа тарифа, 0 - без разбивки
+    value = Column(BigInteger, default=0)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, BigInteger
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, BigInteger, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from bot.utils.db import Base
@@ -9,8 +9,8 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     tg_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(255), nullable=True)
-    email = Column(String(255), nullable=True)  # Поле для хранения email
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    email = Column(String(255), nullable=True, index=True)  # Поле для хранения email
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     
     # Поля для бана
     is_banned = Column(Boolean, default=False)
@@ -18,5 +18,12 @@ class User(Base):
     banned_at = Column(DateTime(timezone=True), nullable=True)
     banned_until = Column(DateTime(timezone=True), nullable=True)  # Когда истекает бан
     
+    # Поля для автопродления
+    auto_renew = Column(Boolean, default=False)  # Пользователь включил автопродление
+    payment_method_id = Column(String(255), nullable=True)  # Сохраненный способ оплаты YooKassa
+    
     # Отношение с клиентами
     clients = relationship("Client", back_populates="user", cascade="all, delete-orphan")
+    
+    # Поиск по username без учета регистра, в том числе по началу
+    __table_args__ = (Index("ix_users_username_lower", func.lower(username)),)
@@ -0,0 +1,158 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import and_, exists, func
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class AudienceService:
+    """
+    Сегменты получателей рассылки
+
+    Сегмент - словарь фильтров, который хранится в broadcasts.audience в виде JSON
+    и компилируется в одно условие на users с коррелированными EXISTS по
+    индексам clients.user_id, clients.expiry_time и payments.user_id.
+    """
+
+    STATUS_ACTIVE = "active"
+    STATUS_EXPIRED = "expired"
+
+    # Справка по формату фильтров для администратора
+    HELP_TEXT = (
+        "Фильтры указываются через пробел, все условия объединяются по И:\n"
+        "• <code>tariff=2</code> - тип тарифа клиента (1 - base, 2 - middle, 3 - unlimited)\n"
+        "• <code>status=active</code> / <code>status=expired</code> - подписка действует / истекла\n"
+        "• <code>expiring=3</code> - подписка истекает в ближайшие N дней\n"
+        "• <code>never_paid</code> - ни одного успешного платежа\n"
+        "• <code>joined_after=01.05.2025</code> - зарегистрировались после даты\n\n"
+        "Пример: <code>status=expired never_paid</code>"
+    )
+
+    @staticmethod
+    def parse(text: str) -> dict:
+        """
+        Разбирает строку фильтров администратора
+
+        Returns:
+            dict: Сегмент (пустой - все пользователи)
+
+        Raises:
+            ValueError: Неизвестный фильтр или неверное значение
+        """
+        segment = {}
+
+        for token in text.split():
+            name, _, value = token.partition("=")
+            name = name.lower()
+
+            if name == "tariff":
+                segment["tariff_id"] = int(value)
+            elif name == "status":
+                if value not in (AudienceService.STATUS_ACTIVE, AudienceService.STATUS_EXPIRED):
+                    raise ValueError(f"Неизвестный статус: {value}")
+                segment["status"] = value
+            elif name == "expiring":
+                days = int(value)
+                if days <= 0:
+                    raise ValueError("Количество дней должно быть больше нуля")
+                segment["expiring_days"] = days
+            elif name == "never_paid":
+                segment["never_paid"] = True
+            elif name == "joined_after":
+                segment["joined_after"] = datetime.strptime(value, "%d.%m.%Y").strftime("%Y-%m-%d")
+            else:
+                raise ValueError(f"Неизвестный фильтр: {token}")
+
+        return segment
+
+    @staticmethod
+    def dumps(segment: dict):
+        """Сериализует сегмент для хранения в broadcasts.audience (None - все пользователи)"""
+        return json.dumps(segment, sort_keys=True) if segment else None
+
+    @staticmethod
+    def loads(audience) -> dict:
+        """Восстанавливает сегмент из broadcasts.audience"""
+        return json.loads(audience) if audience else {}
+
+    @staticmethod
+    def describe(segment: dict) -> str:
+        """Описание сегмента для администратора"""
+        if not segment:
+            return "все пользователи"
+
+        parts = []
+        if "tariff_id" in segment:
+            parts.append(f"тариф {segment['tariff_id']}")
+        if segment.get("status") == AudienceService.STATUS_ACTIVE:
+            parts.append("подписка действует")
+        elif segment.get("status") == AudienceService.STATUS_EXPIRED:
+            parts.append("подписка истекла")
+        if "expiring_days" in segment:
+            parts.append(f"истекает в ближайшие {segment['expiring_days']} дн.")
+        if segment.get("never_paid"):
+            parts.append("без оплат")
+        if "joined_after" in segment:
+            parts.append(f"с {datetime.strptime(segment['joined_after'], '%Y-%m-%d'):%d.%m.%Y}")
+
+        return ", ".join(parts)
+
+    @staticmethod
+    def compile(segment: dict, now: datetime = None):
+        """
+        Компилирует сегмент в условие на таблицу users
+
+        Args:
+            segment: Сегмент
+            now: Текущее время (для подписок)
+
+        Returns:
+            Условие SQLAlchemy или None для всех пользователей
+        """
+        now = now or datetime.now()
+        conditions = []
+
+        # Все условия на клиента проверяются одним EXISTS, чтобы относиться к одной подписке
+        client_conditions = []
+        if "tariff_id" in segment:
+            client_conditions.append(Client.tariff_id == segment["tariff_id"])
+        if segment.get("status") == AudienceService.STATUS_ACTIVE:
+            client_conditions.append((Client.is_active == True) & (Client.expiry_time > now))
+        if "expiring_days" in segment:
+            client_conditions.append(
+                (Client.expiry_time > now) &
+                (Client.expiry_time <= now + timedelta(days=segment["expiring_days"]))
+            )
+        if client_conditions:
+            conditions.append(exists().where(and_(Client.user_id == User.id, *client_conditions)))
+
+        if segment.get("status") == AudienceService.STATUS_EXPIRED:
+            # Была подписка, но ни одна не действует
+            conditions.append(exists().where(Client.user_id == User.id))
+            conditions.append(~exists().where((Client.user_id == User.id) & (Client.expiry_time > now)))
+
+        if segment.get("never_paid"):
+            conditions.append(~exists().where((Payment.user_id == User.id) & (Payment.status == "succeeded")))
+
+        if "joined_after" in segment:
+            conditions.append(User.created_at >= datetime.strptime(segment["joined_after"], "%Y-%m-%d"))
+
+        return and_(*conditions) if conditions else None
+
+    @staticmethod
+    async def count(segment: dict) -> int:
+        """Возвращает количество пользователей в сегменте одним COUNT-запросом"""
+        query = select(func.count(User.id))
+        condition = AudienceService.compile(segment)
+        if condition is not None:
+            query = query.where(condition)
+
+        async with async_session() as session:
+            result = await session.execute(query)
+            return result.scalar() or 0
@@ -1,34 +1,38 @@
-import time
 import datetime
 from sqlalchemy.future import select
 from sqlalchemy import update
 from bot.utils.db import async_session
+from bot.utils.cache import TTLCache
 from bot.models.user import User
+from bot.services.message_gateway import MessageGateway
+from bot.services.stats_service import StatsService
 
 class BanService:
+    # Размер кэша статусов бана и время жизни записи (секунды)
+    CACHE_SIZE = 10000
+    CACHE_TTL = 300
+    
     def __init__(self, bot=None):
-        self.cache = {}  # Временный кэш
+        # {tg_id: (is_banned, reason, ban_until)}; кэшируются и отрицательные результаты,
+        # в том числе для пользователей без записи в БД
+        self.cache = TTLCache(maxsize=BanService.CACHE_SIZE, ttl=BanService.CACHE_TTL)
         self.bot = bot  # Экземпляр бота для отправки уведомлений
     
     async def is_banned(self, user_id: int) -> tuple[bool, str, datetime.datetime]:
         """
-        Проверяет, забанен ли пользователь, учитывая временный банОтлично! Добавляю функционал создания промокодов для администратора.
+        Проверяет, забанен ли пользователь, учитывая временный бан
         Возвращает: (is_banned, reason, expiry_time)
         """
         # Проверяем кэш
-        if user_id in self.cache:
-            if time.time() - self.cache[user_id]["timestamp"] < 300:  # Кэш на 5 минут
-                # Если был временный бан и срок истек
-                if self.cache[user_id]["banned"] and self.cache[user_id].get("ban_until"):
-                    if datetime.datetime.now() > self.cache[user_id]["ban_until"]:
-                        # Разбаниваем пользователя, т.к. срок истек
-                        await self.unban_user(user_id)
-                        return False, "", None
-                return (
-                    self.cache[user_id]["banned"], 
-                    self.cache[user_id].get("reason", ""), 
-                    self.cache[user_id].get("ban_until")
-                )
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            is_banned, ban_reason, ban_until = cached
+            # Если был временный бан и срок истек
+            if is_banned and ban_until and datetime.datetime.now() > ban_until:
+                # Разбаниваем пользователя, т.к. срок истек
+                await self.unban_user(user_id)
+                return False, "", None
+            return cached
         
         # Проверяем БД
         async with async_session() as session:
@@ -37,28 +41,28 @@ class BanService:
                 .where(User.tg_id == user_id)
             )
             data = result.one_or_none()
-            
-            # Если пользователя нет, считаем, что он не забанен
-            if data is None:
-                return False, "", None
-            
-            is_banned, ban_reason, ban_until = data
-            
-            # Если бан временный и срок истек
-            if is_banned and ban_until and ban_until < datetime.datetime.now():
-                # Разбаниваем пользователя
-                await self.unban_user(user_id)
-                return False, "", None
         
-        # Обновляем кэш
-        self.cache[user_id] = {
-            "banned": is_banned,
-            "reason": ban_reason,
-            "ban_until": ban_until,
-            "timestamp": time.time()
-        }
+        # Если пользователя нет, считаем, что он не забанен
+        if data is None:
+            self.cache.set(user_id, (False, "", None))
+            return False, "", None
+        
+        is_banned, ban_reason, ban_until = data
         
-        return is_banned, ban_reason, ban_until
+        # Если бан временный и срок истек
+        if is_banned and ban_until and ban_until < datetime.datetime.now():
+            # Разбаниваем пользователя
+            await self.unban_user(user_id)
+            return False, "", None
+        
+        # Обновляем кэш
+        cached = (bool(is_banned), ban_reason or "", ban_until)
+        self.cache.set(user_id, cached)
+        return cached
+    
+    def get_stats(self) -> dict:
+        """Возвращает счетчики кэша статусов бана"""
+        return self.cache.stats()
     
     async def ban_user(self, user_id: int, reason: str = "спам", hours: float = 24, notify: bool = True) -> bool:
         """Банит пользователя на указанное количество часов"""
@@ -83,6 +87,7 @@ class BanService:
                     banned_until=ban_until
                 )
                 session.add(user)
+                await StatsService.record_user_created(session)
             else:
                 # Обновляем существующего пользователя
                 await session.execute(
@@ -99,19 +104,15 @@ class BanService:
             await session.commit()
             
             # Обновляем кэш
-            self.cache[user_id] = {
-                "banned": True,
-                "reason": reason,
-                "ban_until": ban_until,
-                "timestamp": time.time()
-            }
+            self.cache.set(user_id, (True, reason, ban_until))
             
             # Уведомляем пользователя, если необходимо
             if notify and self.bot:
                 ban_duration = int(hours * 60) if hours > 0 else 0
                 ban_period = f"на {ban_duration} минут" if ban_duration > 0 else "бессрочно"
                 try:
-                    await self.bot.send_message(
+                    await MessageGateway.send_message(
+                        self.bot,
                         user_id,
                         f"⚠️ Вы были заблокированы в боте {ban_period}.\n"
                         f"Причина: {reason}\n"
@@ -133,6 +134,7 @@ class BanService:
             user = result.scalar_one_or_none()
             
             if not user:
+                self.cache.pop(user_id)
                 return False
             
             # Снимаем бан
@@ -145,12 +147,6 @@ class BanService:
             await session.commit()
             
             # Обновляем кэш
-            if user_id in self.cache:
-                self.cache[user_id] = {
-                    "banned": False,
-                    "reason": "",
-                    "ban_until": None,
-                    "timestamp": time.time()
-                }
+            self.cache.set(user_id, (False, "", None))
             
             return True 
\ No newline at end of file
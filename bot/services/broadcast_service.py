@@ -0,0 +1,393 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import update
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.broadcast import Broadcast
+from bot.services.message_gateway import MessageGateway
+from bot.services.audience_service import AudienceService
+from bot.services.dead_chat_service import DeadChatService, ChatUnavailableError
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class BroadcastService:
+    """
+    Массовая рассылка сообщений пользователям
+
+    Рассылка хранится в таблице broadcasts вместе с контрольной точкой -
+    последним обработанным users.id. После перезапуска бота незавершенные
+    рассылки продолжаются с контрольной точки без повторной отправки.
+    """
+
+    # Количество получателей, читаемых из БД за один запрос
+    CHUNK_SIZE = 500
+
+    # Минимальный интервал между обновлениями сообщения о прогрессе (секунды)
+    PROGRESS_INTERVAL = 5
+
+    # Статусы рассылки
+    STATUS_RUNNING = "running"
+    STATUS_PAUSED = "paused"
+    STATUS_CANCELED = "canceled"
+    STATUS_COMPLETED = "completed"
+
+    _tasks = {}  # {broadcast_id: asyncio.Task}
+    _requested = {}  # {broadcast_id: статус, запрошенный администратором}
+
+    @staticmethod
+    async def count_recipients(segment: dict = None) -> int:
+        """Возвращает количество получателей рассылки в сегменте"""
+        return await AudienceService.count(segment or {})
+
+    @staticmethod
+    async def iter_recipient_chunks(after_id: int = 0, segment: dict = None):
+        """
+        Отдает получателей сегмента порциями по CHUNK_SIZE в порядке users.id
+
+        Каждая порция читается отдельным коротким запросом по первичному ключу
+        (keyset), поэтому чтение не держит транзакцию открытой на время отправки.
+
+        Yields:
+            list: Пары (users.id, tg_id)
+        """
+        while True:
+            query = select(User.id, User.tg_id).where(User.id > after_id)
+            condition = AudienceService.compile(segment or {})
+            if condition is not None:
+                query = query.where(condition)
+
+            async with async_session() as session:
+                result = await session.execute(
+                    query.order_by(User.id).limit(BroadcastService.CHUNK_SIZE)
+                )
+                rows = result.all()
+
+            if not rows:
+                return
+
+            yield rows
+            after_id = rows[-1].id
+
+    @staticmethod
+    async def create(text: str, admin_chat_id: int, progress_message_id: int = None, source_message_id: int = None,
+                     segment: dict = None) -> int:
+        """
+        Сохраняет новую рассылку
+
+        Args:
+            text: Текст рассылки (для медиа - подпись, только для отображения)
+            admin_chat_id: Чат администратора для прогресса и отчета
+            progress_message_id: Сообщение для отображения прогресса
+            source_message_id: Сообщение администратора, которое рассылается через copy_message
+            segment: Сегмент получателей (None - все пользователи)
+
+        Returns:
+            int: ID рассылки
+        """
+        total = await BroadcastService.count_recipients(segment)
+
+        async with async_session() as session:
+            broadcast = Broadcast(
+                text=text,
+                audience=AudienceService.dumps(segment),
+                status=BroadcastService.STATUS_RUNNING,
+                total=total,
+                source_chat_id=admin_chat_id if source_message_id else None,
+                source_message_id=source_message_id,
+                admin_chat_id=admin_chat_id,
+                progress_message_id=progress_message_id
+            )
+            session.add(broadcast)
+            await session.commit()
+            return broadcast.id
+
+    @staticmethod
+    def start(bot, broadcast_id: int):
+        """Запускает рассылку фоновой задачей, если она еще не выполняется"""
+        # Пауза, запрошенная до остановки задачи, отменяется
+        BroadcastService._requested.pop(broadcast_id, None)
+
+        task = BroadcastService._tasks.get(broadcast_id)
+        if task and not task.done():
+            return
+
+        BroadcastService._tasks[broadcast_id] = asyncio.create_task(BroadcastService._run(bot, broadcast_id))
+
+    @staticmethod
+    async def resume_unfinished(bot):
+        """Продолжает рассылки, прерванные перезапуском бота"""
+        async with async_session() as session:
+            result = await session.execute(
+                select(Broadcast.id).where(Broadcast.status == BroadcastService.STATUS_RUNNING)
+            )
+            broadcast_ids = result.scalars().all()
+
+        for broadcast_id in broadcast_ids:
+            logger.info(f"Продолжаем рассылку {broadcast_id} с контрольной точки")
+            BroadcastService.start(bot, broadcast_id)
+
+    @staticmethod
+    async def pause(broadcast_id: int) -> bool:
+        """Приостанавливает рассылку после текущей порции"""
+        return await BroadcastService._request_status(
+            broadcast_id, BroadcastService.STATUS_PAUSED, (BroadcastService.STATUS_RUNNING,)
+        )
+
+    @staticmethod
+    async def resume(bot, broadcast_id: int) -> bool:
+        """Продолжает приостановленную рассылку с контрольной точки"""
+        async with async_session() as session:
+            result = await session.execute(
+                update(Broadcast)
+                .where(
+                    (Broadcast.id == broadcast_id) &
+                    (Broadcast.status == BroadcastService.STATUS_PAUSED)
+                )
+                .values(status=BroadcastService.STATUS_RUNNING)
+            )
+            await session.commit()
+
+        if result.rowcount != 1:
+            return False
+
+        BroadcastService.start(bot, broadcast_id)
+        return True
+
+    @staticmethod
+    async def cancel(broadcast_id: int) -> bool:
+        """Отменяет выполняющуюся или приостановленную рассылку"""
+        return await BroadcastService._request_status(
+            broadcast_id, BroadcastService.STATUS_CANCELED,
+            (BroadcastService.STATUS_RUNNING, BroadcastService.STATUS_PAUSED)
+        )
+
+    @staticmethod
+    async def _request_status(broadcast_id: int, status: str, allowed_from: tuple) -> bool:
+        """
+        Меняет статус рассылки; выполняющаяся задача остановится после текущей порции
+
+        Returns:
+            bool: True если статус изменен
+        """
+        async with async_session() as session:
+            result = await session.execute(
+                update(Broadcast)
+                .where((Broadcast.id == broadcast_id) & (Broadcast.status.in_(allowed_from)))
+                .values(status=status)
+            )
+            await session.commit()
+
+        if result.rowcount != 1:
+            return False
+
+        task = BroadcastService._tasks.get(broadcast_id)
+        if task and not task.done():
+            BroadcastService._requested[broadcast_id] = status
+        return True
+
+    @staticmethod
+    async def _run(bot, broadcast_id: int):
+        """Отправляет рассылку с контрольной точки, сохраняя прогресс после каждой порции"""
+        async with async_session() as session:
+            broadcast = await session.get(Broadcast, broadcast_id)
+
+        if not broadcast or broadcast.status != BroadcastService.STATUS_RUNNING:
+            return
+
+        stats = {
+            "total": broadcast.total,
+            "delivered": broadcast.delivered,
+            "failed": broadcast.failed,
+            "blocked": broadcast.blocked,
+            "skipped": broadcast.skipped
+        }
+        last_progress = time.monotonic()
+        started = last_progress
+
+        try:
+            segment = AudienceService.loads(broadcast.audience)
+            async for rows in BroadcastService.iter_recipient_chunks(broadcast.last_user_id, segment):
+                futures = []
+                for row in rows:
+                    # Чаты из реестра недоступных пропускаем без запроса к Telegram
+                    if DeadChatService.is_dead(row.tg_id):
+                        stats["skipped"] += 1
+                        continue
+                    futures.append(BroadcastService._send(bot, broadcast, row.tg_id))
+
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                BroadcastService._count_results(results, stats)
+
+                # Порция отправлена целиком - переносим контрольную точку
+                await BroadcastService._save_checkpoint(broadcast_id, rows[-1].id, stats)
+
+                if BroadcastService._requested.get(broadcast_id):
+                    break
+
+                if time.monotonic() - last_progress >= BroadcastService.PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await BroadcastService._show_progress(bot, broadcast, stats, BroadcastService.STATUS_RUNNING)
+        except Exception as e:
+            # Статус остается running - рассылка продолжится после перезапуска
+            logger.error(f"Ошибка при рассылке {broadcast_id}: {e}")
+            await BroadcastService._notify_admin(bot, broadcast, f"❌ Ошибка при рассылке: {e}")
+            return
+        finally:
+            BroadcastService._tasks.pop(broadcast_id, None)
+
+        requested = BroadcastService._requested.pop(broadcast_id, None)
+        if requested:
+            logger.info(f"Рассылка {broadcast_id} остановлена администратором: {requested}")
+            await BroadcastService._show_progress(bot, broadcast, stats, requested)
+            return
+
+        async with async_session() as session:
+            await session.execute(
+                update(Broadcast)
+                .where((Broadcast.id == broadcast_id) & (Broadcast.status == BroadcastService.STATUS_RUNNING))
+                .values(status=BroadcastService.STATUS_COMPLETED, finished_at=datetime.now())
+            )
+            await session.commit()
+
+        logger.info(f"Рассылка {broadcast_id} завершена за {time.monotonic() - started:.1f} с: {stats}")
+        await BroadcastService._notify_admin(bot, broadcast, BroadcastService.format_report(stats))
+
+    @staticmethod
+    def _send(bot, broadcast, tg_id: int):
+        """
+        Ставит отправку рассылки одному получателю в шлюз сообщений
+
+        Медиа рассылается через copy_message: файл загружен в Telegram один раз
+        вместе с сообщением администратора, получателям уходит только ссылка на него.
+        """
+        if broadcast.source_message_id:
+            return MessageGateway.submit(
+                lambda: bot.copy_message(
+                    chat_id=tg_id,
+                    from_chat_id=broadcast.source_chat_id,
+                    message_id=broadcast.source_message_id
+                ),
+                tg_id,
+                MessageGateway.PRIORITY_BROADCAST
+            )
+
+        return MessageGateway.send_message(
+            bot, tg_id, broadcast.text,
+            priority=MessageGateway.PRIORITY_BROADCAST, parse_mode="HTML"
+        )
+
+    @staticmethod
+    async def _save_checkpoint(broadcast_id: int, last_user_id: int, stats: dict):
+        """Сохраняет контрольную точку и счетчики рассылки"""
+        async with async_session() as session:
+            await session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id)
+                .values(
+                    last_user_id=last_user_id,
+                    delivered=stats["delivered"],
+                    failed=stats["failed"],
+                    blocked=stats["blocked"],
+                    skipped=stats["skipped"]
+                )
+            )
+            await session.commit()
+
+    @staticmethod
+    def _count_results(results, stats: dict):
+        """Учитывает результаты отправки порции в счетчиках"""
+        for result in results:
+            if isinstance(result, ChatUnavailableError):
+                # Чат попал в реестр, пока сообщение ждало в очереди, - запрос не отправлялся
+                stats["skipped"] += 1
+            elif isinstance(result, Exception) and DeadChatService.is_unreachable_error(result):
+                stats["blocked"] += 1
+            elif isinstance(result, Exception):
+                stats["failed"] += 1
+            else:
+                stats["delivered"] += 1
+
+    @staticmethod
+    def format_progress(stats: dict, status: str = STATUS_RUNNING) -> str:
+        """Текст сообщения о ходе рассылки"""
+        processed = stats["delivered"] + stats["failed"] + stats["blocked"] + stats["skipped"]
+        percent = min(processed * 100 // stats["total"], 100) if stats["total"] else 100
+        title = {
+            BroadcastService.STATUS_RUNNING: "🚀 Рассылка",
+            BroadcastService.STATUS_PAUSED: "⏸ Рассылка приостановлена",
+            BroadcastService.STATUS_CANCELED: "🚫 Рассылка отменена"
+        }.get(status, "Рассылка")
+        return (
+            f"{title}: {processed} из {stats['total']} ({percent}%)\n\n"
+            f"- Доставлено: {stats['delivered']}\n"
+            f"- Бот заблокирован: {stats['blocked']}\n"
+            f"- Пропущено (недоступны ранее): {stats['skipped']}\n"
+            f"- Ошибок: {stats['failed']}"
+        )
+
+    @staticmethod
+    def format_report(stats: dict) -> str:
+        """Итоговый отчет о рассылке"""
+        return (
+            f"✅ Рассылка завершена!\n\n"
+            f"📊 Статистика:\n"
+            f"- Всего пользователей: {stats['total']}\n"
+            f"- Успешно отправлено: {stats['delivered']}\n"
+            f"- Бот заблокирован во время рассылки: {stats['blocked']}\n"
+            f"- Пропущено (недоступны ранее): {stats['skipped']}\n"
+            f"- Ошибок: {stats['failed']}"
+        )
+
+    @staticmethod
+    def get_control_keyboard(broadcast_id: int, status: str):
+        """Кнопки управления рассылкой для сообщения о прогрессе"""
+        if status == BroadcastService.STATUS_RUNNING:
+            first = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bc_pause:{broadcast_id}")
+        elif status == BroadcastService.STATUS_PAUSED:
+            first = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc_resume:{broadcast_id}")
+        else:
+            return None
+
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            first,
+            InlineKeyboardButton(text="❌ Отменить", callback_data=f"bc_cancel:{broadcast_id}")
+        ]])
+
+    @staticmethod
+    async def _show_progress(bot, broadcast, stats: dict, status: str):
+        """Обновляет сообщение о прогрессе через шлюз сообщений"""
+        if not broadcast.progress_message_id:
+            return
+
+        try:
+            await MessageGateway.submit(
+                lambda: bot.edit_message_text(
+                    BroadcastService.format_progress(stats, status),
+                    chat_id=broadcast.admin_chat_id,
+                    message_id=broadcast.progress_message_id,
+                    reply_markup=BroadcastService.get_control_keyboard(broadcast.id, status)
+                ),
+                broadcast.admin_chat_id,
+                MessageGateway.PRIORITY_NOTIFICATION
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки {broadcast.id}: {e}")
+
+    @staticmethod
+    async def _notify_admin(bot, broadcast, text: str):
+        """Отправляет администратору итог рассылки"""
+        try:
+            await MessageGateway.send_message(
+                bot, broadcast.admin_chat_id, text,
+                priority=MessageGateway.PRIORITY_NOTIFICATION,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="Вернуться в админ-панель", callback_data="admin_back")]
+                ])
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки отчета о рассылке {broadcast.id}: {e}")
@@ -0,0 +1,143 @@
+import logging
+import time
+from dataclasses import dataclass, asdict, replace
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.services.promo_service import PromoService
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class CheckoutQuote:
+    """Неизменяемый расчет покупки: снимок плана, скидка и итоговая цена"""
+
+    tg_id: int  # Telegram ID покупателя
+    user_id: int  # ID пользователя в БД
+    tariff_key: str  # Ключ тарифа ("base", "middle", "unlimited")
+    plan_id: int
+    plan_title: str
+    duration_days: int
+    base_price: int  # Цена плана без скидки
+    promo_code: str | None
+    discount_percent: float
+    final_price: int  # Цена к оплате
+    catalog_version: int  # Версия каталога тарифов на момент расчета
+    expires_at: float  # Время истечения расчета (unix time)
+
+    def to_dict(self) -> dict:
+        """Сериализует расчет для хранения в данных FSM"""
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Восстанавливает расчет из данных FSM"""
+        return cls(**data) if data else None
+
+class CheckoutService:
+    """Сервис расчета стоимости покупки для сценария оплаты"""
+
+    # Время жизни расчета в секундах
+    QUOTE_TTL = 900
+
+    # Увеличивается при любом изменении тарифов - старые расчеты становятся недействительными
+    catalog_version = 0
+
+    @staticmethod
+    def invalidate_quotes():
+        """Делает недействительными все ранее выданные расчеты"""
+        CheckoutService.catalog_version += 1
+        logger.info(f"Расчеты покупок сброшены, версия каталога: {CheckoutService.catalog_version}")
+
+    @staticmethod
+    async def build_quote(tg_id: int, tariff_key: str, promo_code: str = None, user_id: int = None):
+        """
+        Рассчитывает покупку один раз для всего сценария оплаты
+
+        Args:
+            tg_id: Telegram ID пользователя
+            tariff_key: Ключ тарифа
+            promo_code: Промокод (опционально)
+            user_id: ID пользователя в БД, если уже известен
+
+        Returns:
+            CheckoutQuote: Расчет покупки
+
+        Raises:
+            ValueError: Если пользователь или тариф не найдены
+        """
+        from bot.services.payment_service import PaymentService
+
+        if user_id is None:
+            async with async_session() as session:
+                user_query = await session.execute(
+                    select(User.id).where(User.tg_id == tg_id)
+                )
+                user_id = user_query.scalar_one_or_none()
+
+        if user_id is None:
+            raise ValueError("Пользователь не найден, запустите бота командой /start")
+
+        plan = await PaymentService.get_plan_by_tariff(tariff_key)
+
+        discount_percent = 0
+        if promo_code:
+            is_valid, discount_percent, promo = await PromoService.check_promo(promo_code, user_id)
+            if not is_valid:
+                logger.warning(f"Недействительный промокод {promo_code} для пользователя {tg_id}")
+                discount_percent = 0
+
+        quote = CheckoutQuote(
+            tg_id=tg_id,
+            user_id=user_id,
+            tariff_key=tariff_key,
+            plan_id=plan.id,
+            plan_title=plan.title,
+            duration_days=plan.duration_days,
+            base_price=plan.price,
+            promo_code=None,
+            discount_percent=0,
+            final_price=plan.price,
+            catalog_version=CheckoutService.catalog_version,
+            expires_at=time.time() + CheckoutService.QUOTE_TTL
+        )
+
+        if discount_percent:
+            quote = CheckoutService.apply_promo(quote, promo_code, discount_percent)
+
+        logger.info(f"Расчет покупки для {tg_id}: тариф {tariff_key}, цена {quote.final_price} руб."
+                    + (f" (промокод {quote.promo_code}, скидка {discount_percent}%)" if quote.promo_code else ""))
+
+        return quote
+
+    @staticmethod
+    def apply_promo(quote, promo_code: str, discount_percent: float):
+        """
+        Возвращает новый расчет с уже проверенной скидкой по промокоду
+
+        План при этом не перечитывается, а исходный расчет не меняется.
+        """
+        return replace(
+            quote,
+            promo_code=promo_code,
+            discount_percent=discount_percent,
+            final_price=int(quote.base_price * (100 - discount_percent) / 100)
+        )
+
+    @staticmethod
+    def is_valid(quote, tariff_key: str, promo_code: str = None) -> bool:
+        """
+        Проверяет, что расчет можно использовать для оплаты
+
+        Расчет недействителен, если истек, если изменился каталог тарифов
+        или если пользователь выбрал другой тариф или промокод. Сам промокод
+        повторно проверяется при создании платежа (PromoService.use_promo).
+        """
+        return (
+            quote is not None and
+            quote.expires_at > time.time() and
+            quote.catalog_version == CheckoutService.catalog_version and
+            quote.tariff_key == tariff_key and
+            quote.promo_code == (promo_code or None)
+        )
@@ -0,0 +1,93 @@
+import logging
+from datetime import datetime
+from sqlalchemy import delete
+from sqlalchemy.future import select
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from bot.utils.db import async_session
+from bot.models.dead_chat import DeadChat
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class ChatUnavailableError(Exception):
+    """Чат отмечен недоступным, сообщение не отправлялось"""
+
+class DeadChatService:
+    """Реестр чатов, в которые бот не может писать (заблокировал бота, удален)"""
+
+    # Недоступные чаты в памяти, загружаются при старте
+    _dead = set()
+
+    # Счетчики для метрик
+    _stats = {"marked": 0, "revived": 0}
+
+    @staticmethod
+    async def load():
+        """Загружает реестр недоступных чатов из БД"""
+        async with async_session() as session:
+            result = await session.execute(select(DeadChat.tg_id))
+            DeadChatService._dead = set(result.scalars().all())
+
+        logger.info(f"Загружено {len(DeadChatService._dead)} недоступных чатов")
+
+    @staticmethod
+    def is_dead(tg_id: int) -> bool:
+        """Проверяет, отмечен ли чат недоступным"""
+        return tg_id in DeadChatService._dead
+
+    @staticmethod
+    def is_unreachable_error(error: Exception) -> bool:
+        """Проверяет, означает ли ошибка Telegram, что чат недоступен"""
+        if isinstance(error, TelegramForbiddenError):
+            return True
+        return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+    @staticmethod
+    async def mark_dead(tg_id: int, reason: str = None):
+        """
+        Отмечает чат недоступным
+
+        Args:
+            tg_id: Telegram ID чата
+            reason: Ответ Telegram
+        """
+        if tg_id in DeadChatService._dead:
+            return
+
+        DeadChatService._dead.add(tg_id)
+        DeadChatService._stats["marked"] += 1
+
+        try:
+            async with async_session() as session:
+                await session.merge(DeadChat(tg_id=tg_id, reason=reason, marked_at=datetime.now()))
+                await session.commit()
+            logger.info(f"Чат {tg_id} отмечен недоступным: {reason}")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении недоступного чата {tg_id}: {e}")
+
+    @staticmethod
+    async def revive(tg_id: int):
+        """
+        Снимает отметку недоступности, когда пользователь снова пишет боту
+
+        Args:
+            tg_id: Telegram ID чата
+        """
+        if tg_id not in DeadChatService._dead:
+            return
+
+        DeadChatService._dead.discard(tg_id)
+        DeadChatService._stats["revived"] += 1
+
+        try:
+            async with async_session() as session:
+                await session.execute(delete(DeadChat).where(DeadChat.tg_id == tg_id))
+                await session.commit()
+            logger.info(f"Чат {tg_id} снова доступен")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении чата {tg_id} из недоступных: {e}")
+
+    @staticmethod
+    def get_stats() -> dict:
+        """Возвращает размер реестра и счетчики"""
+        return {"dead": len(DeadChatService._dead), **DeadChatService._stats}
@@ -0,0 +1,107 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+from datetime import datetime
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class ExportService:
+    """Выгрузка таблиц в сжатые CSV/JSONL файлы"""
+
+    # Таблицы для выгрузки: (модель, колонка для фильтра по датам)
+    TABLES = {
+        "users": (User, User.created_at),
+        "clients": (Client, Client.expiry_time),
+        "payments": (Payment, Payment.created_at)
+    }
+
+    # Колонки, которые не выгружаются (конфигурации VPN и платежные токены)
+    EXCLUDED_COLUMNS = {"config_data", "payment_method_id"}
+
+    FORMATS = ("csv", "jsonl")
+
+    # Количество строк, читаемых из БД за один запрос
+    CHUNK_SIZE = 1000
+
+    @staticmethod
+    async def export(table: str, path: str, fmt: str = "csv", date_from: datetime = None, date_to: datetime = None) -> int:
+        """
+        Выгружает таблицу в gzip-файл
+
+        Строки читаются порциями короткими keyset-запросами по id (чтение не
+        держит транзакцию открытой), а сериализация и сжатие каждой порции
+        выполняются в отдельном потоке, поэтому выгрузка не блокирует цикл
+        событий, а в памяти одновременно находится не больше одной порции.
+
+        Args:
+            table: Имя таблицы из TABLES
+            path: Путь к файлу
+            fmt: csv или jsonl
+            date_from: Начало периода (опционально)
+            date_to: Конец периода, не включительно (опционально)
+
+        Returns:
+            int: Количество выгруженных строк
+        """
+        if table not in ExportService.TABLES:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        if fmt not in ExportService.FORMATS:
+            raise ValueError(f"Неизвестный формат: {fmt}")
+
+        model, date_column = ExportService.TABLES[table]
+        columns = [column for column in model.__table__.columns if column.name not in ExportService.EXCLUDED_COLUMNS]
+        names = [column.name for column in columns]
+
+        query = select(*columns)
+        if date_from:
+            query = query.where(date_column >= date_from)
+        if date_to:
+            query = query.where(date_column < date_to)
+
+        output = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8", newline="")
+        total = 0
+        last_id = 0
+
+        try:
+            if fmt == "csv":
+                writer = csv.writer(output)
+                await asyncio.to_thread(writer.writerow, names)
+
+            while True:
+                async with async_session() as session:
+                    result = await session.execute(
+                        query.where(model.id > last_id).order_by(model.id).limit(ExportService.CHUNK_SIZE)
+                    )
+                    rows = result.all()
+
+                if not rows:
+                    break
+
+                if fmt == "csv":
+                    await asyncio.to_thread(writer.writerows, rows)
+                else:
+                    await asyncio.to_thread(ExportService._write_jsonl, output, names, rows)
+
+                total += len(rows)
+                last_id = rows[-1].id
+        finally:
+            await asyncio.to_thread(output.close)
+
+        logger.info(f"Выгружено {total} строк таблицы {table} в {path}")
+        return total
+
+    @staticmethod
+    def _write_jsonl(output, names: list, rows):
+        """Записывает порцию строк в формате JSON Lines"""
+        output.writelines(
+            json.dumps(dict(zip(names, row)), ensure_ascii=False, default=str) + "\n"
+            for row in rows
+        )
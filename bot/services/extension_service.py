@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import func, update
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.client import Client
+from bot.models.extension import ExtensionJob
+from bot.services.vpn_service import VPNService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.message_gateway import MessageGateway
+from bot.services.notification_service import NotificationService
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class ExtensionService:
+    """
+    Массовое продление действующих платных подписок (компенсация)
+
+    Сроки продлеваются в БД одним UPDATE вместе с записью в extension_jobs,
+    затем новые сроки отправляются на VPN сервер порциями. Панель 3x-ui
+    обновляет клиентов только по одному (updateClient/{uuid}), поэтому
+    внутри порции запросы идут параллельно с ограничением. Контрольная точка -
+    последний обновленный clients.id; после перезапуска бота отправка
+    продолжается с нее.
+    """
+
+    # Количество клиентов, читаемых из БД за один запрос
+    CHUNK_SIZE = 200
+
+    # Максимум одновременных обновлений клиентов на VPN сервере
+    PANEL_CONCURRENCY = 5
+
+    # Минимальный интервал между обновлениями сообщения о прогрессе (секунды)
+    PROGRESS_INTERVAL = 5
+
+    # Статусы задания
+    STATUS_PUSHING = "pushing"
+    STATUS_COMPLETED = "completed"
+
+    _tasks = {}  # {job_id: asyncio.Task}
+
+    @staticmethod
+    def _condition(tariff_id: int, cutoff: datetime):
+        """Условие отбора продлеваемых клиентов: активные платные подписки, действующие на cutoff"""
+        tariff_ids = [tariff_id] if tariff_id else [
+            plan.tariff_id for plan in PlanRegistry.get_plans() if plan.tariff_id
+        ]
+        return (
+            (Client.is_active == True) &
+            (Client.tariff_id.in_(tariff_ids)) &
+            (Client.expiry_time > cutoff)
+        )
+
+    @staticmethod
+    def _shifted_expiry(dialect: str, days: int):
+        """Выражение нового срока подписки для UPDATE"""
+        if dialect == "sqlite":
+            # В SQLite даты хранятся строками: сдвигаем дату и сохраняем исходные микросекунды,
+            # чтобы формат совпадал с записанным SQLAlchemy
+            return func.strftime("%Y-%m-%d %H:%M:%S", Client.expiry_time, f"+{days} days").op("||")(
+                func.substr(Client.expiry_time, 20)
+            )
+        return Client.expiry_time + timedelta(days=days)
+
+    @staticmethod
+    async def count(tariff_id: int = None) -> int:
+        """Количество подписок, которые будут продлены (пробный запуск)"""
+        async with async_session() as session:
+            result = await session.execute(
+                select(func.count(Client.id)).where(ExtensionService._condition(tariff_id, datetime.now()))
+            )
+            return result.scalar() or 0
+
+    @staticmethod
+    async def create(days: int, admin_chat_id: int, progress_message_id: int = None, tariff_id: int = None) -> int:
+        """
+        Продлевает подписки в БД и сохраняет задание на обновление VPN сервера
+
+        Продление и задание фиксируются одной транзакцией, поэтому повторный
+        запуск после сбоя не продлит подписки второй раз.
+
+        Args:
+            days: На сколько дней продлить
+            admin_chat_id: Чат администратора для прогресса и отчета
+            progress_message_id: Сообщение для отображения прогресса
+            tariff_id: Продлить только подписки этого типа тарифа
+
+        Returns:
+            int: ID задания
+        """
+        cutoff = datetime.now()
+
+        async with async_session() as session:
+            max_client_id = (await session.execute(select(func.max(Client.id)))).scalar() or 0
+
+            result = await session.execute(
+                update(Client)
+                .where(ExtensionService._condition(tariff_id, cutoff) & (Client.id <= max_client_id))
+                .values(
+                    expiry_time=ExtensionService._shifted_expiry(session.get_bind().dialect.name, days),
+                    reminder_stages=0
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+            job = ExtensionJob(
+                days=days,
+                tariff_id=tariff_id,
+                cutoff=cutoff,
+                max_client_id=max_client_id,
+                status=ExtensionService.STATUS_PUSHING,
+                total=result.rowcount,
+                admin_chat_id=admin_chat_id,
+                progress_message_id=progress_message_id
+            )
+            session.add(job)
+            await session.commit()
+
+        logger.info(f"Продлено {job.total} подписок на {days} дн. (задание {job.id})")
+
+        # Сроки напоминаний сдвинулись - перестраиваем расписание
+        await NotificationService.rebuild_schedule()
+        return job.id
+
+    @staticmethod
+    def start(bot, job_id: int):
+        """Запускает обновление VPN сервера фоновой задачей, если оно еще не выполняется"""
+        task = ExtensionService._tasks.get(job_id)
+        if task and not task.done():
+            return
+
+        ExtensionService._tasks[job_id] = asyncio.create_task(ExtensionService._run(bot, job_id))
+
+    @staticmethod
+    async def resume_unfinished(bot):
+        """Продолжает обновление VPN сервера, прерванное перезапуском бота"""
+        async with async_session() as session:
+            result = await session.execute(
+                select(ExtensionJob.id).where(ExtensionJob.status == ExtensionService.STATUS_PUSHING)
+            )
+            job_ids = result.scalars().all()
+
+        for job_id in job_ids:
+            logger.info(f"Продолжаем продление {job_id} с контрольной точки")
+            ExtensionService.start(bot, job_id)
+
+    @staticmethod
+    async def iter_client_chunks(job):
+        """
+        Отдает продленных клиентов задания порциями по CHUNK_SIZE после контрольной точки
+
+        Yields:
+            list: Клиенты (Client)
+        """
+        after_id = job.last_client_id
+        while True:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Client)
+                    .where(
+                        ExtensionService._condition(job.tariff_id, job.cutoff) &
+                        (Client.id > after_id) &
+                        (Client.id <= job.max_client_id)
+                    )
+                    .order_by(Client.id)
+                    .limit(ExtensionService.CHUNK_SIZE)
+                )
+                clients = result.scalars().all()
+
+            if not clients:
+                return
+
+            yield clients
+            after_id = clients[-1].id
+
+    @staticmethod
+    async def _run(bot, job_id: int):
+        """Отправляет новые сроки на VPN сервер, сохраняя прогресс после каждой порции"""
+        async with async_session() as session:
+            job = await session.get(ExtensionJob, job_id)
+
+        if not job or job.status != ExtensionService.STATUS_PUSHING:
+            return
+
+        stats = {"total": job.total, "pushed": job.pushed, "failed": job.failed}
+        vpn_service = VPNService()
+        semaphore = asyncio.Semaphore(ExtensionService.PANEL_CONCURRENCY)
+        last_progress = time.monotonic()
+        started = last_progress
+
+        async def push(client):
+            if not client.uuid or not client.email:
+                logger.error(f"У клиента {client.id} не определен UUID или email, сервер не обновлен")
+                return False
+            async with semaphore:
+                return await vpn_service.update_client_on_server(
+                    user_uuid=client.uuid,
+                    nickname=client.email,
+                    traffic_limit=client.total_traffic,
+                    limit_ip=client.limit_ip,
+                    expiry_time=int(client.expiry_time.timestamp() * 1000)
+                )
+
+        try:
+            async for clients in ExtensionService.iter_client_chunks(job):
+                results = await asyncio.gather(*(push(client) for client in clients))
+                for client, success in zip(clients, results):
+                    if success:
+                        stats["pushed"] += 1
+                    else:
+                        stats["failed"] += 1
+                        logger.error(f"Не удалось обновить продленного клиента {client.email} на VPN сервере")
+
+                await ExtensionService._save_checkpoint(job_id, clients[-1].id, stats)
+
+                if time.monotonic() - last_progress >= ExtensionService.PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await ExtensionService._show_progress(bot, job, stats)
+        except Exception as e:
+            # Статус остается pushing - обновление продолжится после перезапуска
+            logger.error(f"Ошибка при обновлении сервера по продлению {job_id}: {e}")
+            await ExtensionService._notify_admin(bot, job, f"❌ Ошибка при обновлении VPN сервера: {e}")
+            return
+        finally:
+            ExtensionService._tasks.pop(job_id, None)
+
+        async with async_session() as session:
+            await session.execute(
+                update(ExtensionJob)
+                .where(ExtensionJob.id == job_id)
+                .values(status=ExtensionService.STATUS_COMPLETED, finished_at=datetime.now())
+            )
+            await session.commit()
+
+        logger.info(f"Продление {job_id} отправлено на сервер за {time.monotonic() - started:.1f} с: {stats}")
+        await ExtensionService._notify_admin(bot, job, ExtensionService.format_report(job, stats))
+
+    @staticmethod
+    async def _save_checkpoint(job_id: int, last_client_id: int, stats: dict):
+        """Сохраняет контрольную точку и счетчики задания"""
+        async with async_session() as session:
+            await session.execute(
+                update(ExtensionJob)
+                .where(ExtensionJob.id == job_id)
+                .values(last_client_id=last_client_id, pushed=stats["pushed"], failed=stats["failed"])
+            )
+            await session.commit()
+
+    @staticmethod
+    def format_progress(job, stats: dict) -> str:
+        """Текст сообщения о ходе обновления сервера"""
+        processed = stats["pushed"] + stats["failed"]
+        percent = min(processed * 100 // stats["total"], 100) if stats["total"] else 100
+        return (
+            f"⏳ Продление на {job.days} дн.: на сервере обновлено {processed} из {stats['total']} ({percent}%)\n\n"
+            f"- Успешно: {stats['pushed']}\n"
+            f"- Ошибок: {stats['failed']}"
+        )
+
+    @staticmethod
+    def format_report(job, stats: dict) -> str:
+        """Итоговый отчет о продлении"""
+        return (
+            f"✅ Продление завершено!\n\n"
+            f"📊 Статистика:\n"
+            f"- Продлено подписок на {job.days} дн.: {stats['total']}\n"
+            f"- Обновлено на сервере: {stats['pushed']}\n"
+            f"- Ошибок обновления: {stats['failed']}"
+        )
+
+    @staticmethod
+    async def _show_progress(bot, job, stats: dict):
+        """Обновляет сообщение о прогрессе через шлюз сообщений"""
+        if not job.progress_message_id:
+            return
+
+        try:
+            await MessageGateway.submit(
+                lambda: bot.edit_message_text(
+                    ExtensionService.format_progress(job, stats),
+                    chat_id=job.admin_chat_id,
+                    message_id=job.progress_message_id
+                ),
+                job.admin_chat_id,
+                MessageGateway.PRIORITY_NOTIFICATION
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс продления {job.id}: {e}")
+
+    @staticmethod
+    async def _notify_admin(bot, job, text: str):
+        """Отправляет администратору итог продления"""
+        try:
+            await MessageGateway.send_message(
+                bot, job.admin_chat_id, text,
+                priority=MessageGateway.PRIORITY_NOTIFICATION,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="Вернуться в админ-панель", callback_data="admin_back")]
+                ])
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки отчета о продлении {job.id}: {e}")
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import statistics
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.funnel_event import FunnelEvent
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class FunnelService:
+    """
+    Воронка покупки: от /start до оплаты
+
+    Обработчики только добавляют событие в буфер в памяти, без обращения к БД.
+    Буфер пакетами записывается в таблицу funnel_events фоновой задачей,
+    отчет строится по ней в фоне и не выполняется в обработчике апдейта.
+    """
+
+    # Шаги воронки по порядку
+    START = "start"
+    GET_CONFIG = "get_config"
+    TARIFF = "tariff"
+    EMAIL = "email"
+    PROMO = "promo"
+    PAYMENT_CREATED = "payment_created"
+    PAID = "paid"
+
+    STEPS = [START, GET_CONFIG, TARIFF, EMAIL, PROMO, PAYMENT_CREATED, PAID]
+
+    STEP_TITLES = {
+        START: "/start",
+        GET_CONFIG: "Получен конфиг",
+        TARIFF: "Выбран тариф",
+        EMAIL: "Указан email",
+        PROMO: "Пройден шаг промокода",
+        PAYMENT_CREATED: "Создан платеж",
+        PAID: "Оплачено"
+    }
+
+    # Интервал записи буфера в БД (секунды)
+    FLUSH_INTERVAL = 5
+
+    # Количество событий в одном INSERT
+    BATCH_SIZE = 1000
+
+    # Предел буфера: при недоступной БД старые события вытесняются, память не растет
+    MAX_BUFFER = 100000
+
+    _buffer = deque(maxlen=MAX_BUFFER)
+    _stats = {"emitted": 0, "flushed": 0, "dropped": 0}
+
+    @staticmethod
+    def emit(tg_id: int, step: str):
+        """Добавляет событие воронки в буфер"""
+        if len(FunnelService._buffer) == FunnelService.MAX_BUFFER:
+            FunnelService._stats["dropped"] += 1
+        FunnelService._buffer.append((tg_id, step, datetime.now()))
+        FunnelService._stats["emitted"] += 1
+
+    @staticmethod
+    def get_stats() -> dict:
+        """Возвращает счетчики буфера событий"""
+        return dict(FunnelService._stats, buffered=len(FunnelService._buffer))
+
+    @staticmethod
+    async def flush() -> int:
+        """
+        Записывает накопленные события в БД пакетами по BATCH_SIZE
+
+        Returns:
+            int: Количество записанных событий
+        """
+        buffer = FunnelService._buffer
+        flushed = 0
+
+        while buffer:
+            batch = [buffer.popleft() for _ in range(min(len(buffer), FunnelService.BATCH_SIZE))]
+            try:
+                async with async_session() as session:
+                    await session.execute(
+                        insert(FunnelEvent.__table__),
+                        [{"tg_id": tg_id, "step": step, "created_at": created_at} for tg_id, step, created_at in batch]
+                    )
+                    await session.commit()
+            except Exception as e:
+                # Возвращаем пакет в начало буфера - запишем при следующей попытке
+                buffer.extendleft(reversed(batch))
+                logger.error(f"Ошибка записи событий воронки: {e}")
+                break
+
+            flushed += len(batch)
+
+        FunnelService._stats["flushed"] += flushed
+        return flushed
+
+    @staticmethod
+    async def start_flusher(flush_interval=FLUSH_INTERVAL):
+        """
+        Записывает буфер событий в БД каждые flush_interval секунд
+
+        Args:
+            flush_interval: Интервал записи в секундах
+        """
+        logger.info(f"Запущена запись событий воронки каждые {flush_interval} секунд")
+
+        while True:
+            await asyncio.sleep(flush_interval)
+            await FunnelService.flush()
+
+    @staticmethod
+    async def build_report(days: int = 7) -> list:
+        """
+        Строит отчет по воронке за последние days дней
+
+        Для каждого шага берется первое событие пользователя за период.
+        Из БД читаются только эти первые события (GROUP BY), а конверсия и
+        медианы считаются в отдельном потоке.
+
+        Returns:
+            list: Шаги воронки (step, users, conversion, total_conversion, median_seconds)
+        """
+        # Включаем в отчет события, еще не записанные из буфера
+        await FunnelService.flush()
+
+        since = datetime.now() - timedelta(days=days)
+        rows = []
+        async with async_session() as session:
+            # Строки читаются порциями, чтобы не занимать цикл событий разбором всего результата сразу
+            result = await session.stream(
+                select(FunnelEvent.step, FunnelEvent.tg_id, func.min(FunnelEvent.created_at))
+                .where(FunnelEvent.created_at >= since)
+                .group_by(FunnelEvent.step, FunnelEvent.tg_id)
+            )
+            async for partition in result.partitions(FunnelService.BATCH_SIZE):
+                rows.extend(partition)
+
+        return await asyncio.to_thread(FunnelService._aggregate, rows)
+
+    @staticmethod
+    def _aggregate(rows) -> list:
+        """Считает конверсию и медианное время между соседними шагами"""
+        first = {step: {} for step in FunnelService.STEPS}
+        for step, tg_id, created_at in rows:
+            if step in first:
+                first[step][tg_id] = created_at
+
+        report = []
+        start_users = len(first[FunnelService.START])
+        previous = None
+
+        for step in FunnelService.STEPS:
+            reached = first[step]
+            users = len(reached)
+
+            conversion = None
+            median_seconds = None
+            if previous is not None:
+                previous_users = len(first[previous])
+                conversion = users / previous_users if previous_users else None
+
+                delays = [
+                    (created_at - first[previous][tg_id]).total_seconds()
+                    for tg_id, created_at in reached.items()
+                    if tg_id in first[previous] and created_at >= first[previous][tg_id]
+                ]
+                median_seconds = statistics.median(delays) if delays else None
+
+            report.append({
+                "step": step,
+                "users": users,
+                "conversion": conversion,
+                "total_conversion": users / start_users if start_users else None,
+                "median_seconds": median_seconds
+            })
+            previous = step
+
+        return report
+
+    @staticmethod
+    def format_report(report: list, days: int) -> str:
+        """Текст отчета по воронке для администратора"""
+        def percent(value):
+            return f"{value * 100:.1f}%" if value is not None else "-"
+
+        def duration(seconds):
+            if seconds is None:
+                return "-"
+            if seconds < 60:
+                return f"{seconds:.0f} с"
+            if seconds < 3600:
+                return f"{seconds / 60:.0f} мин"
+            if seconds < 86400:
+                return f"{seconds / 3600:.1f} ч"
+            return f"{seconds / 86400:.1f} дн"
+
+        text = f"<b>Воронка за {days} дн.</b>\n\n"
+        for index, item in enumerate(report):
+            text += f"{index + 1}. {FunnelService.STEP_TITLES[item['step']]}: {item['users']}"
+            if index:
+                text += (
+                    f" ({percent(item['conversion'])} от предыдущего, {percent(item['total_conversion'])} от /start,"
+                    f" медиана {duration(item['median_seconds'])})"
+                )
+            text += "\n"
+
+        text += (
+            "\nПользователь учитывается на шаге по первому событию за период; "
+            "пользователи, пришедшие раньше периода, могут не иметь события /start."
+        )
+        return text
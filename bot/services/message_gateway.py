@@ -0,0 +1,220 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from aiogram.exceptions import TelegramRetryAfter
+from bot.services.dead_chat_service import DeadChatService, ChatUnavailableError
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class MessageGateway:
+    """
+    Единая очередь исходящих сообщений бота
+
+    Все массовые и фоновые отправки идут через общий token bucket (глобальный
+    лимит Telegram), с паузой между сообщениями в один чат и с приоритетами:
+    подтверждения оплаты уходят раньше уведомлений, уведомления - раньше рассылок.
+    """
+
+    # Классы приоритета (меньше - важнее)
+    PRIORITY_PAYMENT = 0
+    PRIORITY_NOTIFICATION = 1
+    PRIORITY_BROADCAST = 2
+
+    # Глобальный лимит Telegram - около 30 сообщений в секунду
+    GLOBAL_RATE = 30
+
+    # Минимальный интервал между сообщениями в один чат (секунды)
+    CHAT_INTERVAL = 1.0
+
+    # Максимум одновременных запросов к Telegram
+    MAX_IN_FLIGHT = 10
+
+    # Максимум повторов после RetryAfter
+    MAX_RETRIES = 3
+
+    # Окно (секунды) для расчета фактической скорости отправки
+    RATE_WINDOW = 60
+
+    _queue = None  # asyncio.PriorityQueue: (priority, seq, item)
+    _worker = None
+    _seq = itertools.count()
+
+    _tokens = GLOBAL_RATE
+    _tokens_updated = 0.0
+    _paused_until = 0.0  # Глобальная пауза после RetryAfter
+    _chat_next = {}  # {chat_id: время, раньше которого в чат не отправляем}
+    _in_flight = None
+
+    _sent_times = deque()
+    _stats = {"sent": 0, "failed": 0, "retried": 0, "skipped_dead": 0}
+
+    @staticmethod
+    def submit(call, chat_id: int, priority: int = PRIORITY_NOTIFICATION) -> asyncio.Future:
+        """
+        Ставит отправку в очередь
+
+        Args:
+            call: Функция без аргументов, возвращающая корутину запроса к Telegram
+                  (вызывается заново при повторе)
+            chat_id: ID чата получателя (для паузы между сообщениями в один чат)
+            priority: Класс приоритета
+
+        Returns:
+            asyncio.Future: Результат запроса или исключение
+                            (ChatUnavailableError для недоступного чата)
+        """
+        MessageGateway._ensure_worker()
+
+        future = asyncio.get_running_loop().create_future()
+        # Ошибки логируются шлюзом, поэтому неожидаемые future не дают предупреждений
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        # Пользователь заблокировал бота - запрос к Telegram не выполняем
+        if DeadChatService.is_dead(chat_id):
+            MessageGateway._stats["skipped_dead"] += 1
+            future.set_exception(ChatUnavailableError(f"Чат {chat_id} недоступен"))
+            return future
+
+        item = {"call": call, "chat_id": chat_id, "future": future, "attempt": 0}
+        MessageGateway._queue.put_nowait((priority, next(MessageGateway._seq), item))
+        return future
+
+    @staticmethod
+    def send_message(bot, chat_id: int, text: str, priority: int = PRIORITY_NOTIFICATION, **kwargs) -> asyncio.Future:
+        """Ставит в очередь bot.send_message и возвращает future с отправленным сообщением"""
+        return MessageGateway.submit(
+            lambda: bot.send_message(chat_id, text, **kwargs),
+            chat_id,
+            priority
+        )
+
+    @staticmethod
+    def get_stats() -> dict:
+        """Возвращает глубину очереди, фактическую скорость отправки и счетчики"""
+        MessageGateway._trim_sent_times()
+        window = min(MessageGateway.RATE_WINDOW, max(time.monotonic() - MessageGateway._sent_times[0], 1)) \
+            if MessageGateway._sent_times else MessageGateway.RATE_WINDOW
+
+        return {
+            "queue_depth": MessageGateway._queue.qsize() if MessageGateway._queue else 0,
+            "messages_per_second": round(len(MessageGateway._sent_times) / window, 2),
+            **MessageGateway._stats
+        }
+
+    @staticmethod
+    def _ensure_worker():
+        """Запускает обработчик очереди при первой отправке"""
+        if MessageGateway._queue is None:
+            MessageGateway._queue = asyncio.PriorityQueue()
+            MessageGateway._in_flight = asyncio.Semaphore(MessageGateway.MAX_IN_FLIGHT)
+            MessageGateway._tokens_updated = time.monotonic()
+
+        if MessageGateway._worker is None or MessageGateway._worker.done():
+            MessageGateway._worker = asyncio.create_task(MessageGateway._run())
+
+    @staticmethod
+    async def _acquire_token():
+        """Ждет свободный токен глобального лимита"""
+        while True:
+            now = time.monotonic()
+
+            if now < MessageGateway._paused_until:
+                await asyncio.sleep(MessageGateway._paused_until - now)
+                continue
+
+            elapsed = now - MessageGateway._tokens_updated
+            MessageGateway._tokens = min(MessageGateway.GLOBAL_RATE, MessageGateway._tokens + elapsed * MessageGateway.GLOBAL_RATE)
+            MessageGateway._tokens_updated = now
+
+            if MessageGateway._tokens >= 1:
+                MessageGateway._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - MessageGateway._tokens) / MessageGateway.GLOBAL_RATE)
+
+    @staticmethod
+    async def _run():
+        """Основной цикл: берет сообщения по приоритету и отправляет в пределах лимитов"""
+        logger.info("Запущен шлюз исходящих сообщений")
+
+        while True:
+            priority, seq, item = await MessageGateway._queue.get()
+
+            if item["future"].done():
+                continue
+
+            # Чат еще не готов - возвращаем сообщение в очередь позже, не блокируя остальные
+            wait = MessageGateway._chat_next.get(item["chat_id"], 0) - time.monotonic()
+            if wait > 0:
+                MessageGateway._requeue_later(wait, priority, seq, item)
+                continue
+
+            await MessageGateway._acquire_token()
+            await MessageGateway._in_flight.acquire()
+
+            MessageGateway._chat_next[item["chat_id"]] = time.monotonic() + MessageGateway.CHAT_INTERVAL
+            asyncio.create_task(MessageGateway._deliver(priority, seq, item))
+
+            if len(MessageGateway._chat_next) > 10000:
+                MessageGateway._prune_chats()
+
+    @staticmethod
+    async def _deliver(priority: int, seq: int, item: dict):
+        """Выполняет запрос к Telegram и разрешает future"""
+        try:
+            result = await item["call"]()
+        except TelegramRetryAfter as e:
+            MessageGateway._stats["retried"] += 1
+            # Лимит превышен - приостанавливаем все отправки на указанное время
+            MessageGateway._paused_until = max(MessageGateway._paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Telegram RetryAfter {e.retry_after} с для чата {item['chat_id']}")
+
+            item["attempt"] += 1
+            if item["attempt"] > MessageGateway.MAX_RETRIES:
+                MessageGateway._stats["failed"] += 1
+                item["future"].set_exception(e)
+            else:
+                MessageGateway._queue.put_nowait((priority, seq, item))
+        except Exception as e:
+            MessageGateway._stats["failed"] += 1
+            if DeadChatService.is_unreachable_error(e):
+                # Следующие сообщения в этот чат будут пропущены до нового обращения пользователя
+                await DeadChatService.mark_dead(item["chat_id"], str(e))
+            else:
+                logger.error(f"Ошибка отправки сообщения в чат {item['chat_id']}: {e}")
+            if not item["future"].done():
+                item["future"].set_exception(e)
+        else:
+            MessageGateway._stats["sent"] += 1
+            MessageGateway._sent_times.append(time.monotonic())
+            MessageGateway._trim_sent_times()
+            if not item["future"].done():
+                item["future"].set_result(result)
+        finally:
+            MessageGateway._in_flight.release()
+
+    @staticmethod
+    def _requeue_later(delay: float, priority: int, seq: int, item: dict):
+        """Возвращает сообщение в очередь через delay секунд"""
+        asyncio.get_running_loop().call_later(
+            delay, MessageGateway._queue.put_nowait, (priority, seq, item)
+        )
+
+    @staticmethod
+    def _trim_sent_times():
+        """Удаляет отметки отправки за пределами окна расчета скорости"""
+        border = time.monotonic() - MessageGateway.RATE_WINDOW
+        while MessageGateway._sent_times and MessageGateway._sent_times[0] < border:
+            MessageGateway._sent_times.popleft()
+
+    @staticmethod
+    def _prune_chats():
+        """Удаляет чаты, пауза для которых уже истекла"""
+        now = time.monotonic()
+        MessageGateway._chat_next = {
+            chat_id: next_time for chat_id, next_time in MessageGateway._chat_next.items()
+            if next_time > now
+        }
@@ -1,144 +1,318 @@
 import logging
 import asyncio
+import heapq
+from collections import deque
 from datetime import datetime, timedelta
-from sqlalchemy import select
+from sqlalchemy import select, update, insert, func, or_, Integer
 from aiogram import Bot
 from bot.utils.db import async_session
 from bot.models.client import Client
 from bot.models.user import User
+from bot.models.reminder_event import ReminderEvent
+from bot.config import REMINDER_STAGES_HOURS
+from bot.services.message_gateway import MessageGateway
+from bot.services.dead_chat_service import DeadChatService
 
 logger = logging.getLogger(__name__)
 
 class NotificationService:
     """Сервис для отправки уведомлений об истечении подписки"""
-
+    
+    # Этапы напоминаний: (бит в clients.reminder_stages, часов до окончания подписки)
+    STAGES = [(1 << index, hours) for index, hours in enumerate(REMINDER_STAGES_HOURS)]
+    
+    # Маска, в которой отправлены все этапы
+    ALL_STAGES = sum(bit for bit, _ in STAGES)
+    
+    # Напоминание об уже истекшей подписке отправляется не позже чем через сутки
+    EXPIRED_GRACE = timedelta(days=1)
+    
+    # Размер порции ID в одном запросе
+    CHUNK_SIZE = 500
+    
+    # Куча моментов следующей проверки: (deadline, client_id).
+    # Сама выборка клиентов выполняется запросом, куча лишь определяет, когда проснуться
+    _heap = []
+    
+    # Будит цикл отправки при появлении более раннего срока
+    _wakeup = None
+    
+    # Задержка отправки напоминаний относительно срока этапа (секунды)
+    _lag_samples = deque(maxlen=1000)
+    _lag_stats = {"sent": 0, "max_lag": 0.0}
+    
+    @staticmethod
+    def _next_deadline(expiry_time: datetime, sent_stages: int):
+        """Срок ближайшего неотправленного этапа или None, если все этапы отправлены"""
+        deadlines = [
+            expiry_time - timedelta(hours=hours)
+            for bit, hours in NotificationService.STAGES
+            if not sent_stages & bit
+        ]
+        return min(deadlines) if deadlines else None
+    
+    @staticmethod
+    def schedule(client_id: int, expiry_time: datetime, sent_stages: int = 0):
+        """
+        Планирует напоминания для клиента после изменения срока подписки
+        
+        Args:
+            client_id: ID клиента
+            expiry_time: Новый срок окончания подписки
+            sent_stages: Маска уже отправленных этапов для этого срока
+        """
+        if not expiry_time:
+            return
+        
+        deadline = NotificationService._next_deadline(expiry_time, sent_stages)
+        if deadline is None:
+            return
+        
+        heapq.heappush(NotificationService._heap, (deadline, client_id))
+        
+        if NotificationService._wakeup:
+            NotificationService._wakeup.set()
+    
+    @staticmethod
+    async def rebuild_schedule():
+        """Строит кучу сроков напоминаний по индексу clients.expiry_time"""
+        now = datetime.now()
+        max_hours = max(hours for _, hours in NotificationService.STAGES)
+        
+        async with async_session() as session:
+            result = await session.execute(
+                select(Client.id, Client.expiry_time, Client.reminder_stages).where(
+                    (Client.expiry_time >= now - NotificationService.EXPIRED_GRACE) &
+                    (Client.expiry_time <= now + timedelta(hours=max_hours, days=1)) &
+                    (Client.is_active == True) &
+                    (func.coalesce(Client.reminder_stages, 0) != NotificationService.ALL_STAGES)
+                )
+            )
+            rows = result.all()
+        
+        heap = []
+        for client_id, expiry_time, sent_stages in rows:
+            deadline = NotificationService._next_deadline(expiry_time, sent_stages or 0)
+            if deadline is not None:
+                heap.append((deadline, client_id))
+        
+        heapq.heapify(heap)
+        NotificationService._heap = heap
+        
+        logger.info(f"Запланировано {len(heap)} напоминаний об истечении подписки")
+    
+    @staticmethod
+    def _pop_due(now: datetime) -> int:
+        """Извлекает из кучи наступившие сроки и возвращает их количество"""
+        count = 0
+        while NotificationService._heap and NotificationService._heap[0][0] <= now:
+            heapq.heappop(NotificationService._heap)
+            count += 1
+        return count
+    
     @staticmethod
-    async def check_expiring_subscriptions(bot):
+    async def check_expiring_subscriptions(bot, force: bool = False):
         """
-        Проверяет подписки, срок действия которых истекает, и отправляет уведомления
+        Отправляет напоминания всех этапов, срок которых наступил
+        
+        Все клиенты с наступившим этапом выбираются одним запросом по индексу
+        clients.expiry_time. Если наступило несколько этапов сразу, отправляется
+        только самый поздний, более ранние отмечаются пропущенными.
         
         Args:
             bot: Экземпляр бота для отправки уведомлений
+            force: Выполнить выборку, даже если в куче нет наступивших сроков
         """
-        logger.info("Проверка истекающих подписок...")
+        now = datetime.now()
+        if not NotificationService._pop_due(now) and not force:
+            return
+        
+        max_hours = max(hours for _, hours in NotificationService.STAGES)
+        stage_due = [
+            (Client.expiry_time <= now + timedelta(hours=hours)) &
+            (func.coalesce(Client.reminder_stages, 0).op("&")(bit) == 0)
+            for bit, hours in NotificationService.STAGES
+        ]
         
         try:
-            # Получаем текущую дату и дату "завтра"
-            now = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            yesterday = now - timedelta(days=1)
-            tomorrow = now + timedelta(days=1)
-            today_end = now.replace(hour=23, minute=59, second=59)
-            tomorrow_end = tomorrow.replace(hour=23, minute=59, second=59)
-            
             async with async_session() as session:
-                # Находим клиентов, у которых срок действия истекает сегодня, завтра или уже истек
-                # и для которых не отправлялись уведомления
-                query = select(Client, User).join(User).where(
-                    (
-                        # Подписка уже истекла (вчера)
-                        ((Client.expiry_time >= yesterday) & (Client.expiry_time < now)) |
-                        # Подписка истекает сегодня
-                        ((Client.expiry_time >= now) & (Client.expiry_time <= today_end)) |
-                        # Подписка истекает завтра
-                        ((Client.expiry_time >= tomorrow) & (Client.expiry_time <= tomorrow_end))
-                    ) &
-                    (Client.is_active == True) &
-                    (Client.tg_notified == False)
+                result = await session.execute(
+                    select(Client.id, Client.user_id, Client.expiry_time, Client.reminder_stages, User.tg_id)
+                    .join(User)
+                    .where(
+                        (Client.expiry_time >= now - NotificationService.EXPIRED_GRACE) &
+                        (Client.expiry_time <= now + timedelta(hours=max_hours)) &
+                        (Client.is_active == True) &
+                        or_(*stage_due)
+                    )
                 )
-                
-                result = await session.execute(query)
-                clients_with_users = result.all()
-                
-                logger.info(f"Найдено {len(clients_with_users)} клиентов с истекающими подписками")
-                
-                for client, user in clients_with_users:
-                    try:
-                        # Определяем, когда истекает подписка
-                        expiry_date = client.expiry_time.date()
-                        today_date = now.date()
-                        yesterday_date = yesterday.date()
-                        
-                        if expiry_date == yesterday_date:
-                            expires_status = "expired"
-                        elif expiry_date == today_date:
-                            expires_status = "today"
-                        else:
-                            expires_status = "tomorrow"
-                        
-                        # Отправляем уведомление пользователю
-                        sent = await NotificationService._send_notification(
-                            bot, 
-                            user.tg_id, 
-                            client.expiry_time, 
-                            expires_status
-                        )
-                        
-                        if sent:
-                            # Отмечаем, что уведомление отправлено
-                            client.tg_notified = True
-                            await session.commit()
-                            
-                            status_text = {
-                                "expired": "вчера",
-                                "today": "сегодня",
-                                "tomorrow": "завтра"
-                            }[expires_status]
-                            
-                            logger.info(f"Отправлено уведомление пользователю {user.tg_id} об истечении подписки {status_text}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при обработке клиента {client.id}: {e}")
-                        await session.rollback()
-                        continue
-                
+                rows = result.all()
         except Exception as e:
             logger.error(f"Ошибка при проверке истекающих подписок: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            return
+        
+        to_send = []
+        marks = {}  # {маска этапов: [ID клиентов]}
+        skipped = 0
+        for client_id, user_id, expiry_time, sent_stages, tg_id in rows:
+            sent_stages = sent_stages or 0
+            due = [
+                (bit, hours) for bit, hours in NotificationService.STAGES
+                if not sent_stages & bit and expiry_time - timedelta(hours=hours) <= now
+            ]
+            if not due:
+                continue
+            
+            # Самый поздний из наступивших этапов
+            stage_hours = min(hours for _, hours in due)
+            due_mask = sum(bit for bit, _ in due)
+            
+            # Пользователь заблокировал бота - этапы отмечаем пропущенными без отправки
+            if DeadChatService.is_dead(tg_id):
+                skipped += 1
+                marks.setdefault(due_mask, []).append(client_id)
+                NotificationService.schedule(client_id, expiry_time, sent_stages | due_mask)
+                continue
+            
+            to_send.append((client_id, user_id, tg_id, expiry_time, sent_stages, stage_hours, due_mask))
+        
+        if not to_send:
+            await NotificationService._mark_sent(marks, [])
+            return
+        
+        # Темп отправки задает шлюз сообщений
+        results = await asyncio.gather(*(
+            NotificationService._send_notification(bot, tg_id, expiry_time, stage_hours)
+            for _, _, tg_id, expiry_time, _, stage_hours, _ in to_send
+        ))
+        
+        events = []
+        for (client_id, user_id, _, expiry_time, sent_stages, stage_hours, due_mask), sent in zip(to_send, results):
+            if not sent:
+                continue
+            
+            marks.setdefault(due_mask, []).append(client_id)
+            events.append({
+                "client_id": client_id,
+                "user_id": user_id,
+                "stage": stage_hours,
+                "expiry_time": expiry_time,
+                "sent_at": now
+            })
+            NotificationService._record_lag(expiry_time - timedelta(hours=stage_hours))
+            
+            # Планируем следующий этап
+            NotificationService.schedule(client_id, expiry_time, sent_stages | due_mask)
+        
+        await NotificationService._mark_sent(marks, events)
+        
+        logger.info(
+            f"Отправлено {len(events)} из {len(to_send)} напоминаний об истечении подписки, "
+            f"пропущено недоступных чатов: {skipped}"
+        )
     
     @staticmethod
-    async def reset_notification_flags():
+    async def _mark_sent(marks: dict, events: list):
         """
-        Сбрасывает флаги уведомлений для продленных подписок
+        Отмечает отправленные этапы пакетными UPDATE и записывает журнал напоминаний
+        
+        Args:
+            marks: {маска этапов: [ID клиентов]}
+            events: Записи для таблицы reminder_events
         """
+        if not marks:
+            return
+        
         try:
-            logger.info("Сброс флагов уведомлений для продленных подписок...")
-            
-            # Получаем текущую дату и дату через 3 дня
-            now = datetime.now()
-            future_date = now + timedelta(days=3)
-            
             async with async_session() as session:
-                try:
-                    # Находим клиентов с флагом уведомления, но дата истечения более 3 дней
-                    query = select(Client).where(
-                        (Client.expiry_time > future_date) &  # Подписка продлена (истекает не скоро)
-                        (Client.tg_notified == True) &        # Уведомление было отправлено
-                        (Client.is_active == True)            # Клиент активен
-                    )
-                    
-                    result = await session.execute(query)
-                    clients = result.scalars().all()
-                    
-                    logger.info(f"Найдено {len(clients)} клиентов с продленными подписками")
-                    
-                    if clients:
-                        for client in clients:
-                            client.tg_notified = False
-                        
-                        await session.commit()
-                        logger.info(f"Сброшены флаги уведомлений для {len(clients)} клиентов")
-                except Exception as e:
-                    logger.error(f"Ошибка при сбросе флагов уведомлений: {e}")
-                    await session.rollback()
-                    raise
+                for mask, client_ids in marks.items():
+                    for start in range(0, len(client_ids), NotificationService.CHUNK_SIZE):
+                        await session.execute(
+                            update(Client)
+                            .where(Client.id.in_(client_ids[start:start + NotificationService.CHUNK_SIZE]))
+                            .values(reminder_stages=func.coalesce(Client.reminder_stages, 0).op("|")(mask))
+                        )
                 
+                if events:
+                    await session.execute(insert(ReminderEvent), events)
+                await session.commit()
         except Exception as e:
-            logger.error(f"Ошибка при сбросе флагов уведомлений: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Ошибка при отметке отправленных напоминаний: {e}")
+    
+    @staticmethod
+    def _record_lag(deadline: datetime):
+        """Учитывает задержку отправки напоминания относительно срока"""
+        lag = max((datetime.now() - deadline).total_seconds(), 0.0)
+        NotificationService._lag_samples.append(lag)
+        NotificationService._lag_stats["sent"] += 1
+        NotificationService._lag_stats["max_lag"] = max(NotificationService._lag_stats["max_lag"], lag)
     
     @staticmethod
-    async def _send_notification(bot: Bot, user_id: int, expiry_time: datetime, expires_status: str):
+    def get_lag_stats() -> dict:
+        """Возвращает задержку отправки напоминаний (секунды) и размер расписания"""
+        samples = sorted(NotificationService._lag_samples)
+        return {
+            "scheduled": len(NotificationService._heap),
+            "sent": NotificationService._lag_stats["sent"],
+            "avg_lag": round(sum(samples) / len(samples), 3) if samples else 0.0,
+            "p95_lag": round(samples[int(len(samples) * 0.95) - 1], 3) if samples else 0.0,
+            "max_lag": round(NotificationService._lag_stats["max_lag"], 3)
+        }
+    
+    @staticmethod
+    async def get_renewal_rates(days: int = 30) -> dict:
+        """
+        Считает долю продлений после напоминаний каждого этапа
+        
+        Подписка считается продленной, если текущий срок клиента позже срока,
+        о котором было отправлено напоминание.
+        
+        Args:
+            days: Период в днях, за который учитываются напоминания
+        
+        Returns:
+            dict: {этап (часов): {"sent": ..., "renewed": ..., "rate": ...}}
+        """
+        since = datetime.now() - timedelta(days=days)
+        
+        async with async_session() as session:
+            result = await session.execute(
+                select(
+                    ReminderEvent.stage,
+                    func.count(ReminderEvent.id),
+                    func.sum((Client.expiry_time > ReminderEvent.expiry_time).cast(Integer))
+                )
+                .join(Client, Client.id == ReminderEvent.client_id)
+                .where(ReminderEvent.sent_at >= since)
+                .group_by(ReminderEvent.stage)
+            )
+            rows = result.all()
+        
+        return {
+            stage: {"sent": sent, "renewed": renewed or 0, "rate": round((renewed or 0) / sent, 3) if sent else 0.0}
+            for stage, sent, renewed in sorted(rows, key=lambda row: -row[0])
+        }
+    
+    @staticmethod
+    def _format_stage(hours: int) -> str:
+        """Описание времени до окончания подписки для текста напоминания"""
+        if hours >= 48:
+            days = round(hours / 24)
+            if days % 10 == 1 and days % 100 != 11:
+                word = "день"
+            elif days % 10 in (2, 3, 4) and days % 100 not in (12, 13, 14):
+                word = "дня"
+            else:
+                word = "дней"
+            return f"через {days} {word}"
+        if hours >= 24:
+            return "завтра"
+        return "менее чем через сутки"
+    
+    @staticmethod
+    async def _send_notification(bot: Bot, user_id: int, expiry_time: datetime, stage_hours: int):
         """
         Отправляет уведомление пользователю
         
@@ -146,63 +320,76 @@ class NotificationService:
             bot: Экземпляр бота
             user_id: Telegram ID пользователя
             expiry_time: Время окончания подписки
-            expires_status: Статус истечения ("expired", "today", "tomorrow")
+            stage_hours: Этап напоминания (часов до окончания, 0 - подписка истекла)
         """
         try:
             # Форматируем дату и время окончания
             formatted_date = expiry_time.strftime("%d.%m.%Y")
             
-            # Формируем текст сообщения в зависимости от типа уведомления
-            if expires_status == "expired":
+            # Формируем текст сообщения в зависимости от этапа
+            if stage_hours <= 0:
                 message_text = (
                     f"⚠️ Уведомление о подписке\n\n"
-                    f"Срок действия вашей подписки истек вчера - {formatted_date}.\n\n"
+                    f"Срок действия вашей подписки истек - {formatted_date}.\n\n"
+                    f"Продлите ее в разделе '💼 Подписка и оплата'."
                 )
-            elif expires_status == "today":
+            else:
                 message_text = (
                     f"⚠️ Уведомление о подписке\n\n"
-                    f"Срок действия вашей подписки истекает сегодня - {formatted_date}.\n\n"
-                )
-            else:  # tomorrow
-                message_text = (
-                    f"⚠️ Уведомление о подписке\n\n"
-                    f"Срок действия вашей подписки истекает завтра - {formatted_date}.\n\n"
+                    f"Срок действия вашей подписки истекает {NotificationService._format_stage(stage_hours)} - {formatted_date}.\n\n"
                 )
             
             # Отправляем сообщение
-            await bot.send_message(
-                chat_id=user_id,
-                text=message_text
-            )
+            await MessageGateway.send_message(bot, user_id, message_text)
             
             return True
         except Exception as e:
             logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
             return False
-
+    
     @staticmethod
     async def start_notification_checker(bot, check_interval=3600):
         """
-        Запускает проверку истекающих подписок каждые check_interval секунд
+        Запускает отправку напоминаний по расписанию сроков
+        
+        Цикл спит до ближайшего срока в куче. Раз в check_interval секунд
+        расписание строится заново, а выборка выполняется принудительно.
         
         Args:
             bot: Экземпляр бота для отправки уведомлений
-            check_interval: Интервал проверки в секундах (по умолчанию - 1 час)
+            check_interval: Интервал полной пересборки расписания в секундах (по умолчанию - 1 час)
         """
-        logger.info(f"Запущена проверка истекающих подписок каждые {check_interval} секунд")
+        logger.info(f"Запущены напоминания об истечении подписок, этапы: {REMINDER_STAGES_HOURS} ч")
+        
+        NotificationService._wakeup = asyncio.Event()
+        next_rebuild = datetime.now()
         
         while True:
+            force = False
             try:
-                # Проверяем истекающие подписки
-                await NotificationService.check_expiring_subscriptions(bot)
-                
-                # Сбрасываем флаги для продленных подписок
-                await NotificationService.reset_notification_flags()
+                if datetime.now() >= next_rebuild:
+                    await NotificationService.rebuild_schedule()
+                    next_rebuild = datetime.now() + timedelta(seconds=check_interval)
+                    force = True
+                    
+                    logger.info(f"Задержка напоминаний: {NotificationService.get_lag_stats()}")
                 
+                # Отправляем напоминания, срок которых наступил
+                await NotificationService.check_expiring_subscriptions(bot, force=force)
+            
             except Exception as e:
                 logger.error(f"Ошибка в цикле проверки истекающих подписок: {e}")
                 import traceback
                 logger.error(traceback.format_exc())
             
-            # Ждем до следующей проверки
-            await asyncio.sleep(check_interval) 
\ No newline at end of file
+            # Спим до ближайшего срока или до пересборки расписания
+            wake_at = next_rebuild
+            if NotificationService._heap:
+                wake_at = min(wake_at, NotificationService._heap[0][0])
+            timeout = max((wake_at - datetime.now()).total_seconds(), 0)
+            
+            NotificationService._wakeup.clear()
+            try:
+                await asyncio.wait_for(NotificationService._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -2,17 +2,26 @@ import logging
 from datetime import datetime, timedelta
 import uuid
 import asyncio
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import json
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
 from sqlalchemy.future import select
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from bot.utils.db import async_session
+from bot.utils.cache import TTLCache
 from bot.models.payment import Payment as PaymentModel
+from bot.models.payment_activation import PaymentActivation
 from bot.models.user import User
 from bot.models.plan import Plan
 from bot.models.client import Client
-from bot.config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, PAYMENT_RETURN_URL
-from bot.keyboards.subscription_kb import TARIFFS
+from bot.config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, PAYMENT_RETURN_URL, TELEGRAM_PAYMENT_PROVIDER_TOKEN, YOOKASSA_API_URL, AUTO_RENEW_ENABLED
 from bot.services.vpn_service import VPNService
 from bot.services.promo_service import PromoService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.message_gateway import MessageGateway
+from bot.services.notification_service import NotificationService
+from bot.services.stats_service import StatsService
+from bot.services.funnel_service import FunnelService
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -65,6 +74,10 @@ try:
         logger.info(f"Секретный ключ: {YOOKASSA_SECRET_KEY[:5]}...{YOOKASSA_SECRET_KEY[-5:]}")
         Configuration.account_id = YOOKASSA_SHOP_ID
         Configuration.secret_key = YOOKASSA_SECRET_KEY
+        if YOOKASSA_API_URL:
+            # Например, локальный тестовый сервер
+            Configuration.api_url = YOOKASSA_API_URL
+            logger.info(f"Используется API YooKassa: {YOOKASSA_API_URL}")
         yookassa_configured = True
         logger.info("YooKassa успешно инициализирована")
     else:
@@ -85,192 +98,459 @@ class PaymentService:
     # Хранилище активных задач проверки платежей
     _payment_check_tasks = {}  # {payment_id: task}
     
+    # Статусы, из которых платеж еще может перейти в финальный
+    OPEN_STATUSES = ("pending", "waiting_for_capture")
+    
+    # Максимум одновременных запросов к YooKassa при проверке платежей
+    CHECK_CONCURRENCY = 5
+    
+    # Префикс ID платежей, оплачиваемых счетом Telegram (не опрашиваются в YooKassa)
+    INVOICE_PREFIX = "tg_invoice_"
+    
+    # Очистка зависших платежей: размер порции и параллельные отмены в YooKassa
+    CLEANUP_CHUNK_SIZE = 500
+    CANCEL_CONCURRENCY = 5
+    
+    # Сколько секунд незавершенный платеж выдается повторно вместо создания нового
+    PENDING_REUSE_TTL = 600
+    
+    # Активация без completed_at повторяется не раньше чем через столько секунд после захвата
+    # (исходный обработчик может еще обновлять клиента) и не чаще раза в интервал
+    ACTIVATION_RETRY_DELAY = 300
+    ACTIVATION_RETRY_INTERVAL = 300
+    
+    # Незавершенные платежи по ключу (user_id, plan_id, цена) и платежи в процессе создания
+    _pending_payments = TTLCache(maxsize=1024, ttl=PENDING_REUSE_TTL)
+    _inflight_payments = {}  # {key: future}
+    _reuse_stats = {"created": 0, "reused_cache": 0, "reused_db": 0, "joined_inflight": 0}
+    
     @staticmethod
     async def get_plan_by_tariff(tariff_key: str) -> Plan:
-        """Получает план по ключу тарифа"""
-        async with async_session() as session:
-            tariff_info = TARIFFS.get(tariff_key)
-            if not tariff_info:
-                raise ValueError(f"Тариф {tariff_key} не найден")
-            
-            # Находим план в БД
-            plan_query = await session.execute(
-                select(Plan).where(Plan.title == tariff_info["name"])
-            )
-            plan = plan_query.scalar_one_or_none()
-            
-            if not plan:
-                logger.warning(f"План для тарифа {tariff_key} ({tariff_info['name']}) не найден в БД")
-                raise ValueError(f"План для тарифа {tariff_key} не найден в базе данных")
-            
-            return plan
+        """Получает план по ключу тарифа из каталога тарифов"""
+        await PlanRegistry.ensure_loaded()
+        
+        plan = PlanRegistry.get_by_key(tariff_key)
+        if not plan:
+            logger.warning(f"План для тарифа {tariff_key} не найден в каталоге")
+            raise ValueError(f"Тариф {tariff_key} не найден")
+        
+        return plan
     
     @staticmethod
-    async def create_payment(user_id: int, tariff_key: str, contact: str = None, promo_code: str = None, bot=None):
+    async def create_payment(quote, contact: str = None, bot=None):
         """
         Создает платеж в YooKassa и сохраняет в БД
         
+        Если у пользователя уже есть незавершенный платеж на тот же тариф и
+        ту же сумму (или он создается прямо сейчас), возвращается он.
+        
         Args:
-            user_id: Telegram ID пользователя
-            tariff_key: Ключ тарифа (например, "base", "middle", "unlimited")
+            quote: Расчет покупки (CheckoutQuote) - план, скидка и итоговая цена
             contact: Email или телефон для чека (опционально)
-            promo_code: Промокод для скидки (опционально)
             bot: Экземпляр бота для отправки уведомлений (опционально)
             
         Returns:
             tuple: (payment_id, payment_url, markup) или (None, None, None) при ошибке
+            
+        Raises:
+            ValueError: Если промокод расчета больше не действует
         """
         try:
-            # Получаем план и пользователя
-            async with async_session() as session:
-                user_query = await session.execute(
-                    select(User).where(User.tg_id == user_id)
+            async def create():
+                return await PaymentService._create_provider_payment(quote, contact)
+            
+            payment_id, payment_url = await PaymentService._get_or_create_payment(
+                (quote.user_id, quote.plan_id, quote.final_price), create
+            )
+            
+            if not payment_id:
+                return None, None, None
+            
+            return payment_id, payment_url, PaymentService._build_payment_markup(payment_id, payment_url)
+        
+        except ValueError:
+            # Промокод больше не действует - сообщение показывается пользователю
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при создании платежа для пользователя {quote.tg_id}: {e}")
+            return None, None, None
+    
+    @staticmethod
+    async def _get_or_create_payment(key: tuple, create):
+        """
+        Возвращает незавершенный платеж для ключа (user, plan, цена) или создает новый
+        
+        Порядок: TTL-кэш, платеж, создаваемый параллельным запросом,
+        незавершенный платеж в БД, и только затем create().
+        
+        Args:
+            key: (ID пользователя в БД, ID плана, итоговая цена)
+            create: Корутина-фабрика, создающая платеж и возвращающая (payment_id, payment_url)
+            
+        Returns:
+            tuple: (payment_id, payment_url) или (None, None) при ошибке
+        """
+        stats = PaymentService._reuse_stats
+        
+        cached = PaymentService._pending_payments.get(key)
+        if cached:
+            stats["reused_cache"] += 1
+            logger.info(f"Повторно используем платеж {cached[0]} из кэша для {key}")
+            return cached
+        
+        # Такой же платеж уже создается (двойное нажатие) - ждем его
+        inflight = PaymentService._inflight_payments.get(key)
+        if inflight:
+            stats["joined_inflight"] += 1
+            logger.info(f"Ожидаем создаваемый платеж для {key}")
+            return await asyncio.shield(inflight)
+        
+        future = asyncio.get_running_loop().create_future()
+        PaymentService._inflight_payments[key] = future
+        result = (None, None)
+        
+        try:
+            reusable = await PaymentService._find_reusable_payment(*key)
+            
+            if reusable:
+                stats["reused_db"] += 1
+                payment_id, payment_url, age = reusable
+                result = (payment_id, payment_url)
+                ttl = PaymentService.PENDING_REUSE_TTL - age
+                logger.info(f"Повторно используем незавершенный платеж {payment_id} для {key}")
+            else:
+                result = await create()
+                ttl = PaymentService.PENDING_REUSE_TTL
+                if result[0]:
+                    stats["created"] += 1
+            
+            if result[0] and ttl > 0:
+                PaymentService._pending_payments.set(key, result, ttl=ttl)
+            
+            return result
+        finally:
+            future.set_result(result)
+            PaymentService._inflight_payments.pop(key, None)
+    
+    @staticmethod
+    async def _find_reusable_payment(user_id: int, plan_id: int, amount: int):
+        """
+        Ищет в БД свежий незавершенный платеж пользователя на тот же план и сумму
+        
+        Returns:
+            tuple: (payment_id, payment_url, возраст в секундах) или None
+        """
+        created_after = datetime.utcnow() - timedelta(seconds=PaymentService.PENDING_REUSE_TTL)
+        
+        async with async_session() as session:
+            result = await session.execute(
+                select(PaymentModel.payment_id, PaymentModel.confirmation_url, PaymentModel.created_at)
+                .where(
+                    (PaymentModel.user_id == user_id) &
+                    (PaymentModel.plan_id == plan_id) &
+                    (PaymentModel.amount == amount) &
+                    (PaymentModel.status == "pending") &
+                    (PaymentModel.confirmation_url.isnot(None)) &
+                    (PaymentModel.created_at >= created_after)
                 )
-                user = user_query.scalar_one_or_none()
-                
-                if not user:
-                    logger.error(f"Пользователь {user_id} не найден в БД")
-                    return None, None, None
-                
-                # Получаем план по тарифу
-                plan = await PaymentService.get_plan_by_tariff(tariff_key)
-                
-                # Применяем промокод, если он указан
-                discount_percent = 0
-                original_price = plan.price
-                
-                if promo_code:
-                    is_valid, discount_percent, promo = await PromoService.check_promo(promo_code, user.id)
-                    if is_valid:
-                        # Применяем скидку
-                        plan.price = int(plan.price * (100 - discount_percent) / 100)
-                        logger.info(f"Применен промокод {promo_code}: цена снижена с {original_price} до {plan.price} руб. (скидка {discount_percent}%)")
-                    else:
-                        logger.warning(f"Недействительный промокод {promo_code} для пользователя {user_id}")
-                
-                # Используем тестовый режим, если YooKassa не настроена или включен тестовый режим
-                if TEST_MODE or not yookassa_configured:
-                    # Создаем тестовый платеж
-                    payment_id = f"test_payment_{uuid.uuid4()}"
-                    payment_url = "https://example.com/test-payment"
-                    
-                    # Сохраняем информацию о платеже в БД
-                    db_payment = PaymentModel(
-                        user_id=user.id,
-                        plan_id=plan.id,
-                        status="pending",
-                        amount=plan.price,
-                        payment_id=payment_id
-                    )
-                    session.add(db_payment)
-                    await session.commit()
-                    
-                    # Создаем клавиатуру с кнопками для оплаты
-                    markup = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(text="✅ Тестовая оплата", callback_data=f"test_success_{payment_id}")],
-                            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_payment_{payment_id}")],
-                        ]
-                    )
-                    
-                    # Если был применен промокод, отмечаем его как использованный
-                    if promo_code and discount_percent > 0:
-                        await PromoService.use_promo(promo_code, user.id)
-                    
-                    logger.info(f"Создан тестовый платеж {payment_id} для пользователя {user_id}, тариф: {tariff_key}" + 
-                                (f", с промокодом {promo_code} (скидка {discount_percent}%)" if promo_code and discount_percent > 0 else ""))
-                    
-                    return payment_id, payment_url, markup
+                .order_by(PaymentModel.id.desc())
+                .limit(1)
+            )
+            row = result.one_or_none()
+        
+        if not row:
+            return None
+        
+        payment_id, payment_url, created_at = row
+        return payment_id, payment_url, (datetime.utcnow() - created_at).total_seconds()
+    
+    @staticmethod
+    async def _create_provider_payment(quote, contact):
+        """
+        Создает платеж в YooKassa (или тестовый) и сохраняет его в БД
+        
+        Returns:
+            tuple: (payment_id, payment_url)
+        """
+        price = quote.final_price
+        discount_percent = quote.discount_percent
+        
+        # Промокод списывается до создания платежа: расчет мог быть выдан, пока код еще действовал
+        await PaymentService._claim_promo(quote)
+        
+        try:
+            return await PaymentService._create_provider_payment_claimed(quote, contact, price, discount_percent)
+        except Exception:
+            if quote.promo_code:
+                await PromoService.release_promo(quote.promo_code)
+            raise
+    
+    @staticmethod
+    async def _claim_promo(quote):
+        """
+        Отмечает промокод расчета использованным перед созданием платежа
+        
+        Raises:
+            ValueError: Если промокод больше не действует (исчерпан, отключен или истек)
+        """
+        if quote.promo_code and not await PromoService.use_promo(quote.promo_code, quote.user_id):
+            raise ValueError(f"Промокод {quote.promo_code} больше не действует. Выберите тариф заново")
+    
+    @staticmethod
+    async def _create_provider_payment_claimed(quote, contact, price, discount_percent):
+        """Создает платеж в YooKassa (или тестовый) и сохраняет его в БД после списания промокода"""
+        # Используем тестовый режим, если YooKassa не настроена или включен тестовый режим
+        if TEST_MODE or not yookassa_configured:
+            # Создаем тестовый платеж
+            payment_id = f"test_payment_{uuid.uuid4()}"
+            payment_url = "https://example.com/test-payment"
+        else:
+            # Подготовка данных для платежа
+            payment_data = {
+                "amount": {
+                    "value": str(price),
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": PAYMENT_RETURN_URL
+                },
+                "capture": True,
+                # Сохраняем способ оплаты для автопродления
+                "save_payment_method": AUTO_RENEW_ENABLED,
+                "description": f"Оплата тарифа {quote.plan_title}" + 
+                               (f" со скидкой {discount_percent}%" if discount_percent > 0 else ""),
+                "metadata": {
+                    "tg_user_id": quote.tg_id,
+                    "tariff": quote.tariff_key,
+                    "db_user_id": quote.user_id,
+                    "plan_id": quote.plan_id,
+                    "original_price": quote.base_price,
+                    "discount_percent": discount_percent,
+                    "promo_code": quote.promo_code
+                }
+            }
+            
+            # Добавляем данные для чека, если указан контакт
+            if contact:
+                if '@' in contact:
+                    contact_type = "email"
+                else:
+                    contact_type = "phone"
+                    # Нормализация телефона (удаление символов кроме цифр)
+                    contact = ''.join(filter(str.isdigit, contact))
                 
-                # Подготовка данных для платежа
-                tariff_info = TARIFFS.get(tariff_key)
-                payment_data = {
-                    "amount": {
-                        "value": str(plan.price),
-                        "currency": "RUB"
+                payment_data["receipt"] = {
+                    "customer": {
+                        contact_type: contact
                     },
-                    "confirmation": {
-                        "type": "redirect",
-                        "return_url": PAYMENT_RETURN_URL
-                    },
-                    "capture": True,
-                    "description": f"Оплата тарифа {tariff_info['name']}" + 
-                                   (f" со скидкой {discount_percent}%" if discount_percent > 0 else ""),
-                    "metadata": {
-                        "tg_user_id": user_id,
-                        "tariff": tariff_key,
-                        "db_user_id": user.id,
-                        "plan_id": plan.id,
-                        "original_price": original_price,
-                        "discount_percent": discount_percent,
-                        "promo_code": promo_code if promo_code and discount_percent > 0 else None
-                    }
+                    "items": [
+                        {
+                            "description": f"Тариф {quote.plan_title}",
+                            "quantity": "1.00",
+                            "amount": {
+                                "value": str(price),
+                                "currency": "RUB"
+                            },
+                            "vat_code": "1",
+                            "payment_mode": "full_prepayment",
+                            "payment_subject": "service"
+                        }
+                    ]
                 }
-                
-                # Добавляем данные для чека, если указан контакт
-                if contact:
-                    if '@' in contact:
-                        contact_type = "email"
-                    else:
-                        contact_type = "phone"
-                        # Нормализация телефона (удаление символов кроме цифр)
-                        contact = ''.join(filter(str.isdigit, contact))
-                    
-                    payment_data["receipt"] = {
-                        "customer": {
-                            contact_type: contact
-                        },
+            
+            # Создаем платеж в YooKassa
+            payment = await asyncio.to_thread(Payment.create, payment_data)
+            payment_id = payment.id
+            payment_url = payment.confirmation.confirmation_url
+        
+        # Сохраняем информацию о платеже в БД
+        async with async_session() as session:
+            db_payment = PaymentModel(
+                user_id=quote.user_id,
+                plan_id=quote.plan_id,
+                status="pending",
+                amount=price,
+                payment_id=payment_id,
+                confirmation_url=payment_url
+            )
+            session.add(db_payment)
+            await session.commit()
+        
+        logger.info(f"Создан платеж {payment_id} для пользователя {quote.tg_id}, тариф: {quote.tariff_key}" + 
+                    (f", с промокодом {quote.promo_code} (скидка {discount_percent}%)" if quote.promo_code else ""))
+        
+        return payment_id, payment_url
+    
+    @staticmethod
+    def _build_payment_markup(payment_id: str, payment_url: str) -> InlineKeyboardMarkup:
+        """Создает клавиатуру с кнопками для оплаты"""
+        if payment_id.startswith("test_payment_"):
+            return InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [InlineKeyboardButton(text="✅ Тестовая оплата", callback_data=f"test_success_{payment_id}")],
+                    [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_payment_{payment_id}")],
+                ]
+            )
+        
+        return InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="💳 Оплатить", url=payment_url)],
+                [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_payment_{payment_id}")],
+            ]
+        )
+    
+    @staticmethod
+    def get_reuse_stats() -> dict:
+        """
+        Возвращает счетчики повторного использования незавершенных платежей
+        
+        created - новые платежи в YooKassa, остальные - сэкономленные вызовы
+        """
+        stats = dict(PaymentService._reuse_stats)
+        reused = stats["reused_cache"] + stats["reused_db"] + stats["joined_inflight"]
+        total = reused + stats["created"]
+        stats["saved_ratio"] = round(reused / total, 3) if total else 0.0
+        stats["cache"] = PaymentService._pending_payments.stats()
+        return stats
+    
+    @staticmethod
+    def get_payment_method(tariff_key: str) -> str:
+        """
+        Возвращает способ оплаты тарифа
+        
+        Args:
+            tariff_key: Ключ тарифа
+            
+        Returns:
+            str: "invoice" для счета Telegram или "redirect" для страницы YooKassa
+        """
+        plan = PlanRegistry.get_by_key(tariff_key)
+        method = (plan.payment_method if plan else None) or "redirect"
+        
+        if method == "invoice" and not TELEGRAM_PAYMENT_PROVIDER_TOKEN:
+            logger.warning(f"Для тарифа {tariff_key} выбран счет Telegram, но токен провайдера не задан")
+            return "redirect"
+        
+        return method
+    
+    @staticmethod
+    async def create_invoice(quote, chat_id: int, bot, contact: str = None):
+        """
+        Создает платеж в БД и отправляет пользователю счет Telegram
+        
+        Результат оплаты приходит событием successful_payment, поэтому
+        такие платежи не опрашиваются в YooKassa.
+        
+        Args:
+            quote: Расчет покупки (CheckoutQuote)
+            chat_id: ID чата для отправки счета
+            bot: Экземпляр бота
+            contact: Email для чека (опционально)
+            
+        Returns:
+            str: ID платежа или None при ошибке
+            
+        Raises:
+            ValueError: Если промокод расчета больше не действует
+        """
+        # Промокод списывается до выставления счета: расчет мог быть выдан, пока код еще действовал
+        await PaymentService._claim_promo(quote)
+        
+        try:
+            price = quote.final_price
+            payment_id = f"{PaymentService.INVOICE_PREFIX}{uuid.uuid4()}"
+            
+            # Данные для чека передаются провайдеру через provider_data
+            provider_data = None
+            if contact and '@' in contact:
+                provider_data = json.dumps({
+                    "receipt": {
+                        "customer": {"email": contact},
                         "items": [
                             {
-                                "description": f"Тариф {tariff_info['name']}",
+                                "description": f"Тариф {quote.plan_title}",
                                 "quantity": "1.00",
                                 "amount": {
-                                    "value": str(plan.price),
+                                    "value": f"{price:.2f}",
                                     "currency": "RUB"
                                 },
-                                "vat_code": "1",
+                                "vat_code": 1,
                                 "payment_mode": "full_prepayment",
                                 "payment_subject": "service"
                             }
                         ]
                     }
-                
-                # Создаем платеж в YooKassa
-                payment = Payment.create(payment_data)
-                payment_id = payment.id
-                payment_url = payment.confirmation.confirmation_url
-                
-                # Сохраняем информацию о платеже в БД
+                })
+            
+            # Сохраняем информацию о платеже в БД до отправки счета
+            async with async_session() as session:
                 db_payment = PaymentModel(
-                    user_id=user.id,
-                    plan_id=plan.id,
+                    user_id=quote.user_id,
+                    plan_id=quote.plan_id,
                     status="pending",
-                    amount=plan.price,
+                    amount=price,
                     payment_id=payment_id
                 )
                 session.add(db_payment)
                 await session.commit()
-                
-                # Создаем клавиатуру с кнопками для оплаты
-                markup = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text="💳 Оплатить", url=payment_url)],
-                        [InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_payment_{payment_id}")],
-                    ]
-                )
-                
-                # Если был применен промокод, отмечаем его как использованный
-                if promo_code and discount_percent > 0:
-                    await PromoService.use_promo(promo_code, user.id)
-                
-                logger.info(f"Создан платеж {payment_id} для пользователя {user_id}, тариф: {tariff_key}" + 
-                            (f", с промокодом {promo_code} (скидка {discount_percent}%)" if promo_code and discount_percent > 0 else ""))
-                
-                return payment_id, payment_url, markup
-                
+            
+            await bot.send_invoice(
+                chat_id=chat_id,
+                title=f"Тариф {quote.plan_title}",
+                description=f"Подписка {quote.plan_title} на {quote.duration_days} дней" +
+                            (f" со скидкой {quote.discount_percent}%" if quote.promo_code else ""),
+                payload=payment_id,
+                provider_token=TELEGRAM_PAYMENT_PROVIDER_TOKEN,
+                currency="RUB",
+                prices=[LabeledPrice(label=f"Тариф {quote.plan_title}", amount=price * 100)],
+                provider_data=provider_data
+            )
+            
+            logger.info(f"Отправлен счет {payment_id} пользователю {quote.tg_id}, тариф: {quote.tariff_key}" +
+                        (f", с промокодом {quote.promo_code} (скидка {quote.discount_percent}%)" if quote.promo_code else ""))
+            
+            return payment_id
+            
         except Exception as e:
-            logger.error(f"Ошибка при создании платежа для пользователя {user_id}: {e}")
-            return None, None, None
+            logger.error(f"Ошибка при создании счета для пользователя {quote.tg_id}: {e}")
+            if quote.promo_code:
+                await PromoService.release_promo(quote.promo_code)
+            return None
+    
+    @staticmethod
+    async def validate_invoice(payment_id: str, total_amount: int, currency: str):
+        """
+        Проверяет счет перед списанием (pre_checkout_query)
+        
+        Args:
+            payment_id: ID платежа из payload счета
+            total_amount: Сумма в копейках
+            currency: Валюта
+            
+        Returns:
+            tuple: (ok, error_message)
+        """
+        async with async_session() as session:
+            payment_query = await session.execute(
+                select(PaymentModel.status, PaymentModel.amount).where(PaymentModel.payment_id == payment_id)
+            )
+            row = payment_query.one_or_none()
+        
+        if not row:
+            logger.warning(f"Счет {payment_id} не найден в БД")
+            return False, "Счет не найден. Выберите тариф заново."
+        
+        status, amount = row
+        if status not in PaymentService.OPEN_STATUSES:
+            logger.warning(f"Счет {payment_id} уже в статусе {status}")
+            return False, "Счет уже оплачен или отменен."
+        
+        if currency != "RUB" or total_amount != amount * 100:
+            logger.warning(f"Сумма счета {payment_id} не совпадает: {total_amount} {currency}, ожидалось {amount * 100} RUB")
+            return False, "Сумма счета изменилась. Выберите тариф заново."
+        
+        return True, None
     
     @staticmethod
     async def schedule_payment_checking(payment_id: str, bot):
@@ -323,97 +603,61 @@ class PaymentService:
             for interval, duration in schedule:
                 # Проверяем, не превысили ли мы длительность текущего этапа
                 while (datetime.now() - start_time).total_seconds() < elapsed_time + duration:
-                    # Проверяем платеж
+                    # Получаем платеж из БД
                     async with async_session() as session:
-                        # Получаем платеж из БД
                         result = await session.execute(
-                            select(PaymentModel).filter(PaymentModel.payment_id == payment_id)
+                            select(PaymentModel.status).filter(PaymentModel.payment_id == payment_id)
                         )
-                        payment = result.scalars().first()
-                        
-                        if not payment:
-                            logger.error(f"Платеж {payment_id} не найден в базе данных")
-                            return
-                        
-                        # Если платеж уже в финальном статусе, завершаем проверку
-                        if payment.status in ["succeeded", "canceled"]:
-                            logger.info(f"Платеж {payment_id} уже в финальном статусе: {payment.status}")
-                            return
-                        
-                        # Получаем актуальный статус платежа из YooKassa
-                        if not yookassa_configured and not TEST_MODE:
-                            logger.warning("YooKassa не настроена, пропускаем проверку платежа")
-                            return
-                        
-                        try:
-                            # Для тестовых платежей просто продолжаем ждать
-                            if payment_id.startswith("test_payment_"):
-                                logger.info(f"Тестовый платеж {payment_id}, ждем действий пользователя")
-                            else:
-                                # Получаем информацию о платеже из YooKassa
-                                payment_info = Payment.find_one(payment_id)
-                                
-                                if not payment_info:
-                                    logger.warning(f"Платеж {payment_id} не найден в YooKassa")
-                                    # Ждем указанный интервал перед следующей проверкой
-                                    await asyncio.sleep(interval)
-                                    continue
-                                
-                                logger.info(f"Платеж {payment_id}: Статус в YooKassa - {payment_info.status}, Статус в БД - {payment.status}")
+                        db_status = result.scalars().first()
+                    
+                    if not db_status:
+                        logger.error(f"Платеж {payment_id} не найден в базе данных")
+                        return
+                    
+                    # Если платеж уже в финальном статусе, завершаем проверку
+                    if db_status in ["succeeded", "canceled"]:
+                        logger.info(f"Платеж {payment_id} уже в финальном статусе: {db_status}")
+                        return
+                    
+                    # Получаем актуальный статус платежа из YooKassa
+                    if not yookassa_configured and not TEST_MODE:
+                        logger.warning("YooKassa не настроена, пропускаем проверку платежа")
+                        return
+                    
+                    try:
+                        # Для тестовых платежей просто продолжаем ждать
+                        if payment_id.startswith("test_payment_"):
+                            logger.info(f"Тестовый платеж {payment_id}, ждем действий пользователя")
+                        else:
+                            # Получаем информацию о платеже из YooKassa
+                            payment_info = await asyncio.to_thread(Payment.find_one, payment_id)
+                            
+                            if not payment_info:
+                                logger.warning(f"Платеж {payment_id} не найден в YooKassa")
+                                # Ждем указанный интервал перед следующей проверкой
+                                await asyncio.sleep(interval)
+                                continue
+                            
+                            logger.info(f"Платеж {payment_id}: Статус в YooKassa - {payment_info.status}, Статус в БД - {db_status}")
+                            
+                            # Если платеж успешно оплачен, активируем тариф (ровно один раз)
+                            if payment_info.status == "succeeded" and payment_info.paid:
+                                await PaymentService.activate_payment(
+                                    payment_id, bot, source="checker",
+                                    payment_method_id=PaymentService.get_saved_payment_method_id(payment_info)
+                                )
+                                return
+                            
+                            # Если статус платежа изменился, обновляем в БД
+                            if payment_info.status != db_status:
+                                await PaymentService.update_payment_status(payment_id, payment_info.status)
                                 
-                                # Если статус платежа изменился, обновляем в БД
-                                if payment_info.status != payment.status:
-                                    old_status = payment.status
-                                    payment.status = payment_info.status
-                                    
-                                    # Если платеж успешно оплачен, устанавливаем время оплаты и обновляем клиента
-                                    if payment_info.status == "succeeded" and payment_info.paid:
-                                        payment.paid_at = datetime.now()
-                                        logger.info(f"Платеж {payment_id} успешно оплачен. Статус изменен с {old_status} на {payment_info.status}")
-                                        
-                                        # Получаем информацию о пользователе для уведомления
-                                        user_query = await session.execute(
-                                            select(User).where(User.id == payment.user_id)
-                                        )
-                                        user = user_query.scalar_one_or_none()
-                                        
-                                        if user:
-                                            # Получаем информацию о плане
-                                            plan_query = await session.execute(
-                                                select(Plan).where(Plan.id == payment.plan_id)
-                                            )
-                                            plan = plan_query.scalar_one_or_none()
-                                            
-                                            # Обновляем клиента в соответствии с тарифом
-                                            await PaymentService.update_client_after_payment(session, user.id, plan)
-                                            
-                                            plan_info = f"«{plan.title}»" if plan else ""
-                                            
-                                            # Отправляем уведомление пользователю
-                                            try:
-                                                await bot.send_message(
-                                                    user.tg_id,
-                                                    f"✅ Оплата успешно выполнена!\n\n"
-                                                    f"Ваш тариф {plan_info} активирован.\n"
-                                                    f"Сумма: {payment.amount} ₽"
-                                                )
-                                                logger.info(f"Отправлено уведомление пользователю {user.tg_id} об успешной оплате")
-                                            except Exception as e:
-                                                logger.error(f"Ошибка отправки уведомления пользователю {user.tg_id}: {e}")
-                                        
-                                        # Завершаем проверку, так как платеж успешно обработан
-                                        await session.commit()
-                                        return
-                                    
-                                    elif payment_info.status == "canceled":
-                                        logger.info(f"Платеж {payment_id} отменен. Статус изменен с {old_status} на {payment_info.status}")
-                                        await session.commit()
-                                        return
-                                    
-                                    await session.commit()
-                        
-                        except Exception as e:
-                            logger.error(f"Ошибка при проверке платежа {payment_id}: {e}")
+                                if payment_info.status == "canceled":
+                                    logger.info(f"Платеж {payment_id} отменен. Статус изменен с {db_status} на {payment_info.status}")
+                                    return
+                    
+                    except Exception as e:
+                        logger.error(f"Ошибка при проверке платежа {payment_id}: {e}")
                     
                     # Ждем указанный интервал перед следующей проверкой
                     await asyncio.sleep(interval)
@@ -443,21 +687,14 @@ class PaymentService:
             bool: True если успешно, False при ошибке
         """
         try:
-            # Для тестовых платежей просто обновляем статус в БД
-            if payment_id.startswith("test_payment_"):
-                async with async_session() as session:
-                    payment_query = await session.execute(
-                        select(PaymentModel).where(PaymentModel.payment_id == payment_id)
-                    )
-                    db_payment = payment_query.scalar_one_or_none()
-                    
-                    if db_payment:
-                        db_payment.status = "canceled"
-                        await session.commit()
-                        logger.info(f"Тестовый платеж {payment_id} отменен")
-                        return True
-                    
-                    return False
+            # Для тестовых платежей и счетов Telegram просто обновляем статус в БД
+            # (оплаченный платеж отменить нельзя - статус меняется только у незавершенных)
+            if payment_id.startswith(("test_payment_", PaymentService.INVOICE_PREFIX)):
+                if await PaymentService.update_payment_status(payment_id, "canceled"):
+                    logger.info(f"Платеж {payment_id} отменен без обращения к YooKassa")
+                    return True
+                
+                return False
             
             # Для реальных платежей через YooKassa
             if yookassa_configured:
@@ -468,19 +705,11 @@ class PaymentService:
                     logger.warning(f"Не удалось отменить платеж в YooKassa: {e}")
             
             # В любом случае обновляем статус в БД
-            async with async_session() as session:
-                payment_query = await session.execute(
-                    select(PaymentModel).where(PaymentModel.payment_id == payment_id)
-                )
-                db_payment = payment_query.scalar_one_or_none()
-                
-                if db_payment:
-                    db_payment.status = "canceled"
-                    await session.commit()
-                    logger.info(f"Платеж {payment_id} отменен в БД")
-                    return True
-                
-                return False
+            if await PaymentService.update_payment_status(payment_id, "canceled"):
+                logger.info(f"Платеж {payment_id} отменен в БД")
+                return True
+            
+            return False
                 
         except Exception as e:
             logger.error(f"Ошибка при отмене платежа {payment_id}: {e}")
@@ -495,40 +724,24 @@ class PaymentService:
             payment_id: ID тестового платежа
             
         Returns:
-            bool: True если успешно обработано
+            bool: True если платеж оплачен (этим или одним из параллельных вызовов)
         """
         try:
+            if await PaymentService.activate_payment(payment_id, source="callback"):
+                logger.info(f"Тестовый платеж {payment_id} успешно обработан")
+                return True
+            
+            # Платеж мог быть уже активирован другим обработчиком - это не ошибка
             async with async_session() as session:
-                payment_query = await session.execute(
-                    select(PaymentModel).where(PaymentModel.payment_id == payment_id)
-                )
-                db_payment = payment_query.scalar_one_or_none()
-                
-                if not db_payment:
-                    logger.warning(f"Платеж {payment_id} не найден в БД")
-                    return False
-                
-                # Устанавливаем статус succeeded и время оплаты
-                old_status = db_payment.status
-                db_payment.status = "succeeded"
-                db_payment.paid_at = datetime.now()
-                
-                # Получаем информацию о плане для обновления клиента
-                plan_query = await session.execute(
-                    select(Plan).where(Plan.id == db_payment.plan_id)
+                status_query = await session.execute(
+                    select(PaymentModel.status).where(PaymentModel.payment_id == payment_id)
                 )
-                plan = plan_query.scalar_one_or_none()
-                
-                if plan:
-                    # Обновляем клиента в соответствии с тарифом
-                    await PaymentService.update_client_after_payment(session, db_payment.user_id, plan)
-                else:
-                    logger.warning(f"План не найден для платежа {payment_id}")
-                
-                await session.commit()
-                
-                logger.info(f"Тестовый платеж {payment_id} успешно обработан: статус изменен с {old_status} на succeeded")
-                return True
+                status = status_query.scalar_one_or_none()
+            
+            if status is None:
+                logger.warning(f"Платеж {payment_id} не найден в БД")
+            
+            return status == "succeeded"
                 
         except Exception as e:
             logger.error(f"Ошибка при обработке тестового платежа {payment_id}: {e}")
@@ -565,53 +778,30 @@ class PaymentService:
                 logger.warning(f"Неподдерживаемый тип события: {event}")
                 return False
                 
-            # Находим платеж в базе данных
-            async with async_session() as session:
-                payment_query = await session.execute(
-                    select(PaymentModel).where(PaymentModel.payment_id == payment_id)
-                )
-                db_payment = payment_query.scalar_one_or_none()
-                
-                if not db_payment:
-                    logger.warning(f"Платеж {payment_id} не найден в БД")
-                    return False
-                    
-                # Обновляем статус платежа
-                old_status = db_payment.status
-                db_payment.status = status
-                
-                # Если платеж успешно завершен, устанавливаем время оплаты
-                if status == "succeeded" and paid:
-                    db_payment.paid_at = datetime.now()
-                    logger.info(f"Платеж {payment_id} успешно оплачен. Статус изменен с {old_status} на {status}")
-                    
-                    # Получаем информацию о плане для обновления клиента
-                    plan_query = await session.execute(
-                        select(Plan).where(Plan.id == db_payment.plan_id)
-                    )
-                    plan = plan_query.scalar_one_or_none()
-                    
-                    if plan:
-                        # Обновляем клиента в соответствии с тарифом
-                        await PaymentService.update_client_after_payment(session, db_payment.user_id, plan)
-                    else:
-                        logger.warning(f"План не найден для платежа {payment_id}")
-                    
-                    # Дополнительно проверяем статус из API YooKassa для подтверждения
-                    if yookassa_configured:
-                        try:
-                            payment_info = Payment.find_one(payment_id)
-                            if payment_info and payment_info.status == "succeeded" and payment_info.paid:
-                                logger.info(f"Подтверждено через API: платеж {payment_id} в статусе succeeded и оплачен")
-                            else:
-                                logger.warning(f"Несоответствие данных: webhook={status}/{paid}, API={payment_info.status if payment_info else 'None'}/{payment_info.paid if payment_info else 'None'}")
-                        except Exception as e:
-                            logger.warning(f"Ошибка при проверке платежа через API: {e}")
-                else:
-                    logger.info(f"Статус платежа {payment_id} изменен с {old_status} на {status}, paid={paid}")
+            # Если платеж успешно завершен, активируем тариф (ровно один раз)
+            if status == "succeeded" and paid:
+                # Дополнительно проверяем статус из API YooKassa для подтверждения
+                if yookassa_configured:
+                    try:
+                        payment_info = await asyncio.to_thread(Payment.find_one, payment_id)
+                        if payment_info and payment_info.status == "succeeded" and payment_info.paid:
+                            logger.info(f"Подтверждено через API: платеж {payment_id} в статусе succeeded и оплачен")
+                        else:
+                            logger.warning(f"Несоответствие данных: webhook={status}/{paid}, API={payment_info.status if payment_info else 'None'}/{payment_info.paid if payment_info else 'None'}")
+                    except Exception as e:
+                        logger.warning(f"Ошибка при проверке платежа через API: {e}")
                 
-                await session.commit()
+                payment_method = payment.get("payment_method") or {}
+                await PaymentService.activate_payment(
+                    payment_id, source="webhook",
+                    payment_method_id=payment_method.get("id") if payment_method.get("saved") else None
+                )
                 return True
+            
+            updated = await PaymentService.update_payment_status(payment_id, status)
+            logger.info(f"Статус платежа {payment_id} изменен на {status}, paid={paid}" if updated
+                        else f"Платеж {payment_id} не найден в БД или уже в финальном статусе")
+            return True
                 
         except Exception as e:
             logger.error(f"Ошибка при обработке уведомления от YooKassa: {e}")
@@ -622,6 +812,9 @@ class PaymentService:
         """
         Проверяет все незавершенные платежи и обновляет их статус
         
+        Проверки выполняются параллельно: повторная активация исключена
+        атомарным захватом платежа в activate_payment.
+        
         Args:
             bot: Экземпляр бота для отправки уведомлений
         """
@@ -629,90 +822,328 @@ class PaymentService:
             # Получаем все незавершенные платежи из БД
             async with async_session() as session:
                 result = await session.execute(
-                    select(PaymentModel).where(
-                        PaymentModel.status.in_(["pending", "waiting_for_capture"])
+                    select(PaymentModel.payment_id, PaymentModel.status).where(
+                        PaymentModel.status.in_(PaymentService.OPEN_STATUSES)
                     )
                 )
-                payments = result.scalars().all()
-                
-                if payments:
-                    logger.info(f"Найдено {len(payments)} незавершенных платежей")
-                    
-                    for payment in payments:
-                        # Пропускаем тестовые платежи - ими пользователь управляет вручную
-                        if payment.payment_id.startswith("test_payment_"):
-                            continue
-                            
-                        # Получаем информацию о платеже из YooKassa
-                        try:
-                            if not yookassa_configured:
-                                logger.warning("YooKassa не настроена, пропускаем проверку платежа")
-                                continue
-                                
-                            payment_info = Payment.find_one(payment.payment_id)
-                            
-                            if not payment_info:
-                                logger.warning(f"Платеж {payment.payment_id} не найден в YooKassa")
-                                continue
-                            
-                            logger.info(f"Платеж {payment.payment_id}: YooKassa статус={payment_info.status}, БД статус={payment.status}")
-                            
-                            # Если статус платежа изменился, обновляем в БД
-                            if payment_info.status != payment.status:
-                                old_status = payment.status
-                                payment.status = payment_info.status
-                                
-                                # Если платеж успешно оплачен
-                                if payment_info.status == "succeeded" and payment_info.paid:
-                                    payment.paid_at = datetime.now()
-                                    logger.info(f"Платеж {payment.payment_id} успешно оплачен. Статус изменен с {old_status} на {payment_info.status}")
-                                    
-                                    # Получаем пользователя
-                                    user_query = await session.execute(
-                                        select(User).where(User.id == payment.user_id)
-                                    )
-                                    user = user_query.scalar_one_or_none()
-                                    
-                                    if user:
-                                        # Получаем план
-                                        plan_query = await session.execute(
-                                            select(Plan).where(Plan.id == payment.plan_id)
-                                        )
-                                        plan = plan_query.scalar_one_or_none()
-                                        
-                                        # Обновляем клиента
-                                        await PaymentService.update_client_after_payment(session, user.id, plan)
-                                        
-                                        # Отправляем уведомление пользователю
-                                        plan_info = f"«{plan.title}»" if plan else ""
-                                        try:
-                                            await bot.send_message(
-                                                user.tg_id,
-                                                f"✅ Оплата успешно выполнена!\n\n"
-                                                f"Ваш тариф {plan_info} активирован.\n"
-                                                f"Сумма: {payment.amount} ₽"
-                                            )
-                                            logger.info(f"Отправлено уведомление пользователю {user.tg_id} об успешной оплате")
-                                        except Exception as e:
-                                            logger.error(f"Ошибка отправки уведомления пользователю {user.tg_id}: {e}")
-                                
-                                # Если платеж отменен
-                                elif payment_info.status == "canceled":
-                                    logger.info(f"Платеж {payment.payment_id} отменен. Статус изменен с {old_status} на {payment_info.status}")
-                                
-                                # Сохраняем изменения
-                                await session.commit()
-                        except Exception as e:
-                            logger.error(f"Ошибка при проверке платежа {payment.payment_id}: {e}")
-                else:
-                    logger.debug("Нет незавершенных платежей")
+                payments = result.all()
+            
+            if not payments:
+                logger.debug("Нет незавершенных платежей")
+                return
+            
+            logger.info(f"Найдено {len(payments)} незавершенных платежей")
+            
+            if not yookassa_configured:
+                logger.warning("YooKassa не настроена, пропускаем проверку платежей")
+                return
+            
+            semaphore = asyncio.Semaphore(PaymentService.CHECK_CONCURRENCY)
+            
+            async def check_one(payment_id, db_status):
+                async with semaphore:
+                    await PaymentService._check_single_payment(payment_id, db_status, bot)
+            
+            # Пропускаем тестовые платежи - ими пользователь управляет вручную,
+            # и счета Telegram - их оплата приходит событием successful_payment
+            await asyncio.gather(*(
+                check_one(payment_id, db_status)
+                for payment_id, db_status in payments
+                if not payment_id.startswith(("test_payment_", PaymentService.INVOICE_PREFIX))
+            ))
         except Exception as e:
             logger.error(f"Ошибка при проверке платежей: {e}")
             import traceback
             logger.error(traceback.format_exc())
     
     @staticmethod
-    async def update_client_after_payment(session, user_id, plan):
+    async def _check_single_payment(payment_id: str, db_status: str, bot):
+        """
+        Сверяет статус одного платежа с YooKassa
+        
+        Args:
+            payment_id: ID платежа в YooKassa
+            db_status: Статус платежа в БД на момент выборки
+            bot: Экземпляр бота для отправки уведомлений
+        """
+        try:
+            payment_info = await asyncio.to_thread(Payment.find_one, payment_id)
+            
+            if not payment_info:
+                logger.warning(f"Платеж {payment_id} не найден в YooKassa")
+                return
+            
+            logger.info(f"Платеж {payment_id}: YooKassa статус={payment_info.status}, БД статус={db_status}")
+            
+            # Если платеж успешно оплачен
+            if payment_info.status == "succeeded" and payment_info.paid:
+                await PaymentService.activate_payment(
+                    payment_id, bot, source="poller",
+                    payment_method_id=PaymentService.get_saved_payment_method_id(payment_info)
+                )
+            
+            # Если статус платежа изменился, обновляем в БД
+            elif payment_info.status != db_status:
+                if await PaymentService.update_payment_status(payment_id, payment_info.status):
+                    logger.info(f"Статус платежа {payment_id} изменен с {db_status} на {payment_info.status}")
+        except Exception as e:
+            logger.error(f"Ошибка при проверке платежа {payment_id}: {e}")
+    
+    @staticmethod
+    def get_saved_payment_method_id(payment_info):
+        """Возвращает ID сохраненного способа оплаты из ответа YooKassa или None"""
+        payment_method = getattr(payment_info, "payment_method", None)
+        if payment_method is not None and getattr(payment_method, "saved", False):
+            return payment_method.id
+        return None
+    
+    @staticmethod
+    async def _claim_payment(session, payment_id: str, new_status: str, paid_at=None, provider_payment_id: str = None) -> bool:
+        """
+        Атомарно переводит платеж из незавершенного статуса в new_status
+        
+        Условный UPDATE срабатывает только для одного из конкурирующих
+        обработчиков, остальные получают rowcount == 0.
+        
+        Args:
+            session: Активная сессия SQLAlchemy
+            payment_id: ID платежа
+            new_status: Новый статус платежа
+            paid_at: Время оплаты в UTC (для succeeded)
+            provider_payment_id: ID платежа у провайдера (для счетов Telegram)
+            
+        Returns:
+            bool: True если платеж захвачен этим вызовом
+        """
+        values = {"status": new_status}
+        if paid_at:
+            values["paid_at"] = paid_at
+        if provider_payment_id:
+            values["provider_payment_id"] = provider_payment_id
+        
+        result = await session.execute(
+            update(PaymentModel)
+            .where(
+                (PaymentModel.payment_id == payment_id) &
+                (PaymentModel.status.in_(PaymentService.OPEN_STATUSES))
+            )
+            .values(**values)
+        )
+        
+        claimed = result.rowcount == 1
+        if claimed:
+            # Платеж больше не может быть выдан повторно
+            PaymentService._pending_payments.discard_where(lambda cached: cached[0] == payment_id)
+        
+        return claimed
+    
+    @staticmethod
+    async def update_payment_status(payment_id: str, status: str) -> bool:
+        """
+        Обновляет статус незавершенного платежа (кроме успешной оплаты)
+        
+        Args:
+            payment_id: ID платежа
+            status: Новый статус из YooKassa
+            
+        Returns:
+            bool: True если статус обновлен
+        """
+        if status == "succeeded":
+            raise ValueError("Успешные платежи обрабатываются через activate_payment")
+        
+        async with async_session() as session:
+            updated = await PaymentService._claim_payment(session, payment_id, status)
+            await session.commit()
+            return updated
+    
+    @staticmethod
+    async def activate_payment(payment_id: str, bot=None, source: str = "poller", provider_payment_id: str = None,
+                               payment_method_id: str = None) -> bool:
+        """
+        Помечает платеж оплаченным и активирует тариф ровно один раз
+        
+        Захват платежа и запись об активации фиксируются в одной транзакции,
+        поэтому параллельные проверки, поллер и callback могут вызывать метод
+        одновременно - клиент обновится и уведомление уйдет только один раз.
+        
+        Args:
+            payment_id: ID платежа
+            bot: Экземпляр бота для уведомления пользователя (опционально)
+            source: Источник активации для журнала
+            provider_payment_id: ID платежа у провайдера (для счетов Telegram)
+            payment_method_id: Сохраненный способ оплаты для автопродления (опционально)
+            
+        Returns:
+            bool: True если этот вызов захватил платеж и клиент обновлен
+        """
+        try:
+            async with async_session() as session:
+                if not await PaymentService._claim_payment(session, payment_id, "succeeded", datetime.utcnow(), provider_payment_id):
+                    await session.rollback()
+                    logger.info(f"Платеж {payment_id} уже обработан или не найден ({source})")
+                    return False
+                
+                payment_query = await session.execute(
+                    select(PaymentModel).where(PaymentModel.payment_id == payment_id)
+                )
+                db_payment = payment_query.scalar_one()
+                
+                activation = PaymentActivation(
+                    payment_id=payment_id,
+                    user_id=db_payment.user_id,
+                    plan_id=db_payment.plan_id,
+                    source=source
+                )
+                session.add(activation)
+                
+                if payment_method_id:
+                    await session.execute(
+                        update(User)
+                        .where(User.id == db_payment.user_id)
+                        .values(payment_method_id=payment_method_id)
+                    )
+                
+                # Счетчики статистики фиксируются вместе с захватом платежа
+                await PlanRegistry.ensure_loaded()
+                plan = PlanRegistry.get_by_id(db_payment.plan_id)
+                await StatsService.record_payment(
+                    session, db_payment.user_id, plan.tariff_id if plan else 0, db_payment.amount, payment_id
+                )
+                
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    await session.rollback()
+                    logger.info(f"Активация платежа {payment_id} уже записана другим обработчиком ({source})")
+                    return False
+                
+                logger.info(f"Платеж {payment_id} захвачен для активации ({source})")
+                
+                return await PaymentService._complete_activation(session, activation, db_payment, plan, bot)
+                
+        except Exception as e:
+            logger.error(f"Ошибка при активации платежа {payment_id}: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return False
+    
+    @staticmethod
+    async def _complete_activation(session, activation, db_payment, plan, bot=None) -> bool:
+        """
+        Обновляет клиента по захваченному платежу и уведомляет пользователя
+        
+        completed_at записывается в одной транзакции с обновлением клиента,
+        поэтому повторная попытка после сбоя не продлит подписку второй раз.
+        
+        Args:
+            session: Активная сессия SQLAlchemy
+            activation: Запись PaymentActivation
+            db_payment: Оплаченный платеж
+            plan: План платежа
+            bot: Экземпляр бота для уведомления пользователя (опционально)
+            
+        Returns:
+            bool: True если клиент обновлен
+        """
+        payment_id = db_payment.payment_id
+        
+        # Получаем пользователя и план
+        user_query = await session.execute(
+            select(User).where(User.id == db_payment.user_id)
+        )
+        user = user_query.scalar_one_or_none()
+        
+        if user:
+            FunnelService.emit(user.tg_id, FunnelService.PAID)
+        
+        if not plan:
+            logger.warning(f"План не найден для платежа {payment_id}")
+        
+        # Обновляем клиента в соответствии с тарифом
+        # (списание автопродления продлевает подписку, а не начинает новый срок)
+        updated = await PaymentService.update_client_after_payment(
+            session, db_payment.user_id, plan, extend=bool(db_payment.is_renewal), activation=activation
+        )
+        
+        if not updated:
+            # Оплата есть, а тариф не выдан - активация будет повторена retry_incomplete_activations
+            logger.error(f"Тариф по платежу {payment_id} не активирован, активация будет повторена")
+            return False
+        
+        # Отправляем уведомление пользователю
+        if bot and user:
+            plan_info = f"«{plan.title}»" if plan else ""
+            try:
+                await MessageGateway.send_message(
+                    bot,
+                    user.tg_id,
+                    f"✅ Оплата успешно выполнена!\n\n"
+                    f"Ваш тариф {plan_info} активирован.\n"
+                    f"Сумма: {db_payment.amount} ₽",
+                    priority=MessageGateway.PRIORITY_PAYMENT
+                )
+                logger.info(f"Отправлено уведомление пользователю {user.tg_id} об успешной оплате")
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомления пользователю {user.tg_id}: {e}")
+        
+        return True
+    
+    @staticmethod
+    async def retry_incomplete_activations(bot=None) -> int:
+        """
+        Повторяет активацию оплаченных платежей, по которым клиент не был обновлен
+        
+        Такие активации остаются без completed_at, если VPN сервер или БД были
+        недоступны или бот перезапустился после захвата платежа.
+        
+        Args:
+            bot: Экземпляр бота для уведомления пользователей (опционально)
+            
+        Returns:
+            int: Количество завершенных активаций
+        """
+        stale = datetime.utcnow() - timedelta(seconds=PaymentService.ACTIVATION_RETRY_DELAY)
+        
+        async with async_session() as session:
+            result = await session.execute(
+                select(PaymentActivation.id).where(
+                    (PaymentActivation.completed_at.is_(None)) &
+                    (PaymentActivation.created_at < stale)
+                )
+            )
+            activation_ids = result.scalars().all()
+        
+        if not activation_ids:
+            return 0
+        
+        logger.warning(f"Найдено {len(activation_ids)} незавершенных активаций платежей, повторяем")
+        await PlanRegistry.ensure_loaded()
+        completed = 0
+        
+        for activation_id in activation_ids:
+            try:
+                async with async_session() as session:
+                    activation = await session.get(PaymentActivation, activation_id)
+                    if activation is None or activation.completed_at is not None:
+                        continue
+                    
+                    payment_query = await session.execute(
+                        select(PaymentModel).where(PaymentModel.payment_id == activation.payment_id)
+                    )
+                    db_payment = payment_query.scalar_one()
+                    plan = PlanRegistry.get_by_id(db_payment.plan_id)
+                    
+                    if await PaymentService._complete_activation(session, activation, db_payment, plan, bot):
+                        completed += 1
+                        logger.info(f"Активация платежа {activation.payment_id} завершена повторно")
+            except Exception as e:
+                logger.error(f"Ошибка при повторной активации {activation_id}: {e}")
+        
+        return completed
+    
+    @staticmethod
+    async def update_client_after_payment(session, user_id, plan, extend: bool = False, activation=None):
         """
         Обновляет информацию о клиенте после успешной оплаты
         
@@ -720,6 +1151,8 @@ class PaymentService:
             session: Активная сессия SQLAlchemy
             user_id: ID пользователя в БД
             plan: Объект плана с информацией о тарифе
+            extend: Продлить от текущего окончания подписки, если она еще действует (автопродление)
+            activation: Запись PaymentActivation - completed_at фиксируется вместе с клиентом
         """
         try:
             # Находим клиента пользователя
@@ -744,37 +1177,40 @@ class PaymentService:
             logger.info(f"План для обновления: title={plan.title}, "
                         f"traffic_limit={plan.traffic_limit}, duration_days={plan.duration_days}")
             
-            # Определяем лимит IP в зависимости от тарифа
-            limit_ip = 3  # Базовый лимит
-            tariff_id = 0  # Начальный тариф ftw.none по умолчанию
+            # Лимит IP и номер типа тарифа хранятся в плане
+            limit_ip = plan.limit_ip or 3  # Базовый лимит
+            tariff_id = plan.tariff_id or 0  # Начальный тариф ftw.none по умолчанию
             
-            if "base" in plan.title.lower():
-                tariff_id = 1
-                limit_ip = 3
-            elif "middle" in plan.title.lower():
-                tariff_id = 2
-                limit_ip = 3
-            elif "unlimited" in plan.title.lower():
-                tariff_id = 3
-                limit_ip = 6
+            # Переносим подписку в счетчике действующих подписок по тарифам
+            await StatsService.record_subscription_change(session, client.tariff_id, client.expiry_time, tariff_id)
             
             # Обновляем информацию о клиенте
             client.total_traffic = plan.traffic_limit  # Устанавливаем лимит трафика из плана
             client.limit_ip = limit_ip  # Обновляем лимит IP
             client.is_active = True  # Активируем клиента
             client.tariff_id = tariff_id  # Сохраняем номер типа тарифа
-            client.tg_notified = False  # Сбрасываем флаг уведомления
+            client.reminder_stages = 0  # Напоминания для нового срока еще не отправлялись
             
-            # Устанавливаем срок действия (30 дней от текущей даты)
-            client.expiry_time = datetime.now() + timedelta(days=plan.duration_days)
+            # Устанавливаем срок действия (30 дней от текущей даты);
+            # при автопродлении оставшееся время действующей подписки сохраняется
+            start = datetime.now()
+            if extend and client.expiry_time and client.expiry_time > start:
+                start = client.expiry_time
+            client.expiry_time = start + timedelta(days=plan.duration_days)
             
             logger.info(f"Клиент (user_id={user_id}) обновлен в БД согласно тарифу {plan.title}: "
                         f"лимит трафика={plan.traffic_limit}, лимит IP={limit_ip}, "
                         f"номер тарифа={tariff_id}, срок действия до {client.expiry_time}")
             
+            if activation is not None:
+                activation.completed_at = datetime.utcnow()
+            
             # Сохраняем изменения в БД
             await session.commit()
             
+            # Планируем напоминание об окончании нового срока
+            NotificationService.schedule(client.id, client.expiry_time)
+            
             # Проверка UUID и email перед обновлением на сервере
             if not client.uuid:
                 logger.error(f"UUID клиента не определен для user_id={user_id}")
@@ -839,6 +1275,7 @@ class PaymentService:
         logger.info(f"Запущена проверка платежей каждые {check_interval} секунд")
         cleanup_interval = 3600  # Очистка зависших платежей раз в час
         cleanup_counter = 0
+        retry_counter = 0
         
         while True:
             try:
@@ -847,12 +1284,22 @@ class PaymentService:
                 
                 # Увеличиваем счетчик для очистки
                 cleanup_counter += check_interval
+                retry_counter += check_interval
+                
+                # Оплаченные платежи, по которым тариф не был выдан
+                if retry_counter >= PaymentService.ACTIVATION_RETRY_INTERVAL:
+                    await PaymentService.retry_incomplete_activations(bot)
+                    retry_counter = 0
                 
                 # Периодически запускаем очистку зависших платежей
                 if cleanup_counter >= cleanup_interval:
                     await PaymentService.cleanup_old_pending_payments(bot)
                     cleanup_counter = 0
                     
+                    # Сколько вызовов YooKassa и строк payments сэкономлено повторным использованием
+                    logger.info(f"Статистика повторного использования платежей: {PaymentService.get_reuse_stats()}")
+                    logger.info(f"Статистика шлюза сообщений: {MessageGateway.get_stats()}")
+                    
             except Exception as e:
                 logger.error(f"Ошибка в цикле проверки платежей: {e}")
             
@@ -864,71 +1311,134 @@ class PaymentService:
         """
         Очищает старые платежи в статусе "pending", которые висят более 24 часов
         
+        Зависшие платежи отменяются в БД одним условным UPDATE ... RETURNING
+        порциями по CLEANUP_CHUNK_SIZE, затем отменяются в YooKassa с
+        ограниченной параллельностью, а пользователи уведомляются пачками.
+        
         Args:
             bot: Экземпляр бота для отправки уведомлений пользователям (опционально)
         """
         try:
             logger.info("Запуск очистки зависших платежей...")
             
-            # Время, после которого считаем платёж "зависшим" (24 часа)
-            pending_timeout = datetime.now() - timedelta(hours=24)
+            # Время, после которого считаем платёж "зависшим" (24 часа, created_at хранится в UTC)
+            pending_timeout = datetime.utcnow() - timedelta(hours=24)
+            total = 0
+            notified = set()  # Пользователь получает одно уведомление, даже если платежи в разных порциях
             
-            async with async_session() as session:
-                # Получаем все платежи в статусе "pending", созданные более 24 часов назад
-                query = select(PaymentModel).where(
-                    (PaymentModel.status == "pending") &
-                    (PaymentModel.created_at < pending_timeout)
-                )
-                
-                result = await session.execute(query)
-                old_payments = result.scalars().all()
-                
-                if not old_payments:
-                    logger.info("Зависших платежей не обнаружено")
-                    return
-                
-                logger.info(f"Найдено {len(old_payments)} зависших платежей для отмены")
-                
-                for payment in old_payments:
-                    # Получаем информацию о пользователе
-                    user_query = await session.execute(
-                        select(User).where(User.id == payment.user_id)
+            while True:
+                async with async_session() as session:
+                    # Одна порция зависших платежей
+                    stale_ids = (
+                        select(PaymentModel.id)
+                        .where(
+                            (PaymentModel.status == "pending") &
+                            (PaymentModel.created_at < pending_timeout)
+                        )
+                        .limit(PaymentService.CLEANUP_CHUNK_SIZE)
                     )
-                    user = user_query.scalar_one_or_none()
                     
-                    # Отменяем платёж в YooKassa, если это не тестовый платёж
-                    cancelled = False
-                    if not payment.payment_id.startswith("test_payment_") and yookassa_configured:
-                        try:
-                            # Пытаемся отменить платёж в YooKassa
-                            yookassa_result = Payment.cancel(payment.payment_id)
-                            if yookassa_result and yookassa_result.status == "canceled":
-                                cancelled = True
-                        except Exception as e:
-                            logger.error(f"Ошибка при отмене платежа {payment.payment_id} в YooKassa: {e}")
-                    else:
-                        # Для тестовых платежей просто считаем отмененными
-                        cancelled = True
+                    # Отменяем порцию одним запросом и получаем отмененные платежи
+                    result = await session.execute(
+                        update(PaymentModel)
+                        .where(
+                            (PaymentModel.id.in_(stale_ids)) &
+                            (PaymentModel.status == "pending")
+                        )
+                        .values(status="canceled")
+                        .returning(PaymentModel.payment_id, PaymentModel.user_id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    canceled = result.all()
                     
-                    # Обновляем статус в БД
-                    payment.status = "canceled"
-                    await session.commit()
+                    # Telegram ID пользователей для уведомлений - одним запросом на порцию
+                    tg_ids = []
+                    if canceled and bot:
+                        users_query = await session.execute(
+                            select(User.tg_id).where(User.id.in_({user_id for _, user_id in canceled}))
+                        )
+                        tg_ids = users_query.scalars().all()
                     
-                    # Отправляем уведомление пользователю, если есть bot и пользователь
-                    if bot and user:
-                        try:
-                            await bot.send_message(
-                                user.tg_id,
-                                "⚠️ Ваш платеж был автоматически отменен из-за истечения времени ожидания.\n\n"
-                                "Пожалуйста, повторите процесс оплаты, если хотите приобрести подписку."
-                            )
-                            logger.info(f"Отправлено уведомление пользователю {user.tg_id} об отмене платежа {payment.payment_id}")
-                        except Exception as e:
-                            logger.error(f"Ошибка при отправке уведомления пользователю {user.tg_id}: {e}")
+                    await session.commit()
+                
+                if not canceled:
+                    break
+                
+                total += len(canceled)
+                payment_ids = {payment_id for payment_id, _ in canceled}
+                PaymentService._pending_payments.discard_where(lambda cached: cached[0] in payment_ids)
+                
+                tg_ids = [tg_id for tg_id in tg_ids if tg_id not in notified]
+                notified.update(tg_ids)
+                
+                await asyncio.gather(
+                    PaymentService._cancel_in_yookassa(payment_ids),
+                    PaymentService._notify_payments_canceled(bot, tg_ids)
+                )
                 
-                logger.info(f"Завершена очистка {len(old_payments)} зависших платежей")
+                if len(canceled) < PaymentService.CLEANUP_CHUNK_SIZE:
+                    break
+            
+            if total:
+                logger.info(f"Завершена очистка {total} зависших платежей")
+            else:
+                logger.info("Зависших платежей не обнаружено")
                 
         except Exception as e:
             logger.error(f"Ошибка при очистке зависших платежей: {e}")
             import traceback
-            logger.error(traceback.format_exc()) 
\ No newline at end of file
+            logger.error(traceback.format_exc())
+    
+    @staticmethod
+    async def _cancel_in_yookassa(payment_ids):
+        """
+        Отменяет платежи в YooKassa с ограниченной параллельностью
+        
+        Args:
+            payment_ids: ID платежей, уже отмененных в БД
+        """
+        # Тестовые платежи и счета Telegram в YooKassa не отменяем
+        payment_ids = [
+            payment_id for payment_id in payment_ids
+            if not payment_id.startswith(("test_payment_", PaymentService.INVOICE_PREFIX))
+        ]
+        
+        if not payment_ids or not yookassa_configured:
+            return
+        
+        semaphore = asyncio.Semaphore(PaymentService.CANCEL_CONCURRENCY)
+        
+        async def cancel_one(payment_id):
+            async with semaphore:
+                try:
+                    await asyncio.to_thread(Payment.cancel, payment_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при отмене платежа {payment_id} в YooKassa: {e}")
+        
+        await asyncio.gather(*(cancel_one(payment_id) for payment_id in payment_ids))
+    
+    @staticmethod
+    async def _notify_payments_canceled(bot, tg_ids):
+        """
+        Уведомляет пользователей об автоматической отмене платежей
+        
+        Args:
+            bot: Экземпляр бота (если None, уведомления не отправляются)
+            tg_ids: Telegram ID пользователей
+        """
+        if not bot or not tg_ids:
+            return
+        
+        text = (
+            "⚠️ Ваш платеж был автоматически отменен из-за истечения времени ожидания.\n\n"
+            "Пожалуйста, повторите процесс оплаты, если хотите приобрести подписку."
+        )
+        
+        # Темп отправки задает шлюз сообщений
+        results = await asyncio.gather(
+            *(MessageGateway.send_message(bot, tg_id, text) for tg_id in tg_ids),
+            return_exceptions=True
+        )
+        
+        sent = sum(1 for result in results if not isinstance(result, Exception))
+        logger.info(f"Отправлено {sent} из {len(tg_ids)} уведомлений об отмене платежей")
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.plan import Plan
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class PlanRegistry:
+    """Каталог тарифов в памяти: загружается один раз и сбрасывается явно после изменений"""
+
+    _by_key = {}  # {key: Plan}
+    _by_id = {}  # {plan.id: Plan}
+    _by_tariff_id = {}  # {tariff_id: Plan}
+
+    # Заранее сформированные описание тарифов и клавиатура выбора
+    _tariffs_text = ""
+    _tariffs_keyboard = None
+
+    _loaded = False
+    _lock = asyncio.Lock()
+
+    @staticmethod
+    async def load():
+        """Загружает планы из БД и формирует описание тарифов и клавиатуру"""
+        async with async_session() as session:
+            result = await session.execute(select(Plan).order_by(Plan.id))
+            plans = result.scalars().all()
+
+        # Собираем новые индексы целиком и подменяем их разом
+        PlanRegistry._by_key = {plan.key: plan for plan in plans if plan.key}
+        PlanRegistry._by_id = {plan.id: plan for plan in plans}
+        PlanRegistry._by_tariff_id = {plan.tariff_id: plan for plan in plans if plan.tariff_id}
+        PlanRegistry._tariffs_text = PlanRegistry._render_text()
+        PlanRegistry._tariffs_keyboard = PlanRegistry._render_keyboard()
+        PlanRegistry._loaded = True
+
+        logger.info(f"Каталог тарифов загружен: {len(plans)} планов")
+
+    @staticmethod
+    async def ensure_loaded():
+        """Загружает каталог, если он еще не загружен"""
+        if PlanRegistry._loaded:
+            return
+        async with PlanRegistry._lock:
+            if not PlanRegistry._loaded:
+                await PlanRegistry.load()
+
+    @staticmethod
+    async def reload():
+        """Перечитывает каталог после изменения тарифов и сбрасывает выданные расчеты покупок"""
+        from bot.services.checkout_service import CheckoutService
+
+        await PlanRegistry.load()
+        CheckoutService.invalidate_quotes()
+
+    @staticmethod
+    def get_by_key(key: str):
+        """Возвращает план по ключу тарифа или None"""
+        return PlanRegistry._by_key.get(key)
+
+    @staticmethod
+    def get_by_id(plan_id: int):
+        """Возвращает план по ID или None"""
+        return PlanRegistry._by_id.get(plan_id)
+
+    @staticmethod
+    def get_by_tariff_id(tariff_id: int):
+        """Возвращает план по номеру типа тарифа клиента или None"""
+        return PlanRegistry._by_tariff_id.get(tariff_id)
+
+    @staticmethod
+    def get_plans() -> list:
+        """Возвращает все планы каталога"""
+        return list(PlanRegistry._by_id.values())
+
+    @staticmethod
+    def get_tariffs_text() -> str:
+        """Возвращает описание тарифов"""
+        return PlanRegistry._tariffs_text
+
+    @staticmethod
+    def get_tariffs_keyboard() -> InlineKeyboardMarkup:
+        """Возвращает клавиатуру выбора тарифа"""
+        return PlanRegistry._tariffs_keyboard
+
+    @staticmethod
+    def format_traffic(plan) -> str:
+        """Описание лимита трафика плана"""
+        if not plan.traffic_limit:
+            return "Безлимит"
+        return f"{plan.traffic_limit // (1024 * 1024 * 1024)}ГБ/месяц"
+
+    @staticmethod
+    def _render_text() -> str:
+        """Формирует текстовое описание всех тарифов"""
+        info = "💼 Доступные тарифы\n\n"
+        info += "⚫ ftw.VPN предлагает три уровня цифровой невидимости:\n"
+
+        for plan in PlanRegistry._by_key.values():
+            info += f"• {plan.title} — {plan.price}₽/месяц — {PlanRegistry.format_traffic(plan)} и {plan.limit_ip}IP\n"
+
+        info += "\n🔍 Выберите степень вашей анонимности"
+
+        return info
+
+    @staticmethod
+    def _render_keyboard() -> InlineKeyboardMarkup:
+        """Создает клавиатуру с кнопками выбора тарифа"""
+        keyboard = []
+
+        for key, plan in PlanRegistry._by_key.items():
+            keyboard.append([
+                InlineKeyboardButton(
+                    text=f"{plan.title} -- {plan.price} РУБ",
+                    callback_data=f"tariff_{key}"
+                )
+            ])
+
+        return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1,5 +1,10 @@
 import logging
+import secrets
+import string
 from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import insert, update, func, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
 from bot.utils.db import async_session
 from bot.models.promo import Promo
@@ -10,6 +15,13 @@ logger = logging.getLogger(__name__)
 class PromoService:
     """Сервис для работы с промокодами"""
     
+    # Алфавит и длина генерируемых кодов
+    CODE_ALPHABET = string.ascii_uppercase + string.digits
+    CODE_LENGTH = 8
+    
+    # Попытки пакетной генерации при совпадении с параллельно созданным кодом
+    BULK_ATTEMPTS = 3
+    
     @staticmethod
     async def check_promo(code: str, user_id: int = None):
         """
@@ -67,40 +79,159 @@ class PromoService:
     @staticmethod
     async def use_promo(code: str, user_id: int):
         """
-        Отмечает промокод как использованный
+        Атомарно отмечает промокод использованным
+        
+        Условия check_promo повторяются в условном UPDATE, поэтому из
+        параллельных покупок с одним кодом лимит пройдет только нужное
+        количество, а промокод, отключенный или истекший после расчета
+        покупки, не будет применен.
         
         Args:
             code: Код промокода
             user_id: ID пользователя, который использует промокод
             
         Returns:
-            bool: True если успешно использован, False при ошибке
+            bool: True если промокод использован, False если он больше не действует или при ошибке
         """
+        used_count = func.coalesce(Promo.used_count, 0)
+        has_limit = Promo.usage_limit.isnot(None) & (Promo.usage_limit > 0)
+        
         try:
             async with async_session() as session:
-                # Ищем промокод в базе
-                query = await session.execute(
-                    select(Promo).where(Promo.code == code)
+                result = await session.execute(
+                    update(Promo)
+                    .where(
+                        (Promo.code == code) &
+                        (Promo.is_active == True) &
+                        (Promo.expiration_date.is_(None) | (Promo.expiration_date >= datetime.now())) &
+                        (~has_limit | (used_count < Promo.usage_limit)) &
+                        (Promo.user_id.is_(None) | (Promo.user_id == user_id))
+                    )
+                    .values(
+                        used_count=used_count + 1,
+                        used_at=datetime.now(),
+                        # Достигнут лимит использования - деактивируем промокод
+                        is_active=case((has_limit & (used_count + 1 >= Promo.usage_limit), False), else_=Promo.is_active)
+                    )
                 )
-                promo = query.scalar_one_or_none()
-                
-                if not promo:
-                    logger.warning(f"Попытка использования несуществующего промокода {code}")
-                    return False
-                
-                # Увеличиваем счетчик использования и сохраняем время использования
-                promo.used_count += 1
-                promo.used_at = datetime.now()
-                
-                # Если достигнут лимит использования, деактивируем промокод
-                if promo.usage_limit and promo.used_count >= promo.usage_limit:
-                    promo.is_active = False
-                    logger.info(f"Промокод {code} достиг лимита использования и деактивирован")
-                
                 await session.commit()
-                logger.info(f"Промокод {code} успешно использован пользователем {user_id}")
-                return True
+            
+            if result.rowcount != 1:
+                logger.info(f"Промокод {code} больше не действует для пользователя {user_id}")
+                return False
+            
+            logger.info(f"Промокод {code} успешно использован пользователем {user_id}")
+            return True
                 
         except Exception as e:
             logger.error(f"Ошибка при использовании промокода {code}: {e}")
             return False
+    
+    @staticmethod
+    async def release_promo(code: str):
+        """
+        Возвращает использование промокода, если покупку не удалось создать
+        
+        Args:
+            code: Код промокода
+        """
+        used_count = func.coalesce(Promo.used_count, 0)
+        
+        try:
+            async with async_session() as session:
+                await session.execute(
+                    update(Promo)
+                    .where((Promo.code == code) & (used_count > 0))
+                    .values(
+                        used_count=used_count - 1,
+                        # Промокод был деактивирован этим использованием по лимиту
+                        is_active=case(
+                            (Promo.usage_limit.isnot(None) & (Promo.usage_limit > 0) & (used_count >= Promo.usage_limit), True),
+                            else_=Promo.is_active
+                        )
+                    )
+                )
+                await session.commit()
+            logger.info(f"Использование промокода {code} возвращено")
+        except Exception as e:
+            logger.error(f"Ошибка при возврате использования промокода {code}: {e}")
+    
+    @staticmethod
+    def _random_codes(count: int, length: int, prefix: str = "") -> list:
+        """
+        Случайные коды из букв и цифр, устойчивые к перебору
+        
+        Случайные байты из secrets переводятся в символы алфавита одной
+        операцией translate; байты, дающие неравномерное распределение, отбрасываются.
+        """
+        alphabet = PromoService.CODE_ALPHABET.encode()
+        usable = 256 - 256 % len(alphabet)
+        table = bytes(alphabet[byte % len(alphabet)] for byte in range(usable)) + bytes(256 - usable)
+        rejected = bytes(range(usable, 256))
+        
+        size = count * length
+        chars = b""
+        while len(chars) < size:
+            chars += secrets.token_bytes(size - len(chars) + size // 8 + length).translate(table, rejected)
+        
+        chars = chars[:size].decode()
+        return [prefix + chars[start:start + length] for start in range(0, size, length)]
+    
+    @staticmethod
+    async def generate_bulk(count: int, discount: float, expiration_date: datetime = None,
+                            usage_limit: int = 1, prefix: str = "") -> list:
+        """
+        Создает пачку уникальных промокодов одной транзакцией
+        
+        Коды проверяются на совпадение в памяти по множеству существующих
+        кодов и вставляются одним пакетным INSERT. Уникальный индекс на
+        promik.code защищает от промокода, созданного параллельно: в этом
+        случае транзакция откатывается и генерация повторяется.
+        
+        Args:
+            count: Количество промокодов
+            discount: Скидка в процентах
+            expiration_date: Срок действия (None - бессрочно)
+            usage_limit: Лимит использований каждого кода (по умолчанию одноразовые)
+            prefix: Префикс кодов (например, название партнера)
+        
+        Returns:
+            list: Созданные коды
+        """
+        for attempt in range(1, PromoService.BULK_ATTEMPTS + 1):
+            async with async_session() as session:
+                result = await session.execute(select(Promo.code))
+                existing = set(result.scalars().all())
+                
+                codes = set()
+                while len(codes) < count:
+                    candidates = PromoService._random_codes(count - len(codes), PromoService.CODE_LENGTH, prefix)
+                    codes.update(code for code in candidates if code not in existing)
+                codes = list(codes)
+                
+                try:
+                    # Вставка через таблицу без ORM-обработки строк заметно быстрее на больших пачках
+                    await session.execute(
+                        insert(Promo.__table__),
+                        [
+                            {
+                                "code": code,
+                                "discount": Decimal(str(discount)),
+                                "expiration_date": expiration_date,
+                                "usage_limit": usage_limit,
+                                "used_count": 0,
+                                "is_active": True
+                            }
+                            for code in codes
+                        ]
+                    )
+                    await session.commit()
+                except IntegrityError:
+                    await session.rollback()
+                    logger.warning(f"Совпадение с новым промокодом при пакетной генерации, попытка {attempt}")
+                    continue
+            
+            logger.info(f"Создано {count} промокодов со скидкой {discount}%")
+            return codes
+        
+        raise RuntimeError("Не удалось сгенерировать уникальные промокоды")
@@ -0,0 +1,237 @@
+import asyncio
+import csv
+import logging
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import text, func
+from sqlalchemy.future import select
+from bot.utils.db import engine, async_session
+from bot.models.payment import Payment as PaymentModel
+from bot.services.payment_service import PaymentService, Payment, yookassa_configured
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class ReconciliationService:
+    """Сверка таблицы payments с платежами YooKassa"""
+
+    # Размер страницы списка YooKassa (максимум API - 100)
+    PAGE_SIZE = 100
+
+    # Размер порции при потоковом чтении строк из БД
+    DB_CHUNK_SIZE = 1000
+
+    REPORT_FIELDS = ["kind", "payment_id", "db_status", "yookassa_status", "db_amount", "yookassa_amount", "action"]
+
+    @staticmethod
+    async def reconcile(date_from: datetime, date_to: datetime, report_path: str, auto_activate: bool = False, bot=None) -> dict:
+        """
+        Сверяет платежи за период [date_from, date_to) и пишет расхождения в CSV
+
+        Список YooKassa читается постранично и складывается во временную
+        таблицу соединения, после чего обе стороны читаются потоком,
+        упорядоченными по ID платежа, и сливаются (merge join). В памяти
+        одновременно находится не больше одной страницы/порции.
+
+        Args:
+            date_from: Начало периода (UTC)
+            date_to: Конец периода (UTC, не включительно)
+            report_path: Путь к CSV-отчету
+            auto_activate: Активировать оплаченные в YooKassa, но незавершенные в БД платежи
+            bot: Экземпляр бота для уведомлений при активации (опционально)
+
+        Returns:
+            dict: Счетчики сверки по типам расхождений
+        """
+        if not yookassa_configured:
+            raise ValueError("YooKassa не настроена, сверка невозможна")
+
+        stats = {
+            "yookassa": 0,
+            "db": 0,
+            "matched": 0,
+            "missing_in_db": 0,
+            "missing_in_yookassa": 0,
+            "status_mismatch": 0,
+            "amount_mismatch": 0,
+            "activated": 0
+        }
+
+        async with engine.connect() as conn:
+            await conn.execute(text(
+                "CREATE TEMP TABLE IF NOT EXISTS reconcile_remote "
+                "(payment_id TEXT PRIMARY KEY, status TEXT, paid INTEGER, amount INTEGER)"
+            ))
+            await conn.execute(text("DELETE FROM reconcile_remote"))
+
+            stats["yookassa"] = await ReconciliationService._stage_remote_payments(conn, date_from, date_to)
+            await conn.commit()
+
+            # Слияние сравнивает ID как строки Python, поэтому обе стороны сортируются побайтово:
+            # в Postgres порядок по умолчанию зависит от локали базы (в SQLite он и так побайтовый)
+            collation = "C" if conn.dialect.name == "postgresql" else None
+
+            remote_rows = await conn.stream(text(
+                "SELECT payment_id, status, paid, amount FROM reconcile_remote ORDER BY payment_id"
+                + (f' COLLATE "{collation}"' if collation else "")
+            ))
+
+            async with async_session() as session:
+                # Для счетов Telegram ID в YooKassa хранится в provider_payment_id
+                key = func.coalesce(PaymentModel.provider_payment_id, PaymentModel.payment_id)
+                local_rows = await session.stream(
+                    select(key.label("key"), PaymentModel.payment_id, PaymentModel.status, PaymentModel.amount)
+                    .where(
+                        (PaymentModel.created_at >= date_from) &
+                        (PaymentModel.created_at < date_to) &
+                        (~PaymentModel.payment_id.startswith("test_payment_")) &
+                        ~(
+                            PaymentModel.payment_id.startswith(PaymentService.INVOICE_PREFIX) &
+                            PaymentModel.provider_payment_id.is_(None)
+                        )
+                    )
+                    .order_by(key.collate(collation) if collation else key)
+                    .execution_options(yield_per=ReconciliationService.DB_CHUNK_SIZE)
+                )
+
+                with open(report_path, "w", newline="", encoding="utf-8") as report_file:
+                    writer = csv.DictWriter(report_file, fieldnames=ReconciliationService.REPORT_FIELDS)
+                    writer.writeheader()
+
+                    to_activate = await ReconciliationService._merge(remote_rows, local_rows, writer, stats, auto_activate)
+
+            await conn.execute(text("DROP TABLE IF EXISTS reconcile_remote"))
+
+        # Активируем только после закрытия курсоров, чтобы не держать чтение во время записи
+        if auto_activate:
+            for payment_id in to_activate:
+                if await PaymentService.activate_payment(payment_id, bot, source="reconcile"):
+                    stats["activated"] += 1
+
+        logger.info(f"Сверка платежей {date_from:%d.%m.%Y}-{date_to:%d.%m.%Y} завершена: {stats}")
+        return stats
+
+    @staticmethod
+    async def _stage_remote_payments(conn, date_from: datetime, date_to: datetime) -> int:
+        """
+        Постранично загружает список платежей YooKassa во временную таблицу
+
+        Returns:
+            int: Количество загруженных платежей
+        """
+        params = {
+            "created_at.gte": date_from.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "created_at.lt": date_to.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "limit": ReconciliationService.PAGE_SIZE
+        }
+        total = 0
+
+        while True:
+            page = await asyncio.to_thread(Payment.list, params)
+
+            rows = [
+                {
+                    "payment_id": item.id,
+                    "status": item.status,
+                    "paid": int(bool(item.paid)),
+                    # Сумма в копейках, чтобы сравнивать целые числа
+                    "amount": int(Decimal(str(item.amount.value)) * 100)
+                }
+                for item in page.items
+            ]
+
+            if rows:
+                await conn.execute(
+                    text("INSERT INTO reconcile_remote (payment_id, status, paid, amount) "
+                         "VALUES (:payment_id, :status, :paid, :amount)"),
+                    rows
+                )
+                total += len(rows)
+
+            if not page.next_cursor:
+                break
+            params["cursor"] = page.next_cursor
+
+        logger.info(f"Загружено {total} платежей из YooKassa для сверки")
+        return total
+
+    @staticmethod
+    async def _merge(remote_rows, local_rows, writer, stats: dict, auto_activate: bool) -> list:
+        """
+        Сливает два упорядоченных по ID потока и записывает расхождения
+
+        Returns:
+            list: ID платежей, оплаченных в YooKassa, но не активированных в БД
+        """
+        to_activate = []
+
+        remote = await anext(remote_rows, None)
+        local = await anext(local_rows, None)
+
+        while remote is not None or local is not None:
+            if local is None or (remote is not None and remote.payment_id < local.key):
+                stats["missing_in_db"] += 1
+                writer.writerow({
+                    "kind": "missing_in_db",
+                    "payment_id": remote.payment_id,
+                    "yookassa_status": remote.status,
+                    "yookassa_amount": remote.amount / 100
+                })
+                remote = await anext(remote_rows, None)
+                continue
+
+            if remote is None or local.key < remote.payment_id:
+                stats["db"] += 1
+                stats["missing_in_yookassa"] += 1
+                writer.writerow({
+                    "kind": "missing_in_yookassa",
+                    "payment_id": local.payment_id,
+                    "db_status": local.status,
+                    "db_amount": local.amount
+                })
+                local = await anext(local_rows, None)
+                continue
+
+            # Платеж есть с обеих сторон
+            stats["db"] += 1
+            matched = True
+
+            if remote.status != local.status:
+                matched = False
+                stats["status_mismatch"] += 1
+                action = ""
+
+                # Оплата прошла, но активация была пропущена
+                if remote.status == "succeeded" and remote.paid and local.status in PaymentService.OPEN_STATUSES:
+                    to_activate.append(local.payment_id)
+                    action = "activate" if auto_activate else "needs_activation"
+
+                writer.writerow({
+                    "kind": "status_mismatch",
+                    "payment_id": local.payment_id,
+                    "db_status": local.status,
+                    "yookassa_status": remote.status,
+                    "db_amount": local.amount,
+                    "yookassa_amount": remote.amount / 100,
+                    "action": action
+                })
+
+            if (local.amount or 0) * 100 != remote.amount:
+                matched = False
+                stats["amount_mismatch"] += 1
+                writer.writerow({
+                    "kind": "amount_mismatch",
+                    "payment_id": local.payment_id,
+                    "db_status": local.status,
+                    "yookassa_status": remote.status,
+                    "db_amount": local.amount,
+                    "yookassa_amount": remote.amount / 100
+                })
+
+            if matched:
+                stats["matched"] += 1
+
+            remote = await anext(remote_rows, None)
+            local = await anext(local_rows, None)
+
+        return to_activate
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.utils.cache import TTLCache
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment as PaymentModel
+from bot.models.payment_activation import PaymentActivation
+from bot.config import AUTO_RENEW_ENABLED, AUTO_RENEW_BEFORE_HOURS
+from bot.services.payment_service import PaymentService, Payment, yookassa_configured
+from bot.services.vpn_service import VPNService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.message_gateway import MessageGateway
+from bot.services.notification_service import NotificationService
+from bot.services.stats_service import StatsService
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class RenewalService:
+    """Автопродление подписок сохраненным способом оплаты YooKassa"""
+
+    # Максимум одновременных списаний в YooKassa
+    CHARGE_CONCURRENCY = 5
+
+    # Максимум одновременных обновлений клиентов на VPN сервере
+    PANEL_CONCURRENCY = 5
+
+    # Количество продлений, фиксируемых в БД одной транзакцией
+    BATCH_SIZE = 100
+
+    # Счетчики для метрик
+    _stats = {"runs": 0, "charged": 0, "pending": 0, "failed": 0, "skipped": 0}
+
+    # Ключи списаний (клиент и срок подписки), о неудаче которых пользователь уже уведомлен.
+    # Запрос без ответа YooKassa не записывается в payments и повторяется каждый запуск,
+    # а уведомление о неудаче отправляется один раз на срок подписки
+    _failure_notified = TTLCache(maxsize=10000, ttl=(AUTO_RENEW_BEFORE_HOURS + 1) * 3600)
+
+    @staticmethod
+    def get_stats() -> dict:
+        """Возвращает счетчики автопродления"""
+        return dict(RenewalService._stats)
+
+    @staticmethod
+    async def renew_expiring(bot=None, before_hours: int = AUTO_RENEW_BEFORE_HOURS) -> dict:
+        """
+        Списывает оплату у клиентов с автопродлением, подписка которых истекает в ближайшие часы
+
+        Args:
+            bot: Экземпляр бота для уведомлений (опционально)
+            before_hours: За сколько часов до окончания подписки выполнять списание
+
+        Returns:
+            dict: Счетчики текущего запуска
+        """
+        run_stats = {"candidates": 0, "charged": 0, "pending": 0, "failed": 0, "skipped": 0}
+
+        if not yookassa_configured:
+            logger.warning("YooKassa не настроена, автопродление пропущено")
+            return run_stats
+
+        now = datetime.now()
+
+        # Выборка по индексу clients.expiry_time
+        async with async_session() as session:
+            result = await session.execute(
+                select(
+                    Client.id, Client.user_id, Client.expiry_time, Client.tariff_id,
+                    User.tg_id, User.payment_method_id
+                )
+                .join(User, User.id == Client.user_id)
+                .where(
+                    (Client.expiry_time > now) &
+                    (Client.expiry_time <= now + timedelta(hours=before_hours)) &
+                    (Client.is_active == True) &
+                    (User.auto_renew == True) &
+                    (User.payment_method_id.isnot(None))
+                )
+            )
+            candidates = result.all()
+
+        run_stats["candidates"] = len(candidates)
+        if not candidates:
+            logger.debug("Нет подписок для автопродления")
+            return run_stats
+
+        logger.info(f"Найдено {len(candidates)} подписок для автопродления")
+
+        await PlanRegistry.ensure_loaded()
+
+        semaphore = asyncio.Semaphore(RenewalService.CHARGE_CONCURRENCY)
+
+        async def charge_one(row):
+            plan = PlanRegistry.get_by_tariff_id(row.tariff_id)
+            if not plan:
+                # Бесплатный или неизвестный тариф не продлевается
+                return None
+            async with semaphore:
+                return await RenewalService._charge(row, plan)
+
+        charges = await asyncio.gather(*(charge_one(row) for row in candidates))
+
+        results = [charge for charge in charges if charge is not None]
+        run_stats["skipped"] = len(charges) - len(results)
+
+        for start in range(0, len(results), RenewalService.BATCH_SIZE):
+            batch_stats = await RenewalService._apply_batch(results[start:start + RenewalService.BATCH_SIZE], bot)
+            for key, value in batch_stats.items():
+                run_stats[key] += value
+
+        RenewalService._stats["runs"] += 1
+        for key in ("charged", "pending", "failed", "skipped"):
+            RenewalService._stats[key] += run_stats[key]
+
+        logger.info(f"Автопродление завершено: {run_stats}")
+        return run_stats
+
+    @staticmethod
+    def _idempotency_key(row) -> str:
+        """Ключ списания: один на клиента и текущий срок окончания подписки"""
+        return f"renew-{row.id}-{int(row.expiry_time.timestamp())}"
+
+    @staticmethod
+    async def _charge(row, plan):
+        """
+        Списывает оплату сохраненным способом
+
+        Ключ идемпотентности привязан к клиенту и текущему сроку окончания подписки,
+        поэтому повторный запуск задачи не приведет к повторному списанию.
+
+        Returns:
+            dict: Результат списания (payment_id = None при ошибке запроса)
+        """
+        idempotency_key = RenewalService._idempotency_key(row)
+        payment_data = {
+            "amount": {
+                "value": str(plan.price),
+                "currency": "RUB"
+            },
+            "capture": True,
+            "payment_method_id": row.payment_method_id,
+            "description": f"Автопродление тарифа {plan.title}",
+            "metadata": {
+                "tg_user_id": row.tg_id,
+                "db_user_id": row.user_id,
+                "plan_id": plan.id,
+                "renewal": True
+            }
+        }
+
+        try:
+            payment = await asyncio.to_thread(Payment.create, payment_data, idempotency_key)
+        except Exception as e:
+            logger.error(f"Ошибка списания автопродления для клиента {row.id}: {e}")
+            return {"row": row, "plan": plan, "payment_id": None, "status": "error", "paid": False}
+
+        return {
+            "row": row,
+            "plan": plan,
+            "payment_id": payment.id,
+            "status": payment.status,
+            "paid": bool(payment.paid)
+        }
+
+    @staticmethod
+    async def _apply_batch(batch, bot) -> dict:
+        """
+        Фиксирует порцию списаний в БД одной транзакцией и обновляет клиентов на сервере
+
+        Returns:
+            dict: Счетчики по порции
+        """
+        stats = {"charged": 0, "pending": 0, "failed": 0}
+        # Время оплаты хранится в UTC, как payments.created_at
+        paid_at = datetime.utcnow()
+
+        async with async_session() as session:
+            # Платежи, уже записанные при предыдущем запуске (идемпотентный повтор)
+            known_query = await session.execute(
+                select(PaymentModel.payment_id).where(
+                    PaymentModel.payment_id.in_([item["payment_id"] for item in batch if item["payment_id"]])
+                )
+            )
+            known = set(known_query.scalars().all())
+
+            renewed = []
+            for item in batch:
+                row, plan = item["row"], item["plan"]
+
+                if item["payment_id"] is None:
+                    stats["failed"] += 1
+                    continue
+
+                if item["payment_id"] in known:
+                    continue
+
+                succeeded = item["status"] == "succeeded" and item["paid"]
+                session.add(PaymentModel(
+                    user_id=row.user_id,
+                    plan_id=plan.id,
+                    status="succeeded" if succeeded else item["status"],
+                    amount=plan.price,
+                    payment_id=item["payment_id"],
+                    paid_at=paid_at if succeeded else None,
+                    is_renewal=True
+                ))
+
+                if succeeded:
+                    session.add(PaymentActivation(
+                        payment_id=item["payment_id"],
+                        user_id=row.user_id,
+                        plan_id=plan.id,
+                        source="renewal",
+                        completed_at=paid_at
+                    ))
+                    renewed.append(item)
+                elif item["status"] in PaymentService.OPEN_STATUSES:
+                    # Подтверждение придет позже - платеж активирует поллер,
+                    # продлив подписку от текущего окончания (is_renewal)
+                    stats["pending"] += 1
+                else:
+                    stats["failed"] += 1
+
+            # Продлеваем подписки от текущей даты окончания одним пакетным UPDATE
+            if renewed:
+                await session.execute(
+                    update(Client),
+                    [
+                        {
+                            "id": item["row"].id,
+                            "expiry_time": item["row"].expiry_time + timedelta(days=item["plan"].duration_days),
+                            "total_traffic": item["plan"].traffic_limit,
+                            "reminder_stages": 0
+                        }
+                        for item in renewed
+                    ]
+                )
+
+                # Счетчики статистики по тарифам фиксируются в той же транзакции
+                by_tariff = {}
+                for item in renewed:
+                    totals = by_tariff.setdefault(item["plan"].tariff_id, [0, 0])
+                    totals[0] += 1
+                    totals[1] += item["plan"].price
+                for tariff_id, (count, amount) in by_tariff.items():
+                    await StatsService.record_payment(session, None, tariff_id, amount, count=count)
+
+            await session.commit()
+
+        for item in renewed:
+            NotificationService.schedule(item["row"].id, item["row"].expiry_time + timedelta(days=item["plan"].duration_days))
+
+        stats["charged"] = len(renewed)
+
+        if renewed:
+            await RenewalService._push_to_panel([item["row"].id for item in renewed])
+
+        if bot:
+            for item in batch:
+                if item["payment_id"] in known:
+                    continue
+                await RenewalService._notify(bot, item)
+
+        return stats
+
+    @staticmethod
+    async def _push_to_panel(client_ids):
+        """Обновляет продленных клиентов на VPN сервере с ограничением параллельности"""
+        async with async_session() as session:
+            result = await session.execute(select(Client).where(Client.id.in_(client_ids)))
+            clients = result.scalars().all()
+
+        vpn_service = VPNService()
+        semaphore = asyncio.Semaphore(RenewalService.PANEL_CONCURRENCY)
+
+        async def push(client):
+            if not client.uuid or not client.email:
+                logger.error(f"У клиента {client.id} не определен UUID или email, сервер не обновлен")
+                return
+            async with semaphore:
+                if not await vpn_service.update_client_on_server(
+                    user_uuid=client.uuid,
+                    nickname=client.email,
+                    traffic_limit=client.total_traffic,
+                    limit_ip=client.limit_ip,
+                    expiry_time=int(client.expiry_time.timestamp() * 1000)
+                ):
+                    logger.error(f"Не удалось обновить продленного клиента {client.email} на VPN сервере")
+
+        await asyncio.gather(*(push(client) for client in clients))
+
+    @staticmethod
+    async def _notify(bot, item):
+        """Уведомляет пользователя о результате автопродления"""
+        row, plan = item["row"], item["plan"]
+
+        if item["status"] == "succeeded" and item["paid"]:
+            text = (
+                f"🔁 Подписка «{plan.title}» продлена автоматически.\n\n"
+                f"Действует до: {(row.expiry_time + timedelta(days=plan.duration_days)).strftime('%d.%m.%Y %H:%M')}\n"
+                f"Списано: {plan.price} ₽"
+            )
+        elif item["status"] in PaymentService.OPEN_STATUSES:
+            return
+        else:
+            if item["payment_id"] is None:
+                # Списание повторится при следующем запуске - о неудаче сообщаем один раз на срок
+                key = RenewalService._idempotency_key(row)
+                if RenewalService._failure_notified.get(key):
+                    return
+                RenewalService._failure_notified.set(key, True)
+            text = (
+                f"⚠️ Не удалось автоматически продлить подписку «{plan.title}».\n\n"
+                f"Продлите ее вручную в разделе '💼 Подписка и оплата'."
+            )
+
+        try:
+            await MessageGateway.send_message(bot, row.tg_id, text, priority=MessageGateway.PRIORITY_PAYMENT)
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления об автопродлении пользователю {row.tg_id}: {e}")
+
+    @staticmethod
+    async def set_auto_renew(tg_id: int, enabled: bool) -> bool:
+        """
+        Включает или выключает автопродление для пользователя
+
+        Returns:
+            bool: True если настройка изменена
+        """
+        async with async_session() as session:
+            result = await session.execute(
+                update(User).where(User.tg_id == tg_id).values(auto_renew=enabled)
+            )
+            await session.commit()
+            return result.rowcount == 1
+
+    @staticmethod
+    async def start_renewal_checker(bot, check_interval=3600):
+        """
+        Запускает автопродление каждые check_interval секунд
+
+        Args:
+            bot: Экземпляр бота для отправки уведомлений
+            check_interval: Интервал проверки в секундах
+        """
+        if not AUTO_RENEW_ENABLED:
+            logger.info("Автопродление отключено (AUTO_RENEW_ENABLED)")
+            return
+
+        logger.info(f"Запущено автопродление каждые {check_interval} секунд")
+
+        while True:
+            try:
+                await RenewalService.renew_expiring(bot)
+            except Exception as e:
+                logger.error(f"Ошибка в цикле автопродления: {e}")
+
+            await asyncio.sleep(check_interval)
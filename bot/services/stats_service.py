@@ -0,0 +1,355 @@
+import asyncio
+import logging
+from datetime import datetime
+from sqlalchemy import delete, func, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.plan import Plan
+from bot.models.payment import Payment
+from bot.models.stat_counter import StatCounter
+from bot.services.plan_registry import PlanRegistry
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class StatsService:
+    """
+    Счетчики статистики для админ-панели
+
+    Счетчики обновляются в транзакциях событий (регистрация пользователя,
+    успешная оплата, окончание подписки), поэтому экран статистики читает
+    несколько строк stat_counters вместо агрегатов по payments и clients.
+    Дни счетчиков считаются по UTC - так же хранятся users.created_at
+    и payments.created_at/paid_at, по которым счетчики пересчитываются.
+    """
+
+    # Метрики
+    USERS = "users"  # Новые пользователи
+    PAYMENTS = "payments"  # Успешные платежи
+    REVENUE = "revenue"  # Выручка, ₽
+    PAYING_USERS = "paying_users"  # Пользователи хотя бы с одной оплатой (только итог)
+    ACTIVE_CLIENTS = "active_clients"  # Действующие платные подписки по тарифам (только итог)
+    EXPIRY_WATERMARK = "expiry_watermark"  # Время (timestamp), до которого учтены окончания подписок
+
+    # Накопительный итог хранится с пустой датой
+    TOTAL = ""
+
+    _upsert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+    @staticmethod
+    def today() -> str:
+        """Ключ текущего дня (UTC)"""
+        return datetime.utcnow().date().isoformat()
+
+    @staticmethod
+    def _utc_date(dialect: str, column):
+        """Выражение дня (UTC) для колонки времени в запросе пересчета"""
+        if dialect == "postgresql":
+            # timestamptz приводится к дате в часовом поясе сессии - переводим в UTC явно
+            return func.date(func.timezone("UTC", column))
+        # SQLite хранит время строкой как записано (CURRENT_TIMESTAMP - в UTC)
+        return func.date(column)
+
+    @staticmethod
+    async def bump(session, metric: str, value: int = 1, tariff_id: int = 0, day: str = TOTAL):
+        """
+        Прибавляет значение к счетчику в транзакции сессии
+
+        Args:
+            session: Сессия события (счетчик фиксируется вместе с ним)
+            metric: Метрика
+            value: Приращение (может быть отрицательным)
+            tariff_id: Номер типа тарифа (0 - без разбивки)
+            day: Дата YYYY-MM-DD или TOTAL
+        """
+        if not value:
+            return
+
+        upsert = StatsService._upsert[session.get_bind().dialect.name]
+        stmt = upsert(StatCounter).values(metric=metric, day=day, tariff_id=tariff_id, value=value)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[StatCounter.metric, StatCounter.day, StatCounter.tariff_id],
+            set_={"value": StatCounter.value + stmt.excluded.value}
+        ))
+
+    @staticmethod
+    async def record_user_created(session):
+        """Учитывает нового пользователя (вызывается до commit создания)"""
+        await StatsService.bump(session, StatsService.USERS, day=StatsService.today())
+        await StatsService.bump(session, StatsService.USERS)
+
+    @staticmethod
+    async def record_payment(session, user_id: int, tariff_id: int, amount: int, payment_id: str = None, count: int = 1):
+        """
+        Учитывает успешные платежи (вызывается до commit активации)
+
+        Args:
+            session: Сессия активации платежа
+            user_id: ID пользователя в БД (для учета первой оплаты)
+            tariff_id: Номер типа тарифа плана
+            amount: Сумма платежей, ₽
+            payment_id: ID текущего платежа - если у пользователя нет других оплат, он учитывается как оплативший
+            count: Количество платежей
+        """
+        today = StatsService.today()
+        tariff_id = tariff_id or 0
+
+        for day in (today, StatsService.TOTAL):
+            await StatsService.bump(session, StatsService.PAYMENTS, count, tariff_id, day)
+            await StatsService.bump(session, StatsService.REVENUE, amount or 0, tariff_id, day)
+
+        if payment_id:
+            previous = await session.execute(
+                select(Payment.id).where(
+                    (Payment.user_id == user_id) &
+                    (Payment.status == "succeeded") &
+                    (Payment.payment_id != payment_id)
+                ).limit(1)
+            )
+            if previous.first() is None:
+                await StatsService.bump(session, StatsService.PAYING_USERS)
+
+    @staticmethod
+    async def get_watermark(session) -> datetime:
+        """Время, до которого окончания подписок уже вычтены из active_clients"""
+        result = await session.execute(
+            select(StatCounter.value).where(
+                (StatCounter.metric == StatsService.EXPIRY_WATERMARK) &
+                (StatCounter.day == StatsService.TOTAL) &
+                (StatCounter.tariff_id == 0)
+            )
+        )
+        value = result.scalar()
+        return datetime.fromtimestamp(value) if value else datetime.now()
+
+    @staticmethod
+    async def record_subscription_change(session, old_tariff_id, old_expiry_time, new_tariff_id):
+        """
+        Переносит подписку клиента в счетчике active_clients при оплате тарифа
+
+        Подписка считается учтенной, пока ее окончание не обработано
+        process_expirations (срок позже контрольной точки).
+
+        Args:
+            session: Сессия обновления клиента
+            old_tariff_id: Тариф клиента до оплаты
+            old_expiry_time: Срок подписки до оплаты
+            new_tariff_id: Оплаченный тариф
+        """
+        paid_tariffs = StatsService._paid_tariff_ids()
+
+        if old_tariff_id in paid_tariffs and old_expiry_time and old_expiry_time > await StatsService.get_watermark(session):
+            await StatsService.bump(session, StatsService.ACTIVE_CLIENTS, -1, old_tariff_id)
+
+        if new_tariff_id in paid_tariffs:
+            await StatsService.bump(session, StatsService.ACTIVE_CLIENTS, 1, new_tariff_id)
+
+    @staticmethod
+    async def process_expirations(now: datetime = None) -> int:
+        """
+        Вычитает из active_clients подписки, истекшие после контрольной точки
+
+        Выборка по индексу clients.expiry_time; контрольная точка переносится
+        в той же транзакции.
+
+        Returns:
+            int: Количество учтенных окончаний
+        """
+        # Контрольная точка хранится с точностью до секунды
+        now = (now or datetime.now()).replace(microsecond=0)
+        paid_tariffs = StatsService._paid_tariff_ids()
+
+        async with async_session() as session:
+            watermark = await StatsService.get_watermark(session)
+            if watermark >= now:
+                return 0
+
+            result = await session.execute(
+                select(Client.tariff_id, func.count(Client.id))
+                .where(
+                    (Client.expiry_time > watermark) &
+                    (Client.expiry_time <= now) &
+                    (Client.tariff_id.in_(paid_tariffs))
+                )
+                .group_by(Client.tariff_id)
+            )
+            expired = result.all()
+
+            for tariff_id, count in expired:
+                await StatsService.bump(session, StatsService.ACTIVE_CLIENTS, -count, tariff_id)
+
+            await StatsService._set_watermark(session, now)
+            await session.commit()
+
+        return sum(count for _, count in expired)
+
+    @staticmethod
+    async def _set_watermark(session, moment: datetime):
+        """Сохраняет контрольную точку учета окончаний подписок"""
+        await session.execute(delete(StatCounter).where(StatCounter.metric == StatsService.EXPIRY_WATERMARK))
+        await session.execute(insert(StatCounter).values(
+            metric=StatsService.EXPIRY_WATERMARK, day=StatsService.TOTAL, tariff_id=0, value=int(moment.timestamp())
+        ))
+
+    @staticmethod
+    def _paid_tariff_ids() -> list:
+        """Номера типов тарифов, продаваемых за деньги"""
+        return [plan.tariff_id for plan in PlanRegistry.get_plans() if plan.tariff_id]
+
+    @staticmethod
+    async def rebuild():
+        """
+        Пересчитывает все счетчики по исходным таблицам
+
+        Используется для первичного заполнения и восстановления после ручных
+        правок в БД. Выполняется одной транзакцией.
+        """
+        await PlanRegistry.ensure_loaded()
+        now = datetime.now().replace(microsecond=0)
+        paid_tariffs = StatsService._paid_tariff_ids()
+        rows = []
+
+        async with async_session() as session:
+            dialect = session.get_bind().dialect.name
+
+            # Пользователи по дням
+            created_day = StatsService._utc_date(dialect, User.created_at)
+            result = await session.execute(
+                select(created_day, func.count(User.id)).group_by(created_day)
+            )
+            users_by_day = result.all()
+            rows += [
+                {"metric": StatsService.USERS, "day": str(day), "tariff_id": 0, "value": count}
+                for day, count in users_by_day if day
+            ]
+            rows.append({
+                "metric": StatsService.USERS, "day": StatsService.TOTAL, "tariff_id": 0,
+                "value": sum(count for _, count in users_by_day)
+            })
+
+            # Успешные платежи и выручка по дням и тарифам (paid_at и created_at - в UTC)
+            paid_day = func.date(func.coalesce(Payment.paid_at, Payment.created_at))
+            tariff = func.coalesce(Plan.tariff_id, 0)
+            result = await session.execute(
+                select(paid_day, tariff, func.count(Payment.id), func.coalesce(func.sum(Payment.amount), 0))
+                .join(Plan, Plan.id == Payment.plan_id)
+                .where(Payment.status == "succeeded")
+                .group_by(paid_day, tariff)
+            )
+            totals = {}
+            for day, tariff_id, count, revenue in result.all():
+                rows.append({"metric": StatsService.PAYMENTS, "day": str(day), "tariff_id": tariff_id, "value": count})
+                rows.append({"metric": StatsService.REVENUE, "day": str(day), "tariff_id": tariff_id, "value": revenue})
+                total = totals.setdefault(tariff_id, [0, 0])
+                total[0] += count
+                total[1] += revenue
+            for tariff_id, (count, revenue) in totals.items():
+                rows.append({"metric": StatsService.PAYMENTS, "day": StatsService.TOTAL, "tariff_id": tariff_id, "value": count})
+                rows.append({"metric": StatsService.REVENUE, "day": StatsService.TOTAL, "tariff_id": tariff_id, "value": revenue})
+
+            # Оплатившие пользователи
+            result = await session.execute(
+                select(func.count(func.distinct(Payment.user_id))).where(Payment.status == "succeeded")
+            )
+            rows.append({"metric": StatsService.PAYING_USERS, "day": StatsService.TOTAL, "tariff_id": 0, "value": result.scalar() or 0})
+
+            # Действующие платные подписки
+            result = await session.execute(
+                select(Client.tariff_id, func.count(Client.id))
+                .where((Client.expiry_time > now) & (Client.tariff_id.in_(paid_tariffs)))
+                .group_by(Client.tariff_id)
+            )
+            rows += [
+                {"metric": StatsService.ACTIVE_CLIENTS, "day": StatsService.TOTAL, "tariff_id": tariff_id, "value": count}
+                for tariff_id, count in result.all()
+            ]
+
+            await session.execute(delete(StatCounter))
+            await session.execute(insert(StatCounter), rows)
+            await StatsService._set_watermark(session, now)
+            await session.commit()
+
+        logger.info(f"Счетчики статистики пересчитаны: {len(rows)} строк")
+
+    @staticmethod
+    async def ensure_initialized():
+        """Заполняет счетчики при первом запуске (пустая таблица)"""
+        async with async_session() as session:
+            result = await session.execute(select(StatCounter.metric).limit(1))
+            if result.first() is not None:
+                return
+
+        await StatsService.rebuild()
+
+    @staticmethod
+    async def get_summary() -> dict:
+        """
+        Читает счетчики для экрана статистики
+
+        Читаются только итоговые строки и строки текущего месяца, поэтому
+        время не зависит от размера payments и clients.
+        """
+        today = datetime.utcnow().date()
+        month_start = today.replace(day=1).isoformat()
+
+        async with async_session() as session:
+            result = await session.execute(
+                select(StatCounter.metric, StatCounter.day, StatCounter.tariff_id, StatCounter.value)
+                .where(
+                    (StatCounter.day == StatsService.TOTAL) |
+                    ((StatCounter.day >= month_start) & (StatCounter.day <= today.isoformat()))
+                )
+            )
+            rows = result.all()
+
+        summary = {
+            "users": 0, "users_today": 0, "paying_users": 0,
+            "payments_today": 0, "payments_month": 0,
+            "revenue_today": 0, "revenue_month": 0, "revenue_total": 0,
+            "active_clients": {}
+        }
+
+        for metric, day, tariff_id, value in rows:
+            if metric == StatsService.USERS:
+                if day == StatsService.TOTAL:
+                    summary["users"] += value
+                elif day == today.isoformat():
+                    summary["users_today"] += value
+            elif metric == StatsService.PAYING_USERS:
+                summary["paying_users"] += value
+            elif metric == StatsService.ACTIVE_CLIENTS:
+                summary["active_clients"][tariff_id] = summary["active_clients"].get(tariff_id, 0) + value
+            elif metric in (StatsService.PAYMENTS, StatsService.REVENUE):
+                if day == StatsService.TOTAL:
+                    if metric == StatsService.REVENUE:
+                        summary["revenue_total"] += value
+                    continue
+                summary[f"{metric}_month"] += value
+                if day == today.isoformat():
+                    summary[f"{metric}_today"] += value
+
+        summary["conversion"] = round(summary["paying_users"] * 100 / summary["users"], 1) if summary["users"] else 0.0
+        return summary
+
+    @staticmethod
+    async def start_expiry_checker(check_interval=3600):
+        """
+        Учитывает окончания подписок каждые check_interval секунд
+
+        Args:
+            check_interval: Интервал проверки в секундах
+        """
+        logger.info(f"Запущен учет окончаний подписок каждые {check_interval} секунд")
+
+        while True:
+            try:
+                expired = await StatsService.process_expirations()
+                if expired:
+                    logger.info(f"Учтено окончаний подписок: {expired}")
+            except Exception as e:
+                logger.error(f"Ошибка при учете окончаний подписок: {e}")
+
+            await asyncio.sleep(check_interval)
@@ -0,0 +1,117 @@
+import logging
+import re
+from sqlalchemy import func, or_
+from sqlalchemy.future import select
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+class UserLookupService:
+    """
+    Поиск пользователя по любому идентификатору для поддержки
+
+    Тип идентификатора определяется по формату, и каждый вариант - один
+    запрос по индексу: users.tg_id, lower(users.username), users.email,
+    clients.uuid, clients.email, payments.payment_id / provider_payment_id.
+    """
+
+    # Максимум пользователей в ответе на поиск по началу username
+    PREFIX_LIMIT = 10
+
+    # Количество последних платежей в карточке
+    RECENT_PAYMENTS = 5
+
+    @staticmethod
+    async def find(query: str) -> list:
+        """
+        Находит пользователей по идентификатору
+
+        Args:
+            query: tg_id, @username (или его начало), email, UUID клиента,
+                   email клиента (user_<id>) или ID платежа
+
+        Returns:
+            list: Найденные пользователи (User)
+        """
+        query = query.strip()
+        if not query:
+            return []
+
+        async with async_session() as session:
+            if query.isdigit():
+                condition = User.tg_id == int(query)
+            elif query.startswith("@"):
+                return await UserLookupService._find_by_username(session, query[1:].lower())
+            elif EMAIL_PATTERN.match(query):
+                condition = User.email == query
+            elif query.startswith("user_"):
+                condition = User.id.in_(select(Client.user_id).where(Client.email == query))
+            elif UUID_PATTERN.match(query):
+                # ID платежей YooKassa тоже имеют формат UUID
+                condition = or_(
+                    User.id.in_(select(Client.user_id).where(Client.uuid == query.lower())),
+                    User.id.in_(select(Payment.user_id).where(Payment.payment_id == query))
+                )
+            else:
+                condition = User.id.in_(
+                    select(Payment.user_id).where(
+                        (Payment.payment_id == query) | (Payment.provider_payment_id == query)
+                    )
+                )
+
+            result = await session.execute(select(User).where(condition).limit(UserLookupService.PREFIX_LIMIT))
+            return result.scalars().all()
+
+    @staticmethod
+    async def _find_by_username(session, username: str) -> list:
+        """Точное совпадение username, иначе - поиск по началу (диапазон по индексу lower(username))"""
+        if not username:
+            return []
+
+        lowered = func.lower(User.username)
+        result = await session.execute(select(User).where(lowered == username))
+        users = result.scalars().all()
+        if users:
+            return users
+
+        result = await session.execute(
+            select(User)
+            .where((lowered >= username) & (lowered < username + "\uffff"))
+            .order_by(lowered)
+            .limit(UserLookupService.PREFIX_LIMIT)
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_card(user_id: int) -> dict:
+        """
+        Собирает данные карточки пользователя
+
+        Returns:
+            dict: user, clients, payments (последние) или None
+        """
+        async with async_session() as session:
+            user = await session.get(User, user_id)
+            if not user:
+                return None
+
+            clients = await session.execute(select(Client).where(Client.user_id == user_id))
+            payments = await session.execute(
+                select(Payment)
+                .where(Payment.user_id == user_id)
+                .order_by(Payment.id.desc())
+                .limit(UserLookupService.RECENT_PAYMENTS)
+            )
+
+            return {
+                "user": user,
+                "clients": clients.scalars().all(),
+                "payments": payments.scalars().all()
+            }
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """Ограниченный по размеру кэш с временем жизни записей (LRU-вытеснение)"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize  # Максимальное число записей
+        self.ttl = ttl  # Время жизни записи в секундах
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+
+        # Счетчики для метрик
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу или default, если записи нет или она устарела"""
+        item = self._data.get(key)
+
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        # Отмечаем запись как недавно использованную
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Сохраняет значение, вытесняя самые старые записи при переполнении"""
+        self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Удаляет запись и возвращает ее значение"""
+        item = self._data.pop(key, None)
+        return item[1] if item else default
+
+    def discard_where(self, predicate):
+        """Удаляет записи, для значений которых predicate(value) истинно"""
+        for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def clear(self):
+        """Очищает кэш"""
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Возвращает счетчики попаданий, промахов и вытеснений"""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def __len__(self):
+        return len(self._data)
@@ -1,8 +1,11 @@
+import warnings
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from bot.config import DATABASE_URL
 from bot.utils.base import Base
 from sqlalchemy.future import select
+from sqlalchemy import inspect, text, func, and_
+from sqlalchemy.exc import SAWarning
 
 # Создаем асинхронный движок
 engine = create_async_engine(DATABASE_URL, echo=True)
@@ -14,10 +17,68 @@ async def init_db():
     """Инициализирует базу данных, создавая все таблицы по моделям, наследующим Base."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
     
     # Заполняем таблицу планов
     await fill_plans_table()
 
+def upgrade_schema(conn):
+    """Добавляет в существующие таблицы новые колонки и индексы моделей.
+    
+    create_all создает только отсутствующие таблицы, поэтому для уже
+    развернутой базы недостающие колонки добавляются через ALTER TABLE.
+    """
+    inspector = inspect(conn)
+    
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            
+            column_type = column.type.compile(dialect=conn.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            
+            # Скалярное значение по умолчанию переносим в DDL, чтобы заполнить старые строки
+            if column.default is not None and column.default.is_scalar:
+                default = column.default.arg
+                if isinstance(default, bool):
+                    default = int(default)
+                ddl += f" DEFAULT {default!r}" if isinstance(default, str) else f" DEFAULT {default}"
+            
+            conn.execute(text(ddl))
+            print(f"Добавлена колонка {table.name}.{column.name}")
+        
+        # Индексы, объявленные в моделях позже создания таблицы
+        with warnings.catch_warnings():
+            # Индексы по выражениям инспектор SQLite пропускает с предупреждением - их находит PRAGMA ниже
+            warnings.filterwarnings("ignore", "Skipped unsupported reflection of expression-based index", SAWarning)
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        if conn.dialect.name == "sqlite":
+            # Индексы по выражениям (lower(username)) инспектор SQLite не возвращает
+            existing_indexes |= {row[1] for row in conn.execute(text(f"PRAGMA index_list({table.name})"))}
+        
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            
+            # Уникальный индекс нельзя создать, пока в таблице есть повторяющиеся значения
+            # (NULL не нарушает уникальность и дубликатом не считается)
+            if index.unique:
+                duplicates = conn.execute(
+                    select(*index.expressions)
+                    .where(and_(*(expression.isnot(None) for expression in index.expressions)))
+                    .group_by(*index.expressions)
+                    .having(func.count() > 1)
+                    .limit(1)
+                ).first()
+                if duplicates:
+                    print(f"Индекс {index.name} не создан: в таблице {table.name} есть повторяющиеся значения {tuple(duplicates)}")
+                    continue
+            
+            index.create(conn)
+
 async def fill_plans_table():
     """Заполняет таблицу plans данными из словаря TARIFFS."""
     from bot.keyboards.subscription_kb import TARIFFS
@@ -40,14 +101,35 @@ async def fill_plans_table():
                     traffic_limit = gb_value * 1024 * 1024 * 1024
                 
                 plan = Plan(
+                    key=key,
                     title=tariff["name"],
                     traffic_limit=traffic_limit,  # 0 для безлимита
                     duration_days=30,  # 30 дней по умолчанию
-                    price=tariff["price"]
+                    price=tariff["price"],
+                    tariff_id=tariff["tariff_id"],
+                    limit_ip=tariff["limit_ip"],
+                    payment_method=tariff["payment_method"]
                 )
                 session.add(plan)
             
             await session.commit()
             print(f"Таблица plans заполнена начальными данными: {len(TARIFFS)} тарифов")
         else:
+            # Заполняем ключ и атрибуты тарифа у планов, созданных до их появления
+            tariffs_by_title = {tariff["name"]: (key, tariff) for key, tariff in TARIFFS.items()}
+            updated = 0
+            
+            for plan in existing_plans:
+                if plan.key is None and plan.title in tariffs_by_title:
+                    key, tariff = tariffs_by_title[plan.title]
+                    plan.key = key
+                    plan.tariff_id = tariff["tariff_id"]
+                    plan.limit_ip = tariff["limit_ip"]
+                    plan.payment_method = tariff["payment_method"]
+                    updated += 1
+            
+            if updated:
+                await session.commit()
+                print(f"Заполнены атрибуты тарифов для {updated} планов")
+            
             print(f"Таблица plans уже содержит данные: {len(existing_plans)} тарифов")
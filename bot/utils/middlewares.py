@@ -27,6 +27,10 @@ class ThrottlingMiddleware(BaseMiddleware):
         event: Message | CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
+        # Оплату счета пропускаем всегда, чтобы не потерять активацию тарифа
+        if isinstance(event, Message) and event.successful_payment:
+            return await handler(event, data)
+        
         # Получаем user_id
         user_id = event.from_user.id
         
@@ -81,6 +85,10 @@ class BanCheckMiddleware(BaseMiddleware):
         event: Message | CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
+        # Оплату счета пропускаем всегда, чтобы не потерять активацию тарифа
+        if isinstance(event, Message) and event.successful_payment:
+            return await handler(event, data)
+        
         # Проверяем, забанен ли пользователь
         user_id = event.from_user.id
         
@@ -196,4 +204,22 @@ class AntiFloodMiddleware(BaseMiddleware):
                 )
                 return None
         
-        return await handler(event, data) 
\ No newline at end of file
+        return await handler(event, data) 
+
+class DeadChatMiddleware(BaseMiddleware):
+    """Снимает отметку недоступности чата, когда пользователь снова обращается к боту"""
+    
+    def __init__(self, dead_chat_service):
+        self.dead_chat_service = dead_chat_service
+        super().__init__()
+    
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        if event.from_user and self.dead_chat_service.is_dead(event.from_user.id):
+            await self.dead_chat_service.revive(event.from_user.id)
+        
+        return await handler(event, data)
@@ -0,0 +1,144 @@
+import time
+from datetime import datetime
+from sqlalchemy import and_, or_, func, literal
+from sqlalchemy.future import select
+
+# Время жизни закэшированного количества записей (секунды)
+COUNT_TTL = 60
+
+# {имя списка: (время истечения, количество)}
+_count_cache = {}
+
+# Маркер NULL в курсоре
+NULL_MARK = "~"
+
+class KeysetList:
+    """
+    Список с постраничным выводом по ключу сортировки (keyset / seek)
+
+    Вместо OFFSET следующая страница выбирается условием "после последнего
+    показанного ключа", поэтому время выборки не зависит от номера страницы.
+    Ключ - одна или две колонки, последняя из которых уникальна (обычно id).
+    Первая из двух колонок может содержать NULL.
+    """
+
+    def __init__(self, name: str, query, columns: list, descending: bool = True, key=None):
+        """
+        Args:
+            name: Имя списка (используется в callback_data)
+            query: Базовый запрос select(...)
+            columns: Колонки ключа сортировки
+            descending: Порядок вывода
+            key: Функция, возвращающая значения ключа для строки результата
+        """
+        self.name = name
+        self.query = query
+        self.columns = columns
+        self.descending = descending
+        self.key = key
+
+    def encode_cursor(self, row) -> str:
+        """Кодирует ключ строки для callback_data"""
+        parts = []
+        for value in self.key(row):
+            if value is None:
+                parts.append(NULL_MARK)
+            elif isinstance(value, datetime):
+                parts.append(value.strftime("%Y%m%d%H%M%S%f"))
+            elif isinstance(value, bool):
+                parts.append(str(int(value)))
+            else:
+                parts.append(str(value))
+        return ".".join(parts)
+
+    def decode_cursor(self, cursor: str) -> tuple:
+        """Восстанавливает ключ из callback_data"""
+        values = []
+        for column, part in zip(self.columns, cursor.split(".")):
+            if part == NULL_MARK:
+                values.append(None)
+                continue
+
+            python_type = column.type.python_type
+            if python_type is datetime:
+                values.append(datetime.strptime(part, "%Y%m%d%H%M%S%f"))
+            elif python_type is bool:
+                values.append(bool(int(part)))
+            else:
+                values.append(python_type(part))
+        return tuple(values)
+
+    def _seek(self, values: tuple, forward: bool):
+        """Условие "строки после ключа" в порядке выборки"""
+        # Для прямого направления в убывающем списке идем к меньшим значениям
+        less = self.descending == forward
+
+        def beyond(column, value):
+            # literal нужен для сравнения булевых колонок на больше/меньше
+            value = literal(value, column.type)
+            return column < value if less else column > value
+
+        if len(self.columns) == 1:
+            return beyond(self.columns[0], values[0])
+
+        first, last = self.columns
+        first_value, last_value = values
+
+        # NULL первой колонки всегда в конце порядка вывода
+        if first_value is None:
+            if forward:
+                return and_(first.is_(None), beyond(last, last_value))
+            return or_(first.isnot(None), beyond(last, last_value))
+
+        condition = or_(
+            beyond(first, first_value),
+            and_(first == literal(first_value, first.type), beyond(last, last_value))
+        )
+        return or_(condition, first.is_(None)) if forward else condition
+
+    def _order(self, forward: bool) -> list:
+        """Порядок выборки (для движения назад - обратный порядку вывода)"""
+        descending = self.descending == forward
+        order = []
+        for index, column in enumerate(self.columns):
+            clause = column.desc() if descending else column.asc()
+            # NULL первой колонки - в конце порядка вывода
+            if index == 0 and len(self.columns) > 1:
+                clause = clause.nulls_last() if forward else clause.nulls_first()
+            order.append(clause)
+        return order
+
+    async def fetch(self, session, page_size: int, cursor: str = None, forward: bool = True):
+        """
+        Выбирает страницу после (или перед) курсором
+
+        Returns:
+            tuple: (строки страницы, есть ли еще строки в направлении движения)
+        """
+        query = self.query
+        if cursor:
+            query = query.where(self._seek(self.decode_cursor(cursor), forward))
+
+        result = await session.execute(query.order_by(*self._order(forward)).limit(page_size + 1))
+        rows = result.all()
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if not forward:
+            rows.reverse()
+        return rows, has_more
+
+    async def count(self, session) -> int:
+        """Количество записей, кэшируется на COUNT_TTL секунд"""
+        cached = _count_cache.get(self.name)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        result = await session.execute(select(func.count()).select_from(self.query.subquery()))
+        total = result.scalar() or 0
+        _count_cache[self.name] = (time.monotonic() + COUNT_TTL, total)
+        return total
+
+def invalidate_count(name: str):
+    """Сбрасывает закэшированное количество записей списка"""
+    _count_cache.pop(name, None)
@@ -0,0 +1,109 @@
+"""
+Время выборки страницы списков админ-панели: keyset против COUNT + OFFSET
+
+Во временной SQLite базе создаются пользователи и клиенты, затем для первой и
+дальней страницы сравниваются прежний способ (COUNT и OFFSET на каждое нажатие)
+и KeysetList.fetch из ADMIN_LISTS с курсором предыдущей страницы. Количество
+записей в keyset-списке кэшируется, поэтому в замер оно не входит.
+
+    python scripts/bench_admin_pagination.py [--rows 50000] [--page 5000] [--page-size 5]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_env import Timer, reset_db  # noqa: E402
+
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from bot.utils.db import async_session  # noqa: E402
+from bot.models.user import User  # noqa: E402
+from bot.models.client import Client  # noqa: E402
+from bot.handlers.admin import ADMIN_LISTS  # noqa: E402
+
+# Повторов каждого замера (берется медиана)
+REPEATS = 20
+
+
+async def fill(rows: int):
+    """Создает пользователей и клиентов с разными сроками подписки (часть без срока)"""
+    now = datetime.now()
+    async with async_session() as session:
+        for start in range(0, rows, 10_000):
+            batch = range(start, min(start + 10_000, rows))
+            await session.execute(insert(User), [
+                {"id": index + 1, "tg_id": 1_000_000 + index, "username": f"user{index}"} for index in batch
+            ])
+            await session.execute(insert(Client), [
+                {
+                    "user_id": index + 1, "email": f"user_{index}", "uuid": f"uuid-{index}", "limit_ip": 3,
+                    "expiry_time": None if index % 50 == 0 else now + timedelta(minutes=(index * 7919) % 100_000),
+                    "is_active": True, "tariff_id": 1
+                }
+                for index in batch
+            ])
+        await session.commit()
+
+
+async def offset_page(keyset_list, page: int, page_size: int):
+    """Прежний способ: COUNT и OFFSET в порядке вывода списка"""
+    async with async_session() as session:
+        await session.execute(select(func.count()).select_from(keyset_list.query.subquery()))
+        result = await session.execute(
+            keyset_list.query.order_by(*keyset_list._order(True)).offset((page - 1) * page_size).limit(page_size)
+        )
+        return result.all()
+
+
+async def keyset_page(keyset_list, cursor: str, page_size: int):
+    """Текущий способ: выборка после ключа последней показанной записи"""
+    async with async_session() as session:
+        await keyset_list.count(session)
+        rows, _ = await keyset_list.fetch(session, page_size, cursor)
+        return rows
+
+
+async def median_ms(make_call) -> float:
+    samples = []
+    for _ in range(REPEATS):
+        with Timer() as timer:
+            await make_call()
+        samples.append(timer.seconds * 1000)
+    return statistics.median(samples)
+
+
+async def main(rows: int, page: int, page_size: int):
+    await reset_db()
+    await fill(rows)
+
+    print(f"Записей: {rows}, страница из {page_size} записей, медиана {REPEATS} повторов")
+    for name in ("users", "clients"):
+        keyset_list = ADMIN_LISTS[name]
+
+        for number in (1, page):
+            cursor = None
+            if number > 1:
+                # Курсор - последняя запись предыдущей страницы, как в кнопке "Вперёд"
+                previous = await offset_page(keyset_list, number - 1, page_size)
+                cursor = keyset_list.encode_cursor(previous[-1])
+
+            expected = [keyset_list.key(row) for row in await offset_page(keyset_list, number, page_size)]
+            actual = [keyset_list.key(row) for row in await keyset_page(keyset_list, cursor, page_size)]
+            assert actual == expected, f"{name}: страницы {number} не совпадают"
+
+            offset_ms = await median_ms(lambda: offset_page(keyset_list, number, page_size))
+            keyset_ms = await median_ms(lambda: keyset_page(keyset_list, cursor, page_size))
+            print(f"{name}, страница {number}: COUNT + OFFSET {offset_ms:.2f} мс, keyset {keyset_ms:.2f} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--page", type=int, default=5_000)
+    parser.add_argument("--page-size", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.page, args.page_size))
@@ -0,0 +1,108 @@
+"""
+Проверка бана на каждый апдейт: TTLCache с отрицательными записями против прежнего dict
+
+BanCheckMiddleware вызывает BanService.is_banned на каждое сообщение и callback.
+Во временной SQLite базе создается половина пользователей, затем поток апдейтов
+от всех пользователей проверяется текущим BanService и прежней реализацией
+(dict без записей для пользователей, которых нет в users). Считаются запросы к БД.
+
+    python scripts/bench_ban_cache.py [--updates 10000] [--users 2000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_env import Timer, reset_db  # noqa: E402
+
+from sqlalchemy import event, insert  # noqa: E402
+from sqlalchemy.future import select  # noqa: E402
+
+import bot.utils.db as db  # noqa: E402
+from bot.utils.db import async_session  # noqa: E402
+from bot.models.user import User  # noqa: E402
+from bot.services.ban_service import BanService  # noqa: E402
+
+
+class LegacyBanService(BanService):
+    """Прежняя проверка: неограниченный dict, пользователи без записи в users не кэшируются"""
+
+    def __init__(self, bot=None):
+        super().__init__(bot)
+        self.legacy_cache = {}
+
+    async def is_banned(self, user_id: int):
+        cached = self.legacy_cache.get(user_id)
+        if cached and time.time() - cached["timestamp"] < 300:
+            return cached["banned"], cached["reason"], cached["ban_until"]
+
+        async with async_session() as session:
+            result = await session.execute(
+                select(User.is_banned, User.ban_reason, User.banned_until).where(User.tg_id == user_id)
+            )
+            data = result.one_or_none()
+
+        if data is None:
+            return False, "", None
+
+        is_banned, ban_reason, ban_until = data
+        self.legacy_cache[user_id] = {
+            "banned": is_banned, "reason": ban_reason, "ban_until": ban_until, "timestamp": time.time()
+        }
+        return is_banned, ban_reason, ban_until
+
+
+class QueryCounter:
+    """Считает SQL запросы движка"""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(db.engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+async def run(service, updates: list, counter: QueryCounter):
+    counter.count = 0
+    with Timer() as timer:
+        for tg_id in updates:
+            await service.is_banned(tg_id)
+    return counter.count, timer.seconds
+
+
+async def main(updates_count: int, users: int):
+    await reset_db()
+
+    # Запись в users есть у каждого второго пользователя, часть из них забанена
+    async with async_session() as session:
+        await session.execute(insert(User), [
+            {"tg_id": 1_000_000 + index, "username": f"user{index}", "is_banned": index % 20 == 0}
+            for index in range(0, users, 2)
+        ])
+        await session.commit()
+
+    generator = random.Random(42)
+    updates = [1_000_000 + generator.randrange(users) for _ in range(updates_count)]
+    counter = QueryCounter()
+
+    legacy_queries, legacy_seconds = await run(LegacyBanService(), updates, counter)
+    service = BanService()
+    current_queries, current_seconds = await run(service, updates, counter)
+    stats = service.get_stats()
+
+    print(f"Апдейтов: {updates_count} от {users} пользователей, половина без записи в users")
+    print(f"Прежний dict: {legacy_queries} запросов к БД, {legacy_seconds:.2f} с")
+    print(f"TTLCache: {current_queries} запросов к БД, {current_seconds:.2f} с")
+    print(f"Кэш: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.users))
@@ -0,0 +1,103 @@
+"""
+Размер запросов к Bot API при рассылке медиа: copy_message против повторной загрузки
+
+Рассылка отправляется через BroadcastService._send в шлюз сообщений. Бот
+работает через сессию-заглушку: она собирает тело запроса так же, как
+AiohttpSession (multipart/form-data), считает его размер и не обращается к сети.
+
+    python scripts/bench_broadcast_media.py [--recipients 20] [--photo-kb 200]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_env  # noqa: E402,F401
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.types import BufferedInputFile  # noqa: E402
+
+from bot.services.broadcast_service import BroadcastService  # noqa: E402
+from bot.services.message_gateway import MessageGateway  # noqa: E402
+from bot.models.broadcast import Broadcast  # noqa: E402
+
+
+class BodyCounter:
+    """Приемник тела запроса: считает байты вместо отправки в сокет"""
+
+    def __init__(self):
+        self.size = 0
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+
+    async def write_eof(self, chunk=b""):
+        self.size += len(chunk)
+
+    async def drain(self):
+        pass
+
+
+class MeasuringSession(AiohttpSession):
+    """Сессия-заглушка: собирает тело запроса и запоминает его размер по методам"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        payload = self.build_form_data(bot=bot, method=method)()
+        counter = BodyCounter()
+        await payload.write(counter)
+        self.requests.append((method.__api_method__, counter.size))
+        return True
+
+
+async def run_broadcast(bot, broadcast, recipients: int):
+    """Отправляет рассылку получателям через шлюз сообщений"""
+    futures = [BroadcastService._send(bot, broadcast, 10_000 + index) for index in range(recipients)]
+    await asyncio.gather(*futures)
+
+
+async def main(recipients: int, photo_kb: int):
+    photo = os.urandom(photo_kb * 1024)
+
+    # Текущая реализация: сообщение администратора копируется получателям
+    copy_session = MeasuringSession()
+    copy_bot = Bot("123456:BENCH", session=copy_session)
+    broadcast = Broadcast(id=1, text="Подпись", source_chat_id=1, source_message_id=42)
+    await run_broadcast(copy_bot, broadcast, recipients)
+
+    # Прежний способ: файл загружается заново каждому получателю
+    upload_session = MeasuringSession()
+    upload_bot = Bot("123456:BENCH", session=upload_session)
+    await asyncio.gather(*(
+        MessageGateway.submit(
+            lambda chat_id=10_000 + index: upload_bot.send_photo(
+                chat_id, BufferedInputFile(photo, filename="photo.jpg"), caption="Подпись"
+            ),
+            10_000 + index,
+            MessageGateway.PRIORITY_BROADCAST
+        )
+        for index in range(recipients)
+    ))
+
+    MessageGateway._worker.cancel()
+
+    copy_bytes = sum(size for _, size in copy_session.requests)
+    upload_bytes = sum(size for _, size in upload_session.requests)
+
+    print(f"Получателей: {recipients}, фото: {photo_kb} КБ")
+    print(f"copy_message: {copy_bytes} байт ({copy_bytes / recipients:.0f} на получателя)")
+    print(f"send_photo (повторная загрузка): {upload_bytes} байт ({upload_bytes / recipients:.0f} на получателя)")
+    print(f"Отношение: {upload_bytes / copy_bytes:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=20)
+    parser.add_argument("--photo-kb", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.recipients, args.photo_kb))
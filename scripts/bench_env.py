@@ -0,0 +1,65 @@
+"""
+Окружение для скриптов замеров (scripts/bench_*.py)
+
+Конфигурация бота читается из .env при импорте bot.config, поэтому до импорта
+модулей bot подставляются переменные окружения и временная SQLite база -
+замеры не трогают рабочую базу и не обращаются к Telegram и VPN серверу.
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import dotenv
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+os.chdir(ROOT_DIR)
+
+dotenv.load_dotenv = lambda *args, **kwargs: True
+
+BENCH_DB = os.path.join(tempfile.mkdtemp(prefix="vpnbot_bench_"), "bench.db")
+os.environ.update({
+    "BOT_TOKEN": "123456:BENCH",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{BENCH_DB}",
+    "API_BASE_URL": "http://127.0.0.1:9",
+    "INBOUND_ID": "1",
+    "API_USERNAME": "bench",
+    "API_PASSWORD": "bench",
+})
+
+logging.basicConfig(level=logging.WARNING)
+
+import bot.utils.db as db  # noqa: E402
+
+db.engine.echo = False
+logging.getLogger("sqlalchemy").setLevel(logging.WARNING)
+
+
+async def reset_db():
+    """Пересоздает таблицы во временной базе и загружает тарифы"""
+    from bot.services.plan_registry import PlanRegistry
+
+    # Регистрируем все модели в Base.metadata до создания таблиц
+    import bot.services.payment_service  # noqa: F401
+    import bot.services.broadcast_service  # noqa: F401
+    import bot.models.promo  # noqa: F401
+    import bot.models.dead_chat  # noqa: F401
+
+    async with db.engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    await db.init_db()
+    await PlanRegistry.load()
+
+
+class Timer:
+    """Замер времени блока: with Timer() as timer: ...; timer.seconds"""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
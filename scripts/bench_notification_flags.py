@@ -0,0 +1,91 @@
+"""
+Отметка отправленных напоминаний: пакетные UPDATE против коммита на клиента
+
+Во временной SQLite базе создаются клиенты, затем отметка отправленных напоминаний
+через NotificationService._mark_sent (UPDATE ... WHERE id IN на порцию) сравнивается
+с прежним способом - ORM-объект и commit на каждого клиента.
+
+    python scripts/bench_notification_flags.py [--clients 100000] [--marked 5000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_env import Timer, reset_db  # noqa: E402
+
+from sqlalchemy import func, insert, select, update  # noqa: E402
+
+from bot.utils.db import async_session  # noqa: E402
+from bot.models.client import Client  # noqa: E402
+from bot.services.notification_service import NotificationService  # noqa: E402
+
+
+async def fill_clients(count: int):
+    """Создает клиентов без отправленных напоминаний"""
+    expiry_time = datetime.now() + timedelta(days=30)
+    async with async_session() as session:
+        for start in range(0, count, 10_000):
+            await session.execute(insert(Client), [
+                {
+                    "user_id": index + 1, "email": f"user_{index}", "uuid": f"uuid-{index}", "limit_ip": 3,
+                    "expiry_time": expiry_time, "is_active": True,
+                    "reminder_stages": 0, "tariff_id": 1
+                }
+                for index in range(start, min(start + 10_000, count))
+            ])
+        await session.commit()
+
+
+async def reset_state():
+    """Сбрасывает отметки напоминаний между замерами"""
+    async with async_session() as session:
+        await session.execute(update(Client).values(reminder_stages=0))
+        await session.commit()
+
+
+async def mark_per_client(client_ids: list, mask: int):
+    """Прежний способ: клиент загружается и фиксируется отдельным commit"""
+    async with async_session() as session:
+        for client_id in client_ids:
+            client = await session.get(Client, client_id)
+            client.reminder_stages = (client.reminder_stages or 0) | mask
+            await session.commit()
+
+
+async def count_marked(mask: int) -> int:
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count(Client.id)).where(Client.reminder_stages.op("&")(mask) != 0)
+        )
+        return result.scalar()
+
+
+async def main(clients: int, marked: int):
+    await reset_db()
+    await fill_clients(clients)
+
+    mask = NotificationService.STAGES[0][0]
+    client_ids = list(range(1, marked + 1))
+
+    with Timer() as per_client:
+        await mark_per_client(client_ids, mask)
+    assert await count_marked(mask) == marked
+
+    await reset_state()
+    with Timer() as batched:
+        await NotificationService._mark_sent({mask: client_ids}, [])
+    assert await count_marked(mask) == marked
+
+    print(f"Клиентов: {clients}, отмечено напоминаний: {marked}")
+    print(f"Отметка: commit на клиента {per_client.seconds:.2f} с, пакетный UPDATE {batched.seconds:.3f} с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100_000)
+    parser.add_argument("--marked", type=int, default=5_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.clients, args.marked))
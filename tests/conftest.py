@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import dotenv
+import pytest
+
+# Конфигурация читается из .env при импорте bot.config - для тестов подставляем
+# переменные окружения и временную SQLite базу
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+os.chdir(ROOT_DIR)
+
+dotenv.load_dotenv = lambda *args, **kwargs: True
+
+TEST_DB = os.path.join(tempfile.mkdtemp(prefix="vpnbot_tests_"), "test.db")
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{TEST_DB}",
+    "API_BASE_URL": "http://127.0.0.1:9",
+    "INBOUND_ID": "1",
+    "API_USERNAME": "test",
+    "API_PASSWORD": "test",
+})
+
+import bot.utils.db as db  # noqa: E402
+
+db.engine.echo = False
+logging.getLogger("sqlalchemy").setLevel(logging.WARNING)
+
+# Регистрируем все модели в Base.metadata до создания таблиц
+import bot.services.payment_service  # noqa: E402,F401
+import bot.services.broadcast_service  # noqa: E402,F401
+import bot.models.promo  # noqa: E402,F401
+import bot.models.dead_chat  # noqa: E402,F401
+
+
+@pytest.fixture
+def run_db():
+    """Выполняет сценарий в новом цикле событий на пустой базе"""
+    def runner(scenario):
+        async def wrapper():
+            from bot.services.message_gateway import MessageGateway
+            from bot.services.plan_registry import PlanRegistry
+
+            from bot.services.payment_service import PaymentService
+
+            # Очередь шлюза привязана к циклу событий предыдущего теста
+            MessageGateway._queue = None
+            MessageGateway._worker = None
+            # Незавершенные платежи предыдущего теста не должны переиспользоваться
+            PaymentService._pending_payments.clear()
+
+            async with db.engine.begin() as conn:
+                await conn.run_sync(db.Base.metadata.drop_all)
+            await db.init_db()
+            await PlanRegistry.load()
+
+            try:
+                return await scenario()
+            finally:
+                if MessageGateway._worker:
+                    MessageGateway._worker.cancel()
+                await db.engine.dispose()
+
+        return asyncio.run(wrapper())
+
+    return runner
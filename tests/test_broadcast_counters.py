@@ -0,0 +1,33 @@
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+from bot.services.broadcast_service import BroadcastService
+from bot.services.dead_chat_service import ChatUnavailableError
+
+
+def empty_stats():
+    return {"total": 4, "delivered": 0, "failed": 0, "blocked": 0, "skipped": 0}
+
+
+def test_registry_skips_are_not_counted_as_blocked():
+    stats = empty_stats()
+    forbidden = TelegramForbiddenError(SendMessage(chat_id=1, text="x"), "Forbidden: bot was blocked by the user")
+
+    BroadcastService._count_results(
+        [ChatUnavailableError("Чат 1 недоступен"), forbidden, RuntimeError("timeout"), object()],
+        stats
+    )
+
+    assert stats == {"total": 4, "delivered": 1, "failed": 1, "blocked": 1, "skipped": 1}
+
+
+def test_report_shows_blocked_and_skipped_separately():
+    stats = dict(empty_stats(), total=10, delivered=1, blocked=2, skipped=3)
+
+    report = BroadcastService.format_report(stats)
+    progress = BroadcastService.format_progress(stats)
+
+    assert "Бот заблокирован во время рассылки: 2" in report
+    assert "Пропущено (недоступны ранее): 3" in report
+    assert "6 из 10" in progress
+    assert "Бот заблокирован: 2" in progress
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+from bot.models.payment_activation import PaymentActivation
+from bot.services.payment_service import PaymentService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.vpn_service import VPNService
+
+CONCURRENT_CALLS = 20
+
+
+class FakeBot:
+    """Бот, запоминающий отправленные сообщения"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+async def create_pending_payment(payment_id: str):
+    plan = PlanRegistry.get_by_key("base")
+    async with async_session() as session:
+        user = User(tg_id=1001, username="tester")
+        session.add(user)
+        await session.flush()
+        session.add(Client(user_id=user.id, email="user_1001", uuid="uuid-1001", limit_ip=3, tariff_id=0))
+        session.add(Payment(user_id=user.id, plan_id=plan.id, status="pending", amount=plan.price, payment_id=payment_id))
+        await session.commit()
+
+
+def test_concurrent_activation_happens_once(run_db, monkeypatch):
+    payment_id = "payment-concurrency"
+    updates = []
+
+    async def fake_update_client(session, user_id, plan, **kwargs):
+        updates.append(user_id)
+        # Уступаем цикл событий, как при запросе к VPN серверу
+        await asyncio.sleep(0.01)
+        return True
+
+    monkeypatch.setattr(PaymentService, "update_client_after_payment", staticmethod(fake_update_client))
+
+    async def scenario():
+        await create_pending_payment(payment_id)
+        bot = FakeBot()
+
+        results = await asyncio.gather(*(
+            PaymentService.activate_payment(payment_id, bot, source=f"test-{index}")
+            for index in range(CONCURRENT_CALLS)
+        ))
+
+        # Уведомление уходит через шлюз сообщений - даем ему отправиться
+        for _ in range(100):
+            if bot.messages:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+
+        async with async_session() as session:
+            activations = (await session.execute(
+                select(func.count(PaymentActivation.id)).where(PaymentActivation.payment_id == payment_id)
+            )).scalar()
+            status = (await session.execute(
+                select(Payment.status).where(Payment.payment_id == payment_id)
+            )).scalar()
+
+        return results, activations, status, bot.messages
+
+    results, activations, status, messages = run_db(scenario)
+
+    assert results.count(True) == 1
+    assert activations == 1
+    assert status == "succeeded"
+    assert len(updates) == 1
+    assert len(messages) == 1
+    assert messages[0][0] == 1001
+
+
+def test_failed_activation_is_retried_and_notified_once(run_db, monkeypatch):
+    payment_id = "payment-retry"
+
+    async def fake_update_client_on_server(self, **kwargs):
+        return True
+
+    monkeypatch.setattr(VPNService, "update_client_on_server", fake_update_client_on_server)
+
+    async def scenario():
+        plan = PlanRegistry.get_by_key("base")
+        async with async_session() as session:
+            user = User(tg_id=1002, username="retry")
+            session.add(user)
+            await session.flush()
+            session.add(Payment(user_id=user.id, plan_id=plan.id, status="pending", amount=plan.price, payment_id=payment_id))
+            await session.commit()
+            user_id = user.id
+
+        bot = FakeBot()
+
+        # Клиента еще нет - тариф не выдан, об успехе не сообщаем
+        activated = await PaymentService.activate_payment(payment_id, bot, source="test")
+        await asyncio.sleep(0.05)
+        messages_after_failure = list(bot.messages)
+
+        async with async_session() as session:
+            session.add(Client(user_id=user_id, email="user_1002", uuid="uuid-1002", limit_ip=3, tariff_id=0))
+            activation = (await session.execute(
+                select(PaymentActivation).where(PaymentActivation.payment_id == payment_id)
+            )).scalar_one()
+            assert activation.completed_at is None
+            # Захват был давно - исходный обработчик уже не работает
+            activation.created_at = datetime.utcnow() - timedelta(seconds=PaymentService.ACTIVATION_RETRY_DELAY + 1)
+            await session.commit()
+
+        retried = await PaymentService.retry_incomplete_activations(bot)
+        retried_again = await PaymentService.retry_incomplete_activations(bot)
+
+        for _ in range(100):
+            if bot.messages:
+                break
+            await asyncio.sleep(0.01)
+
+        async with async_session() as session:
+            completed_at = (await session.execute(
+                select(PaymentActivation.completed_at).where(PaymentActivation.payment_id == payment_id)
+            )).scalar()
+            expiry_time = (await session.execute(select(Client.expiry_time))).scalar()
+
+        return activated, messages_after_failure, retried, retried_again, completed_at, expiry_time, bot.messages
+
+    activated, messages_after_failure, retried, retried_again, completed_at, expiry_time, messages = run_db(scenario)
+
+    assert activated is False
+    assert messages_after_failure == []
+    assert retried == 1
+    assert retried_again == 0
+    assert completed_at is not None
+    assert expiry_time is not None
+    assert len(messages) == 1
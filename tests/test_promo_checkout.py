@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.payment import Payment
+from bot.models.promo import Promo
+from bot.services.checkout_service import CheckoutService
+from bot.services.payment_service import PaymentService
+
+
+async def create_users(*tg_ids):
+    async with async_session() as session:
+        users = [User(tg_id=tg_id, username=f"user{tg_id}") for tg_id in tg_ids]
+        session.add_all(users)
+        await session.commit()
+        return [user.id for user in users]
+
+
+async def create_promo(code: str, usage_limit: int = 1):
+    async with async_session() as session:
+        session.add(Promo(code=code, discount=50, usage_limit=usage_limit, used_count=0, is_active=True))
+        await session.commit()
+
+
+async def read_promo(code: str):
+    async with async_session() as session:
+        return (await session.execute(select(Promo).where(Promo.code == code))).scalar_one()
+
+
+async def count_payments():
+    async with async_session() as session:
+        return len((await session.execute(select(Payment.id))).all())
+
+
+def test_single_use_promo_is_redeemed_once(run_db):
+    async def scenario():
+        first, second = await create_users(4001, 4002)
+        await create_promo("ONCE")
+
+        # Оба расчета выданы, пока код еще не использован
+        quotes = [
+            await CheckoutService.build_quote(4001, "base", "ONCE", first),
+            await CheckoutService.build_quote(4002, "base", "ONCE", second)
+        ]
+        assert all(quote.promo_code == "ONCE" for quote in quotes)
+
+        results = await asyncio.gather(
+            *(PaymentService.create_payment(quote) for quote in quotes), return_exceptions=True
+        )
+        return results, await read_promo("ONCE"), await count_payments()
+
+    results, promo, payments = run_db(scenario)
+
+    created = [result for result in results if not isinstance(result, Exception)]
+    rejected = [result for result in results if isinstance(result, ValueError)]
+    assert len(created) == 1 and created[0][0]
+    assert len(rejected) == 1
+    assert promo.used_count == 1
+    assert promo.is_active is False
+    assert payments == 1
+
+
+def test_promo_disabled_after_quote_is_not_applied(run_db):
+    async def scenario():
+        user_id, = await create_users(4003)
+        await create_promo("LATER", usage_limit=0)
+        quote = await CheckoutService.build_quote(4003, "base", "LATER", user_id)
+
+        async with async_session() as session:
+            promo = (await session.execute(select(Promo).where(Promo.code == "LATER"))).scalar_one()
+            promo.is_active = False
+            await session.commit()
+
+        # Расчет еще действителен, но промокод уже отключен
+        assert CheckoutService.is_valid(quote, "base", "LATER")
+        with pytest.raises(ValueError):
+            await PaymentService.create_payment(quote)
+        return await read_promo("LATER"), await count_payments()
+
+    promo, payments = run_db(scenario)
+
+    assert promo.used_count == 0
+    assert payments == 0
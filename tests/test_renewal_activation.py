@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+from bot.services.payment_service import PaymentService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.vpn_service import VPNService
+
+
+async def create_client_with_payment(payment_id: str, expiry_time: datetime, is_renewal: bool):
+    plan = PlanRegistry.get_by_key("base")
+    async with async_session() as session:
+        user = User(tg_id=2002, username="renewal")
+        session.add(user)
+        await session.flush()
+        session.add(Client(
+            user_id=user.id, email="user_2002", uuid="uuid-2002", limit_ip=3,
+            tariff_id=plan.tariff_id, expiry_time=expiry_time
+        ))
+        session.add(Payment(
+            user_id=user.id, plan_id=plan.id, status="pending", amount=plan.price,
+            payment_id=payment_id, is_renewal=is_renewal
+        ))
+        await session.commit()
+    return plan
+
+
+async def activate_and_get_expiry(payment_id: str) -> datetime:
+    assert await PaymentService.activate_payment(payment_id, source="poller")
+    async with async_session() as session:
+        return (await session.execute(select(Client.expiry_time))).scalar()
+
+
+def stub_vpn(monkeypatch):
+    async def fake_update_client_on_server(self, **kwargs):
+        return True
+
+    monkeypatch.setattr(VPNService, "update_client_on_server", fake_update_client_on_server)
+
+
+def test_pending_renewal_extends_from_current_expiry(run_db, monkeypatch):
+    stub_vpn(monkeypatch)
+    expiry_time = datetime.now() + timedelta(hours=20)
+
+    async def scenario():
+        plan = await create_client_with_payment("renewal-pending", expiry_time, is_renewal=True)
+        return plan, await activate_and_get_expiry("renewal-pending")
+
+    plan, new_expiry = run_db(scenario)
+
+    # Оставшиеся 20 часов подписки не теряются
+    assert new_expiry == expiry_time + timedelta(days=plan.duration_days)
+
+
+def test_renewal_of_expired_subscription_starts_now(run_db, monkeypatch):
+    stub_vpn(monkeypatch)
+    expiry_time = datetime.now() - timedelta(days=3)
+
+    async def scenario():
+        plan = await create_client_with_payment("renewal-expired", expiry_time, is_renewal=True)
+        started = datetime.now()
+        return plan, started, await activate_and_get_expiry("renewal-expired")
+
+    plan, started, new_expiry = run_db(scenario)
+
+    assert new_expiry >= started + timedelta(days=plan.duration_days)
+
+
+def test_regular_payment_starts_now(run_db, monkeypatch):
+    stub_vpn(monkeypatch)
+    expiry_time = datetime.now() + timedelta(days=10)
+
+    async def scenario():
+        plan = await create_client_with_payment("regular", expiry_time, is_renewal=False)
+        started = datetime.now()
+        return plan, started, await activate_and_get_expiry("regular")
+
+    plan, started, new_expiry = run_db(scenario)
+
+    assert started + timedelta(days=plan.duration_days) <= new_expiry < expiry_time + timedelta(days=plan.duration_days)
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import bot.services.renewal_service as renewal_module
+from sqlalchemy import func, select
+
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+from bot.models.payment_activation import PaymentActivation
+from bot.services.plan_registry import PlanRegistry
+from bot.services.renewal_service import RenewalService
+from bot.services.vpn_service import VPNService
+
+
+class FakeYooKassa:
+    """Заглушка yookassa.Payment: один платеж на ключ идемпотентности, как в API"""
+
+    def __init__(self, status: str = "succeeded", fail: bool = False):
+        self.status = status
+        self.fail = fail
+        self.calls = 0
+        self.payments = {}
+
+    def create(self, payment_data, idempotency_key=None):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("YooKassa недоступна")
+        if idempotency_key not in self.payments:
+            self.payments[idempotency_key] = SimpleNamespace(
+                id=f"renewal-{len(self.payments) + 1}", status=self.status, paid=self.status == "succeeded"
+            )
+        return self.payments[idempotency_key]
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+def setup_fakes(monkeypatch, yookassa):
+    async def fake_update_client_on_server(self, **kwargs):
+        return True
+
+    monkeypatch.setattr(renewal_module, "Payment", yookassa)
+    monkeypatch.setattr(renewal_module, "yookassa_configured", True)
+    monkeypatch.setattr(VPNService, "update_client_on_server", fake_update_client_on_server)
+    RenewalService._failure_notified.clear()
+
+
+async def create_expiring_client(expiry_time: datetime):
+    plan = PlanRegistry.get_by_key("base")
+    async with async_session() as session:
+        user = User(tg_id=5005, username="renew", auto_renew=True, payment_method_id="pm-1")
+        session.add(user)
+        await session.flush()
+        session.add(Client(
+            user_id=user.id, email="user_5005", uuid="uuid-5005", limit_ip=3,
+            tariff_id=plan.tariff_id, expiry_time=expiry_time, is_active=True
+        ))
+        await session.commit()
+    return plan
+
+
+async def read_state():
+    async with async_session() as session:
+        payments = (await session.execute(select(Payment.payment_id, Payment.status, Payment.is_renewal))).all()
+        activations = (await session.execute(select(func.count(PaymentActivation.id)))).scalar()
+        expiry_time = (await session.execute(select(Client.expiry_time))).scalar()
+    return payments, activations, expiry_time
+
+
+async def wait_messages(bot):
+    for _ in range(50):
+        if bot.messages:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+
+
+def test_renewal_charges_and_extends_once(run_db, monkeypatch):
+    yookassa = FakeYooKassa()
+    setup_fakes(monkeypatch, yookassa)
+    expiry_time = datetime.now() + timedelta(hours=10)
+
+    async def scenario():
+        plan = await create_expiring_client(expiry_time)
+        first = await RenewalService.renew_expiring()
+        second = await RenewalService.renew_expiring()
+        return plan, first, second, await read_state()
+
+    plan, first, second, (payments, activations, new_expiry) = run_db(scenario)
+
+    assert first["charged"] == 1
+    assert second["candidates"] == 0
+    assert yookassa.calls == 1
+    assert len(payments) == 1 and payments[0].status == "succeeded" and payments[0].is_renewal
+    assert activations == 1
+    assert new_expiry == expiry_time + timedelta(days=plan.duration_days)
+
+
+def test_pending_renewal_is_recorded_once(run_db, monkeypatch):
+    yookassa = FakeYooKassa(status="pending")
+    setup_fakes(monkeypatch, yookassa)
+    expiry_time = datetime.now() + timedelta(hours=10)
+
+    async def scenario():
+        await create_expiring_client(expiry_time)
+        first = await RenewalService.renew_expiring()
+        # Повторный запуск получает тот же платеж по ключу идемпотентности - он уже записан
+        second = await RenewalService.renew_expiring()
+        return first, second, await read_state()
+
+    first, second, (payments, activations, new_expiry) = run_db(scenario)
+
+    assert first["pending"] == 1
+    assert second["pending"] == 0 and second["charged"] == 0
+    assert yookassa.calls == 2 and len(yookassa.payments) == 1
+    assert len(payments) == 1 and payments[0].status == "pending"
+    assert activations == 0
+    assert new_expiry == expiry_time
+
+
+def test_failed_charge_is_retried_but_notified_once(run_db, monkeypatch):
+    yookassa = FakeYooKassa(fail=True)
+    setup_fakes(monkeypatch, yookassa)
+
+    async def scenario():
+        await create_expiring_client(datetime.now() + timedelta(hours=10))
+        bot = FakeBot()
+        first = await RenewalService.renew_expiring(bot)
+        second = await RenewalService.renew_expiring(bot)
+        await wait_messages(bot)
+        return first, second, bot.messages, await read_state()
+
+    first, second, messages, (payments, activations, _) = run_db(scenario)
+
+    assert first["failed"] == 1 and second["failed"] == 1
+    assert yookassa.calls == 2
+    assert payments == []
+    assert len(messages) == 1
@@ -0,0 +1,78 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import select
+
+from bot.utils.db import async_session
+from bot.models.user import User
+from bot.models.client import Client
+from bot.models.payment import Payment
+from bot.models.stat_counter import StatCounter
+from bot.services.payment_service import PaymentService
+from bot.services.plan_registry import PlanRegistry
+from bot.services.stats_service import StatsService
+
+
+async def read_counters():
+    async with async_session() as session:
+        result = await session.execute(
+            select(StatCounter.metric, StatCounter.day, StatCounter.tariff_id, StatCounter.value)
+            .where(StatCounter.metric.in_([StatsService.USERS, StatsService.PAYMENTS, StatsService.REVENUE]))
+        )
+        return sorted(result.all())
+
+
+def test_incremental_counters_match_rebuild(run_db, monkeypatch):
+    # Часовой пояс, в котором локальный день сейчас отличается от дня по UTC
+    monkeypatch.setenv("TZ", "Etc/GMT+12" if datetime.utcnow().hour < 12 else "Etc/GMT-14")
+    time.tzset()
+
+    async def fake_update_client(session, user_id, plan, **kwargs):
+        return True
+
+    monkeypatch.setattr(PaymentService, "update_client_after_payment", staticmethod(fake_update_client))
+
+    async def scenario():
+        plan = PlanRegistry.get_by_key("base")
+        async with async_session() as session:
+            user = User(tg_id=3003, username="stats")
+            session.add(user)
+            await StatsService.record_user_created(session)
+            await session.flush()
+            session.add(Client(user_id=user.id, email="user_3003", uuid="uuid-3003", limit_ip=3, tariff_id=0))
+            session.add(Payment(user_id=user.id, plan_id=plan.id, status="pending", amount=plan.price, payment_id="stats-payment"))
+            await session.commit()
+
+        assert await PaymentService.activate_payment("stats-payment", source="test")
+        incremental = await read_counters()
+
+        await StatsService.rebuild()
+        return incremental, await read_counters()
+
+    try:
+        incremental, rebuilt = run_db(scenario)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert incremental == rebuilt
+    assert StatsService.today() in {day for _, day, _, _ in incremental}
+
+
+def test_admin_payment_card_shows_local_time(monkeypatch):
+    from bot.handlers.admin import format_payments
+
+    monkeypatch.setenv("TZ", "Etc/GMT-3")
+    time.tzset()
+    try:
+        payment = Payment(
+            id=1, amount=100, status="succeeded",
+            created_at=datetime(2026, 1, 1, 21, 30), paid_at=datetime(2026, 1, 1, 22, 0)
+        )
+        text = format_payments([(payment, User(tg_id=1, username="u"))])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert "Создан: 02.01.2026 00:30" in text
+    assert "Оплачен: 02.01.2026 01:00" in text
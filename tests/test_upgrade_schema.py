@@ -0,0 +1,67 @@
+import asyncio
+import warnings
+
+from sqlalchemy import text
+from sqlalchemy.exc import SAWarning
+
+import bot.utils.db as db
+
+
+async def index_names(conn, table):
+    return {row[1]: row[2] for row in await conn.execute(text(f"PRAGMA index_list({table})"))}
+
+
+def test_unique_indexes_ignore_nulls_and_skip_duplicates():
+    async def scenario():
+        async with db.engine.begin() as conn:
+            await conn.run_sync(db.Base.metadata.drop_all)
+            # Таблицы старой схемы: у планов еще нет ключа, у части промокодов нет кода
+            await conn.execute(text(
+                "CREATE TABLE plans (id INTEGER PRIMARY KEY, title TEXT, traffic_limit BIGINT, "
+                "duration_days INTEGER, price INTEGER)"
+            ))
+            await conn.execute(text("INSERT INTO plans (title, price) VALUES ('old-1', 10), ('old-2', 20)"))
+            await conn.execute(text(
+                "CREATE TABLE promik (id INTEGER PRIMARY KEY, code TEXT, discount DECIMAL, expiration_date DATETIME, "
+                "usage_limit INTEGER, used_count INTEGER, is_active BOOLEAN, user_id INTEGER, used_at DATETIME)"
+            ))
+            await conn.execute(text("INSERT INTO promik (code) VALUES (NULL), (NULL), ('A'), ('B')"))
+
+        try:
+            await db.init_db()
+            async with db.engine.begin() as conn:
+                plans_indexes = await index_names(conn, "plans")
+                promo_indexes = await index_names(conn, "promik")
+
+                # Повторяющийся код - уникальный индекс не создается, запуск не падает
+                await conn.execute(text("DROP INDEX ix_promik_code"))
+                await conn.execute(text("INSERT INTO promik (code) VALUES ('A')"))
+            await db.init_db()
+            async with db.engine.begin() as conn:
+                promo_indexes_with_duplicates = await index_names(conn, "promik")
+        finally:
+            async with db.engine.begin() as conn:
+                await conn.run_sync(db.Base.metadata.drop_all)
+            await db.engine.dispose()
+
+        return plans_indexes, promo_indexes, promo_indexes_with_duplicates
+
+    plans_indexes, promo_indexes, promo_indexes_with_duplicates = asyncio.run(scenario())
+
+    assert plans_indexes.get("ix_plans_key") == 1
+    assert promo_indexes.get("ix_promik_code") == 1
+    assert "ix_promik_code" not in promo_indexes_with_duplicates
+
+
+def test_upgrade_does_not_warn_about_expression_indexes():
+    async def scenario():
+        await db.init_db()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", SAWarning)
+                # Таблицы уже созданы - upgrade_schema читает индексы, в том числе по выражениям
+                await db.init_db()
+        finally:
+            await db.engine.dispose()
+
+    asyncio.run(scenario())